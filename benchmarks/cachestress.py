@@ -0,0 +1,119 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+"""Stress a shared verdict cache from several processes at once.
+
+Every process reads and writes random addresses of a common pool. The score of an address is derived
+from the address, so any other score read back means a corrupted record. The cache starts with a
+small map and entry limit to exercise map growth and eviction under concurrency:
+
+    python benchmarks/cachestress.py [--processes 8] [--ops 20000] [--addresses 5000]
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+from datetime import timedelta
+from typing import Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import lmdb  # pylint: disable=wrong-import-position
+from vpncheck import VerdictCache  # pylint: disable=wrong-import-position
+
+WRITE_SHARE = 0.3
+
+
+def address(index: int) -> str:
+    return f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+
+
+def expectedScore(ip: str) -> int:
+    return zlib.crc32(ip.encode("utf-8")) % 5
+
+
+def openCache(path: str, maxEntries: int) -> VerdictCache:
+    return VerdictCache(path, "iphub", timedelta(days=1), maxEntries=maxEntries, mapSize=2**18, shared=True)
+
+
+def worker(path: str, seed: int, ops: int, addresses: int, maxEntries: int) -> Tuple[int, int, int, int]:
+    """Return reads, hits, mismatches and errors."""
+    rng = random.Random(seed)
+    cache = openCache(path, maxEntries)
+    reads = hits = mismatches = errors = 0
+    for i in range(ops):
+        ip = address(rng.randrange(addresses))
+        try:
+            if rng.random() < WRITE_SHARE:
+                cache.put(ip, expectedScore(ip))
+            else:
+                reads += 1
+                score = cache.get(ip)
+                if score is not None:
+                    hits += 1
+                    if score != expectedScore(ip):
+                        mismatches += 1
+        except lmdb.Error as ex:
+            errors += 1
+            print(f"process {seed}, operation {i}: {ex!r}")
+        if i % 1000 == 0:
+            cache.sync()
+    cache.close()
+    return reads, hits, mismatches, errors
+
+
+def verify(path: str, maxEntries: int) -> Tuple[int, int]:
+    """Return the number of records and of records with a wrong score."""
+    cache = openCache(path, maxEntries)
+    now = int(time.time())
+    records = wrong = 0
+    with cache.begin() as txn:
+        for key, value in txn.cursor():
+            records += 1
+            score, _, _ = cache.decode(value, now)
+            if score != expectedScore(str(key, "utf-8")):
+                wrong += 1
+    cache.close()
+    return records, wrong
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=20000, help="operations per process")
+    parser.add_argument("--addresses", type=int, default=5000, help="size of the address pool")
+    parser.add_argument("--max-entries", type=int, default=2000, help="entry limit of the cache")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "cache")
+    # create the database before the workers race for it
+    openCache(path, args.max_entries).close()
+    start = time.perf_counter()
+    # spawned, LMDB environments must not be inherited by forked processes
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.starmap(
+            worker, [(path, seed, args.ops, args.addresses, args.max_entries) for seed in range(args.processes)]
+        )
+    elapsed = time.perf_counter() - start
+    reads, hits, mismatches, errors = (sum(values) for values in zip(*results))
+    records, wrong = verify(path, args.max_entries)
+
+    totalOps = args.processes * args.ops
+    print(f"{args.processes} processes, {totalOps} operations in {elapsed:.1f}s ({totalOps / elapsed:.0f} ops/s)")
+    print(f"reads: {reads}, hit rate {hits / reads if reads else 0:.1%}")
+    print(f"mismatches: {mismatches}, errors: {errors}")
+    print(f"records at the end: {records} (limit {args.max_entries}), wrong scores: {wrong}")
+    sys.exit(1 if mismatches or errors or wrong else 0)
+
+
+if __name__ == "__main__":
+    main()
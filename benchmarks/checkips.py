@@ -0,0 +1,300 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+"""Measure the MediaWiki API calls and wall time of check-ips.py on a recent changes fixture, offline.
+
+The block status of the reverted addresses is resolved once with one isBlocked() request per address
+(as check-ips.py did before the batched pre-pass) and once with batched list=blocks queries plus the
+active range blocks, and both results must agree. The MediaWiki API is an in-process stub with a fixed
+latency and synthetic blocks of single addresses and ranges, providers and DNSBL are served by the
+stubs of replay.py.
+Record a fixture with
+
+    python pwb.py check-ips -saverc:rc.json
+
+and run
+
+    python benchmarks/checkips.py --fixture rc.json
+
+Without a fixture a synthetic dewiki day is used.
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import contextlib
+import importlib
+import io
+import ipaddress
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pywikibot  # pylint: disable=wrong-import-position
+from replay import ProviderHandler, ipFor, serveDns  # pylint: disable=wrong-import-position
+
+
+def sanitizeIp(ipOrRange: str) -> str:
+    """Block target as MediaWiki stores it: IPv6 groups in upper case, without leading zeros, not compressed."""
+    network = ipaddress.ip_network(ipOrRange, strict=False)
+    address = network.network_address
+    if address.version == 4:
+        text = str(address)
+    else:
+        text = ":".join(f"{int(group, 16):X}" for group in address.exploded.split(":"))
+    return text if "/" not in ipOrRange else f"{text}/{network.prefixlen}"
+
+
+class StubSite:
+    """Answers the API requests of check-ips.py after latency seconds and counts them by module.
+
+    blocks() follows list=blocks: bkusers only matches blocks of exactly these targets, range blocks
+    covering an address are not returned for it, and results are paged. isBlocked() of StubUser follows
+    the blockinfo of list=users, which includes range blocks, and is computed independently."""
+
+    def __init__(self, latency: float, highLimits: bool) -> None:
+        self.latency = latency
+        self.highLimits = highLimits
+        self.requests: Counter[str] = Counter()
+        self.lock = threading.Lock()
+        self.targets: Set[str] = set()
+        self.userInfoLoaded = False
+
+    def setBlocks(self, targets: Iterable[str]) -> None:
+        self.targets = {sanitizeIp(target) for target in targets}
+
+    def request(self, module: str) -> None:
+        with self.lock:
+            self.requests[module] += 1
+        time.sleep(self.latency)
+
+    def isBlocked(self, ip: str) -> bool:
+        address = ipaddress.ip_address(ip)
+        if sanitizeIp(ip) in self.targets:
+            return True
+        return any(
+            sanitizeIp(str(ipaddress.ip_network((address, prefixLen), strict=False))) in self.targets
+            for prefixLen in range(address.max_prefixlen)
+        )
+
+    def login(self) -> None:
+        self.request("login")
+
+    def has_right(self, right: str) -> bool:  # pylint: disable=invalid-name
+        if not self.userInfoLoaded:
+            self.request("userinfo")
+            self.userInfoLoaded = True
+        return right == "apihighlimits" and self.highLimits
+
+    def blocks(self, users: Optional[List[str]] = None, ip_range: bool = False) -> Iterator[Dict[str, Any]]:
+        if users is not None:
+            if len(users) > (500 if self.highLimits else 50):
+                raise ValueError("Too many values supplied for parameter bkusers")
+            targets = sorted(self.targets.intersection(sanitizeIp(user) for user in users))
+        elif ip_range:
+            targets = sorted(target for target in self.targets if "/" in target)
+        else:
+            targets = sorted(self.targets)
+        pageSize = 5000 if self.highLimits else 500
+        self.request("blocks")
+        for i, target in enumerate(targets):
+            if i and i % pageSize == 0:
+                self.request("blocks")
+            yield {"user": target}
+
+
+class StubUser:
+    def __init__(self, site: StubSite, name: str) -> None:
+        self.site = site
+        self.username = name
+
+    def isAnonymous(self) -> bool:  # pylint: disable=invalid-name
+        try:
+            ipaddress.ip_address(self.username)
+        except ValueError:
+            return False
+        return True
+
+    def isBlocked(self, force: bool = False) -> bool:  # pylint: disable=invalid-name,unused-argument
+        self.site.request("users")
+        return self.site.isBlocked(self.username)
+
+
+def syntheticChanges(count: int, poolSize: int) -> List[Dict[str, Any]]:
+    """A dewiki-like day of recent changes as returned by the API: edits, rollbacks, undos, VM reports, blocks."""
+    rng = random.Random(42)
+    start = datetime.utcnow() - timedelta(hours=23)
+    changes: List[Dict[str, Any]] = []
+    for i in range(count):
+        timestamp = start + timedelta(seconds=i * 23 * 3600 / count)
+        ts = timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+        ip = ipFor(rng.randrange(poolSize * 3), poolSize)
+        base = {"rcid": 300000000 + i, "timestamp": ts, "ns": 0, "title": f"Artikel {i % 5000}", "tags": []}
+        kind = rng.random()
+        if kind < 0.75:
+            changes.append({**base, "type": "edit", "user": ip, "anon": "", "comment": "typo"})
+        elif kind < 0.93:
+            changes.append({**base, "type": "edit", "user": "Autor", "comment": "Ergänzung"})
+        elif kind < 0.97:
+            comment = f"Änderungen von [[Spezial:Beiträge/{ip}|{ip}]] rückgängig gemacht"
+            changes.append({**base, "type": "edit", "user": "Sichter", "comment": comment, "tags": ["mw-rollback"]})
+        elif kind < 0.985:
+            comment = f"Änderung {rng.randrange(10 ** 8)} von [[Special:Contribs/{ip}|{ip}]] rückgängig gemacht"
+            changes.append({**base, "type": "edit", "user": "Sichter", "comment": comment, "tags": ["mw-undo"]})
+        elif kind < 0.99:
+            comment = f"Neuer Abschnitt /* Benutzer:{ip} */"
+            changes.append(
+                {
+                    **base,
+                    "type": "edit",
+                    "ns": 4,
+                    "title": "Wikipedia:Vandalismusmeldung",
+                    "user": "Melder",
+                    "comment": comment,
+                }
+            )
+        else:
+            duration = rng.choice([timedelta(hours=2), timedelta(days=1), timedelta(weeks=1), timedelta(days=30)])
+            changes.append(
+                {
+                    **base,
+                    "type": "log",
+                    "ns": 2,
+                    "title": f"Benutzer:{ip}",
+                    "user": "Admin",
+                    "comment": "Vandalismus",
+                    "logtype": "block",
+                    "logaction": "block",
+                    "logparams": {"expiry": (timestamp + duration).strftime("%Y-%m-%dT%H:%M:%SZ")},
+                }
+            )
+    return changes
+
+
+def syntheticBlocks(ips: Iterable[str], blockedRatio: float, rangeRatio: float, otherRanges: int) -> List[str]:
+    """Block targets: blocks of single addresses, range blocks covering addresses and unrelated range blocks."""
+    targets = []
+    for ip in ips:
+        rng = random.Random(ip)
+        if rng.random() < blockedRatio:
+            targets.append(ip)
+        if rng.random() < rangeRatio:
+            prefixLen = rng.choice([20, 22, 24]) if ipaddress.ip_address(ip).version == 4 else rng.choice([48, 56, 64])
+            targets.append(str(ipaddress.ip_network(f"{ip}/{prefixLen}", strict=False)))
+    rng = random.Random(0)
+    for _ in range(otherRanges):
+        if rng.random() < 0.7:
+            targets.append(
+                str(ipaddress.ip_network(f"{ipaddress.IPv4Address(rng.randrange(2 ** 32))}/24", strict=False))
+            )
+        else:
+            targets.append(
+                str(ipaddress.ip_network(f"{ipaddress.IPv6Address(rng.randrange(2 ** 128))}/64", strict=False))
+            )
+    return targets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", help="recent changes recorded with check-ips -saverc, default: synthetic day")
+    parser.add_argument("--changes", type=int, default=80000, help="number of synthetic changes")
+    parser.add_argument("--ip-pool", type=int, default=20000, help="number of distinct addresses")
+    parser.add_argument("--wiki-latency", type=float, default=100.0, help="MediaWiki API latency in ms")
+    parser.add_argument("--latency", type=float, default=50.0, help="provider latency in ms")
+    parser.add_argument("--blocked-ratio", type=float, default=0.2, help="fraction of blocked addresses")
+    parser.add_argument("--range-ratio", type=float, default=0.03, help="fraction of addresses in a blocked range")
+    parser.add_argument("--other-ranges", type=int, default=3000, help="number of range blocks of other addresses")
+    parser.add_argument("--no-highlimits", action="store_true", help="50 instead of 500 addresses per query")
+    args = parser.parse_args()
+
+    if args.fixture:
+        with open(args.fixture, "r", encoding="utf-8") as f:
+            changes = json.load(f)
+    else:
+        changes = syntheticChanges(args.changes, args.ip_pool)
+
+    ProviderHandler.latency = args.latency / 1000
+    providerServer = ThreadingHTTPServer(("127.0.0.1", 0), ProviderHandler)
+    threading.Thread(target=providerServer.serve_forever, daemon=True).start()
+    baseUrl = f"http://127.0.0.1:{providerServer.server_address[1]}"
+    dnsSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dnsSocket.bind(("127.0.0.1", 0))
+    threading.Thread(target=serveDns, args=(dnsSocket, 0.3), daemon=True).start()
+
+    site = StubSite(args.wiki_latency / 1000, not args.no_highlimits)
+    pywikibot.Site = lambda *a, **k: site
+    pywikibot.User = StubUser
+
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("cache")
+    # pylint: disable=import-outside-toplevel
+    from dnsbl import DnsblChecker
+    from quota import QuotaLimiter
+
+    checkIps = importlib.import_module("check-ips")
+    program = checkIps.Program()
+    program.dnsbl = DnsblChecker(nameserver="127.0.0.1", port=dnsSocket.getsockname()[1])
+    vpnCheck = program.vpnCheck
+    vpnCheck.teohUrl = f"{baseUrl}/teoh/"
+    vpnCheck.iphubUrl = f"{baseUrl}/iphub/ip/"
+    vpnCheck.ipcheckUrl = f"{baseUrl}/ipcheck/index.php"
+    # the stubs have no rate limit
+    for provider in vpnCheck.limiters:
+        vpnCheck.limiters[provider] = QuotaLimiter(f"cache/quota-{provider}.json", provider, None, 1e6, 10**6)
+
+    for ch in changes:
+        program.aggregates.add(ch)
+    revertedIps = sorted(program.aggregates.reverts)
+    site.setBlocks(syntheticBlocks(revertedIps, args.blocked_ratio, args.range_ratio, args.other_ranges))
+
+    site.requests.clear()
+    start = time.monotonic()
+    before = {ip for ip in revertedIps if StubUser(site, ip).isBlocked()}
+    beforeTime = time.monotonic() - start
+    beforeCalls = sum(site.requests.values())
+
+    site.requests.clear()
+    start = time.monotonic()
+    after = program.getBlockedIps(revertedIps)
+    afterTime = time.monotonic() - start
+    afterCalls = sum(site.requests.values())
+    if before != after:
+        raise AssertionError(f"The batched pre-pass differs from isBlocked() for {sorted(before ^ after)[:10]}")
+
+    program.aggregates = checkIps.Aggregates(site)
+    site.requests.clear()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        program.listIPs(changes)
+    runTime = time.monotonic() - start
+    program.vpnCheck.close()
+
+    rangeBlocked = sum(1 for ip in after if sanitizeIp(ip) not in site.targets)
+    print(f"{len(changes)} changes, {len(revertedIps)} reverted addresses")
+    print(
+        f"{len(site.targets)} blocks, {len(after)} reverted addresses blocked, {rangeBlocked} of them by range blocks"
+    )
+    print(f"Block status, one isBlocked() per address: {beforeCalls} API calls, {beforeTime:.2f} s")
+    print(f"Block status, batched list=blocks and range blocks: {afterCalls} API calls, {afterTime:.2f} s")
+    print("Both agree on every address.")
+    # the recent changes come from the fixture, a live run fetches them in addition
+    print(f"Whole run without fetching recent changes: {runTime:.2f} s, API calls: {dict(site.requests)}")
+    print(f"Provider requests: {dict(ProviderHandler.requests)}")
+    providerServer.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+"""Replay a recorded EventStreams capture through the sentinel, completely offline.
+
+The provider APIs (teoh, iphub, ipcheck) are served by a local stub HTTP server, DNSBL queries by a
+local stub DNS server and the MediaWiki API by in-process stubs. Record a capture with
+
+    curl -sN https://stream.wikimedia.org/v2/stream/recentchange > recentchange.sse
+
+and run
+
+    python benchmarks/replay.py --capture recentchange.sse --speedup 10
+
+Without a capture a synthetic dewiki stream is used. Reports events/s, the latency from an event
+to the decision about it (completion of its pipeline jobs), cache hit ratios and peak RSS.
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import contextlib
+import functools
+import io
+import ipaddress
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import metrics  # pylint: disable=wrong-import-position
+import pywikibot  # pylint: disable=wrong-import-position
+from pywikibot.data import api  # pylint: disable=wrong-import-position
+from sse import ReplaySession  # pylint: disable=wrong-import-position
+from sseclient import SSEClient  # pylint: disable=wrong-import-position
+
+SERVER_NAME = "de.wikipedia.org"
+VM_TITLE = "Wikipedia:Vandalismusmeldung"
+
+
+def ipFor(seed: int, poolSize: int) -> str:
+    """Deterministic address from a pool, so that addresses recur like they do in the real stream."""
+    n = zlib.crc32(str(seed % poolSize).encode("ascii"))
+    if n % 5 == 0:
+        return str(ipaddress.IPv6Address((0x2A02 << 112) | (n << 64)))
+    return str(ipaddress.IPv4Address(0x50000000 + n % 0x20000000))
+
+
+def isProxy(ip: str) -> bool:
+    return zlib.crc32(ip.encode("ascii")) % 10 == 0
+
+
+class ProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+    errorRate = 0.0
+    requests: "Counter[str]" = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        provider = url.path.split("/")[1]
+        with self.lock:
+            self.requests[provider] += 1
+        time.sleep(self.latency)
+        if random.random() < self.errorRate:
+            self.reply(503, b"Service Unavailable")
+            return
+        if provider == "ipcheck":
+            proxy = isProxy(parse_qs(url.query)["ip"][0])
+            data: Dict[str, Any] = {
+                "teohio": {"result": {"vpnOrProxy": proxy}},
+                "proxycheck": {"result": {"proxy": proxy}},
+                "getIPIntel": {"result": {"chance": 100 if proxy else 0}},
+                "ipQualityScore": {"result": {"proxy": False, "vpn": proxy}},
+                "cache": {"result": {"cached": "no"}},
+            }
+        elif provider == "iphub":
+            data = {"block": 1 if isProxy(url.path.split("/")[-1]) else 0}
+        else:
+            data = {"vpn_or_proxy": "yes" if isProxy(url.path.split("/")[-1]) else "no"}
+        self.reply(200, json.dumps(data).encode("utf-8"))
+
+    def reply(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+def serveDns(sock: socket.socket, listedRatio: float) -> None:
+    """Answer DNSBL queries, a stable listedRatio of the names is listed."""
+    while True:
+        packet, address = sock.recvfrom(4096)
+        queryId = packet[:2]
+        questionEnd = packet.index(b"\0", 12) + 5
+        question = packet[12:questionEnd]
+        if zlib.crc32(question) % 1000 < listedRatio * 1000:
+            answer = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 3600, 4) + bytes([127, 0, 0, 10])
+            sock.sendto(queryId + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0) + question + answer, address)
+        else:
+            sock.sendto(queryId + struct.pack("!HHHHH", 0x8183, 1, 0, 0, 0) + question, address)
+
+
+class StubMediaWiki:
+    """Answers the MediaWiki API requests of the sentinel.
+
+    Every revision of the VM page reports one address, a diff replaces the report of the old revision
+    with the one of the new revision."""
+
+    def __init__(self, latency: float, poolSize: int) -> None:
+        self.latency = latency
+        self.poolSize = poolSize
+        self.requests: "Counter[str]" = Counter()
+        self.savedEntries = 0
+        self.lock = threading.Lock()
+
+    def count(self, action: str) -> None:
+        with self.lock:
+            self.requests[action] += 1
+        time.sleep(self.latency)
+
+    def revisionText(self, revision: int) -> str:
+        self.count("revision")
+        return f"= Benutzer =\n\n== {{{{Benutzer|{ipFor(revision, self.poolSize)}}}}} ==\nBitte sperren. --~~~~\n"
+
+    def submit(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        action = parameters["action"]
+        self.count(action)
+        if action == "compare":
+            oldIp = ipFor(int(parameters["fromrev"]), self.poolSize)
+            newIp = ipFor(int(parameters["torev"]), self.poolSize)
+            body = (
+                f'<tr><td class="diff-deletedline diff-side-deleted"><div>== {{{{Benutzer|{oldIp}}}}} ==</div></td>'
+                f'<td class="diff-addedline diff-side-added"><div>== {{{{Benutzer|{newIp}}}}} ==</div></td></tr>'
+            )
+            return {"compare": {"body": body}}
+        if action == "edit":
+            with self.lock:
+                self.savedEntries += parameters["appendtext"].count("\n* ")
+            return {"edit": {"result": "Success"}}
+        raise ValueError(f"Unexpected API request: {parameters}")
+
+
+mediaWiki: Optional[StubMediaWiki] = None
+
+
+class StubRequest:
+    def __init__(self, site: Any = None, parameters: Optional[Dict[str, Any]] = None, **kwargs: Any) -> None:
+        self.parameters = parameters or kwargs
+
+    def submit(self) -> Dict[str, Any]:
+        assert mediaWiki
+        return mediaWiki.submit(self.parameters)
+
+
+class StubSite:
+    tokens = {"csrf": "+\\"}
+
+    def login(self) -> None:
+        pass
+
+    def hostname(self) -> str:
+        return SERVER_NAME
+
+    def logevents(self, **kwargs: Any) -> List[Any]:
+        return []
+
+
+class StubPage:
+    def __init__(self, site: Any, title: str, ns: int = 0) -> None:
+        self.site = site
+        self.fullTitle = title
+        self.ns = ns
+        self._rcinfo: Dict[str, Any] = {}
+
+    def title(self, with_ns: bool = True) -> str:  # pylint: disable=invalid-name
+        if with_ns or ":" not in self.fullTitle:
+            return self.fullTitle
+        return self.fullTitle.split(":", 1)[1]
+
+    def namespace(self) -> int:
+        return self.ns
+
+    def getOldVersion(self, revision: int) -> str:
+        assert mediaWiki
+        return mediaWiki.revisionText(revision)
+
+
+class StubUser:
+    def __init__(self, site: Any, name: str) -> None:
+        self.username = name.split(":", 1)[1] if name.startswith(("Benutzer:", "User:")) else name
+
+    def isAnonymous(self) -> bool:
+        try:
+            ipaddress.ip_address(self.username)
+        except ValueError:
+            return False
+        return True
+
+    def isBlocked(self, force: bool = False) -> bool:
+        assert mediaWiki
+        mediaWiki.count("blocks")
+        return False
+
+
+def syntheticEvents(count: int, poolSize: int, rate: float) -> List[Dict[str, Any]]:
+    """A dewiki-like mix of edits, rollbacks, VM reports and blocks, rate events per second."""
+    rng = random.Random(42)
+    events: List[Dict[str, Any]] = []
+    vmRevision = 200000000
+    # anonymous editors of the last minutes, reverts mostly hit one of them, preferably one who removed text
+    recentEditors: Deque[str] = deque(maxlen=200)
+    recentRemovers: Deque[str] = deque(maxlen=50)
+    for i in range(count):
+        ts = i / rate
+        kind = rng.random()
+        ip = ipFor(rng.randrange(poolSize * 3), poolSize)
+        base = {"wiki": "dewiki", "server_name": SERVER_NAME, "timestamp": ts, "bot": False, "namespace": 0}
+        if kind < 0.90:
+            oldLength = rng.randrange(1000, 50000)
+            newLength = oldLength - rng.randrange(500, 5000) if rng.random() < 0.1 else oldLength + rng.randrange(100)
+            length = {"old": oldLength, "new": newLength}
+            events.append(
+                {**base, "type": "edit", "title": f"Artikel {i}", "user": ip, "comment": "typo", "length": length}
+            )
+            recentEditors.append(ip)
+            if newLength < oldLength:
+                recentRemovers.append(ip)
+        elif kind < 0.95:
+            target = rng.random()
+            if recentRemovers and target < 0.5:
+                ip = rng.choice(recentRemovers)
+            elif recentEditors and target < 0.8:
+                ip = rng.choice(recentEditors)
+            comment = f"Änderungen von [[Spezial:Beiträge/{ip}|{ip}]] rückgängig gemacht"
+            events.append({**base, "type": "edit", "title": f"Artikel {i}", "user": "Sichter", "comment": comment})
+        elif kind < 0.97:
+            oldRevision = vmRevision
+            vmRevision += rng.randrange(1, 50)
+            events.append(
+                {
+                    **base,
+                    "type": "edit",
+                    "namespace": 4,
+                    "title": VM_TITLE,
+                    "user": "Melder",
+                    "comment": "Neuer Abschnitt",
+                    "revision": {"old": oldRevision, "new": vmRevision},
+                }
+            )
+        else:
+            events.append(
+                {
+                    **base,
+                    "type": "log",
+                    "namespace": 2,
+                    "title": f"Benutzer:{ip}",
+                    "user": "Admin",
+                    "comment": "Vandalismus",
+                    "log_id": 100000 + i,
+                    "log_type": "block",
+                    "log_action": "block",
+                    "log_params": {"duration": rng.choice(["2 hours", "1 day", "1 week", "1 month", "infinite"])},
+                }
+            )
+    return events
+
+
+def capturedEvents(path: str) -> List[Dict[str, Any]]:
+    with open(path, "rb") as f:
+        capture = f.read()
+    # a capture may end in the middle of an event
+    capture = capture[: capture.rfind(b"\n\n") + 2]
+    events = []
+    client = SSEClient("replay", session=ReplaySession(capture))
+    while True:
+        try:
+            msg = next(client)
+        except StopIteration:
+            break
+        if not msg.data:
+            continue
+        try:
+            entry = json.loads(msg.data)
+        except ValueError:
+            continue
+        if entry.get("server_name") == SERVER_NAME:
+            events.append(entry)
+    return events
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def main() -> None:
+    global mediaWiki  # pylint: disable=global-statement
+    parser = argparse.ArgumentParser(description="Replay recent changes through the sentinel against local stubs.")
+    parser.add_argument("--capture", help="EventStreams capture, default: synthetic stream")
+    parser.add_argument("--events", type=int, default=5000, help="number of synthetic events")
+    parser.add_argument("--rate", type=float, default=20.0, help="events per second of the synthetic stream")
+    parser.add_argument("--speedup", type=float, default=0.0, help="replay speed-up, 0: as fast as possible")
+    parser.add_argument("--latency", type=float, default=50.0, help="provider latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="fraction of failing provider requests")
+    parser.add_argument("--wiki-latency", type=float, default=30.0, help="MediaWiki API latency in ms")
+    parser.add_argument("--dnsbl-ratio", type=float, default=0.3, help="fraction of listed addresses")
+    parser.add_argument("--ip-pool", type=int, default=2000, help="number of distinct addresses")
+    parser.add_argument("--workers", type=int, default=4, help="pipeline workers")
+    parser.add_argument("--metrics", help="write the collected metrics to this file")
+    parser.add_argument("--backlog", type=float, default=0, help="seconds of events missed before a restart")
+    parser.add_argument("--prefetch-budget", type=int, default=0, help="provider requests for prefetching, 0: off")
+    parser.add_argument(
+        "--reputation-share", type=float, default=0.0, help="fraction of addresses known to the reputation database"
+    )
+    args = parser.parse_args()
+
+    events = capturedEvents(args.capture) if args.capture else syntheticEvents(args.events, args.ip_pool, args.rate)
+    if not events:
+        print(f"No {SERVER_NAME} events in the capture.")
+        return
+
+    ProviderHandler.latency = args.latency / 1000
+    ProviderHandler.errorRate = args.error_rate
+    providerServer = ThreadingHTTPServer(("127.0.0.1", 0), ProviderHandler)
+    threading.Thread(target=providerServer.serve_forever, daemon=True).start()
+    baseUrl = f"http://127.0.0.1:{providerServer.server_address[1]}"
+    dnsSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dnsSocket.bind(("127.0.0.1", 0))
+    threading.Thread(target=serveDns, args=(dnsSocket, args.dnsbl_ratio), daemon=True).start()
+
+    mediaWiki = StubMediaWiki(args.wiki_latency / 1000, args.ip_pool)
+    site = StubSite()
+    pywikibot.Site = lambda *a, **k: site
+    pywikibot.Page = StubPage
+    pywikibot.User = StubUser
+    api.Request = StubRequest
+
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("cache")
+    # pylint: disable=import-outside-toplevel
+    import sentinel
+    from dnsbl import DnsblChecker
+    from checkpoint import CHECKPOINT_VERSION
+    from quota import QuotaLimiter
+    from reputation import flatten, writeDatabase
+
+    os.environ["PREFETCH_BUDGET"] = str(args.prefetch_budget)
+    if args.backlog:
+        # the sentinel was stopped args.backlog seconds ago
+        with open("cache/stream-checkpoint.json", "w", encoding="utf-8") as f:
+            json.dump({"version": CHECKPOINT_VERSION, "eventId": None, "timestamp": time.time() - args.backlog}, f)
+    if args.reputation_share:
+        known = {ipFor(seed, args.ip_pool) for seed in range(int(args.ip_pool * args.reputation_share))}
+        writeDatabase(
+            "reputation.db", ["replay"], flatten((ipaddress.ip_network(ip), isProxy(ip), 0) for ip in sorted(known))
+        )
+    controller = sentinel.Controller(workers=args.workers)
+    controller.dnsbl = DnsblChecker(nameserver="127.0.0.1", port=dnsSocket.getsockname()[1])
+    vpnCheck = controller.vpnCheck
+    vpnCheck.teohUrl = f"{baseUrl}/teoh/"
+    vpnCheck.iphubUrl = f"{baseUrl}/iphub/ip/"
+    vpnCheck.ipcheckUrl = f"{baseUrl}/ipcheck/index.php"
+    # the stubs have no rate limit
+    for provider in vpnCheck.limiters:
+        vpnCheck.limiters[provider] = QuotaLimiter(f"cache/quota-{provider}.json", provider, None, 1e6, 10**6)
+
+    tiers: "Counter[str]" = Counter()
+    latencies: List[float] = []
+    statsLock = threading.Lock()
+    emitTime = threading.local()
+    originalLookup = vpnCheck.lookup
+
+    def countingLookup(provider: str, ip: str, fetch: Callable[[str], Any]) -> Any:
+        res = originalLookup(provider, ip, fetch)
+        with statsLock:
+            tiers[f"{provider}/{res.tier}"] += 1
+        return res
+
+    vpnCheck.lookup = countingLookup  # type: ignore
+    originalSubmit = controller.pipeline.submit
+
+    def timedSubmit(eventTime: float, func: Callable[..., None], *funcArgs: Any) -> None:
+        emitted = emitTime.value
+
+        @functools.wraps(func)
+        def timedJob(*jobArgs: Any) -> None:
+            try:
+                func(*jobArgs)
+            finally:
+                with statsLock:
+                    latencies.append(time.perf_counter() - emitted)
+
+        originalSubmit(eventTime, timedJob, *funcArgs)
+
+    controller.pipeline.submit = timedSubmit  # type: ignore
+
+    def replay() -> Iterator[Dict[str, Any]]:
+        start = time.perf_counter()
+        wallStart = time.time()
+        firstTimestamp = events[0]["timestamp"]
+        for entry in events:
+            offset = entry["timestamp"] - firstTimestamp
+            if offset < args.backlog:
+                # missed while the sentinel was down, available at once
+                timestamp = int(wallStart - args.backlog + offset)
+            else:
+                if args.speedup:
+                    delay = (offset - args.backlog) / args.speedup - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                timestamp = int(time.time())
+            emitTime.value = time.perf_counter()
+            yield dict(entry, timestamp=timestamp)
+
+    sentinel.rcListener = lambda site, resumeFrom: replay()
+    print(f"Replaying {len(events)} events...")
+    start = time.perf_counter()
+    catchUpTime = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for page in controller.generator:
+            controller.treat(page)
+            if catchUpTime is None and not controller.catchingUp:
+                catchUpTime = time.perf_counter() - start
+        ingestTime = time.perf_counter() - start
+        controller.pipeline.stop()
+        elapsed = time.perf_counter() - start
+        controller.logWriter.stop()
+    signal.alarm(0)
+    controller.blockIndex.save()
+
+    latencies.sort()
+    print(f"Events: {len(events)} in {elapsed:.2f} s ({len(events) / elapsed:.0f} events/s, ingest {ingestTime:.2f} s)")
+    print(
+        f"Decisions: {len(latencies)}, latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, max {percentile(latencies, 1.0) * 1000:.1f} ms"
+    )
+    if args.backlog:
+        print(f"Backlog of {args.backlog:.0f} s caught up after {catchUpTime or 0:.2f} s")
+    print(f"Events dropped by the filter: {controller.eventFilter.dropCounts()}")
+    print(f"Log entries: {controller.pipeline.stats().writtenEntries}, saved to the wiki: {mediaWiki.savedEntries}")
+    for provider in sorted({key.split("/")[0] for key in tiers}):
+        total = sum(count for key, count in tiers.items() if key.startswith(f"{provider}/"))
+        remote = tiers[f"{provider}/remote"]
+        byTier = ", ".join(
+            f"{key.split('/')[1]} {count}" for key, count in sorted(tiers.items()) if key.startswith(f"{provider}/")
+        )
+        print(f"Cache {provider}: hit ratio {(total - remote) / total:.1%} of {total} lookups ({byTier})")
+    templates = controller.vmUserTemplates
+    print(f"VM revisions: {templates.hits} cached, {templates.diffFetches} diffs, {templates.textFetches} full texts")
+    print(f"Provider requests: {dict(ProviderHandler.requests)}, saved by coalescing: {vpnCheck.savedRequests}")
+    for cascade in controller.cascades.values():
+        order = ", ".join(f"{name} {stats.decisions}/{stats.calls}" for name, stats in cascade.providerStats().items())
+        print(f"Cascade {cascade.name} (decisions/checks): {order}")
+    if controller.prefetcher:
+        prefetchStats = controller.prefetcher.stats()
+        print(
+            f"Prefetch: {prefetchStats.prefetched} checked, hit rate {prefetchStats.hitRate:.1%} of "
+            f"{prefetchStats.liveChecks} live checks, {prefetchStats.requestsUsed} provider requests"
+        )
+    print(f"MediaWiki requests: {dict(mediaWiki.requests)}")
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(metrics.REGISTRY.exposition())
+    providerServer.shutdown()
+
+
+if __name__ == "__main__":
+    main()
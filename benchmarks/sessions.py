@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+"""Compare per-lookup latency of one-shot requests.get() calls and pooled provider sessions.
+
+Both cases only request and decode the response, the verdict caches, circuit breakers and rate limiters
+are left out so that the comparison isolates connection reuse. Runs against a local stub HTTP server, so no API keys or network access are needed:
+
+    python benchmarks/sessions.py [lookups]
+"""
+
+from __future__ import unicode_literals
+
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+IPCHECK_RESPONSE = json.dumps(
+    {
+        "teohio": {"result": {"vpnOrProxy": False}},
+        "proxycheck": {"result": {"proxy": False}},
+        "getIPIntel": {"result": {"chance": 0}},
+        "ipQualityScore": {"result": {"proxy": False, "vpn": False}},
+        "cache": {"result": {"cached": "no"}},
+    }
+).encode("utf-8")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(IPCHECK_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(IPCHECK_RESPONSE)
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+def measure(name: str, lookup: Callable[[int], object], lookups: int) -> None:
+    timings: List[float] = []
+    for i in range(lookups):
+        start = time.perf_counter()
+        lookup(i)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(
+        f"{name:>24}: mean {statistics.mean(timings):.3f} ms, "
+        f"p50 {timings[len(timings) // 2]:.3f} ms, p99 {timings[int(len(timings) * 0.99)]:.3f} ms"
+    )
+
+
+def main() -> None:
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    baseUrl = f"http://127.0.0.1:{server.server_address[1]}/index.php"
+
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("cache")
+    from vpncheck import VpnCheck  # pylint: disable=import-outside-toplevel
+
+    vpnCheck = VpnCheck(syncInterval=None)
+    vpnCheck.ipcheckUrl = baseUrl
+
+    measure(
+        "requests.get (before)",
+        lambda i: json.loads(requests.get(f"{baseUrl}?ip=10.0.{i // 256 % 256}.{i % 256}", timeout=10).text),
+        lookups,
+    )
+    # the request of checkWithIpCheck without cache, breaker and limiter
+    measure("pooled session (after)", lambda i: vpnCheck.requestIpCheck(f"10.0.{i // 256 % 256}.{i % 256}"), lookups)
+    vpnCheck.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
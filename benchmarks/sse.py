@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+"""Feed a recorded EventStreams capture through the legacy and the incremental SSE parser.
+
+Record a capture with
+
+    curl -sN https://stream.wikimedia.org/v2/stream/recentchange > recentchange.sse
+
+and run
+
+    python benchmarks/sse.py recentchange.sse [chunk_size]
+
+Without a capture file a synthetic stream with some very large events is used.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import os
+import sys
+import time
+from typing import Any, Iterator, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sseclient import SSEClient, end_of_field_bytes  # pylint: disable=wrong-import-position
+
+
+class ReplayResponse:
+    encoding = "utf-8"
+    raw = None
+
+    def __init__(self, capture: bytes) -> None:
+        self.capture = capture
+
+    def iter_content(self, chunkSize: int) -> Iterator[bytes]:
+        for i in range(0, len(self.capture), chunkSize):
+            yield self.capture[i : i + chunkSize]
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+class ReplaySession:
+    def __init__(self, capture: bytes) -> None:
+        self.capture = capture
+
+    def get(self, url: str, **kwargs: Any) -> ReplayResponse:
+        return ReplayResponse(self.capture)
+
+
+def syntheticCapture() -> bytes:
+    events: List[bytes] = []
+    for i in range(5000):
+        # every 100th event carries a huge comment, like bulk edits with long summaries do
+        data = {"id": i, "type": "edit", "title": f"Seite {i}", "comment": "ä" * (200000 if i % 100 == 0 else 100)}
+        events.append(
+            f'event: message\nid: [{{"offset":{i}}}]\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'.encode("utf-8")
+        )
+    return b"".join(events)
+
+
+def run(name: str, capture: bytes, eventCount: int, chunkSize: int, legacy: bool) -> None:
+    client = SSEClient("replay", session=ReplaySession(capture), chunk_size=chunkSize, legacy_parser=legacy)
+    start = time.perf_counter()
+    for _ in range(eventCount):
+        next(client)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>12}: {eventCount} events in {elapsed:.3f} s ({eventCount / elapsed:.0f} events/s)")
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            capture = f.read()
+        # a capture may end in the middle of an event
+        capture = capture[: capture.rfind(b"\n\n") + 2]
+    else:
+        capture = syntheticCapture()
+    chunkSize = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    eventCount = len(end_of_field_bytes.findall(capture))
+    print(f"{len(capture)} bytes, chunk size {chunkSize}")
+    run("legacy", capture, eventCount, chunkSize, legacy=True)
+    run("incremental", capture, eventCount, chunkSize, legacy=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import pywikibot
+from prefixtrie import PrefixTrie, toNetwork
+
+INDEX_VERSION = 1
+
+INFINITE_DURATIONS = {"infinite", "infinity", "indefinite", "never"}
+durationRegex = re.compile(r"(\d+)\s*(second|minute|hour|day|week|month|year)s?")
+durationUnits = {
+    "second": timedelta(seconds=1),
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+    "month": timedelta(days=30),
+    "year": timedelta(days=365),
+}
+
+
+def parseBlockExpiry(logParams: Dict[str, Any], timestamp: datetime) -> Optional[datetime]:
+    """Return the expiry of a block log entry or None for infinite blocks.
+
+    API results contain the expiry, RC stream events only the duration as entered by the blocking admin."""
+    expiry = logParams.get("expiry")
+    if expiry:
+        return None if expiry in INFINITE_DURATIONS else datetime.strptime(expiry, "%Y-%m-%dT%H:%M:%SZ")
+    duration = logParams.get("duration", "infinity")
+    if duration in INFINITE_DURATIONS:
+        return None
+    for timestampFormat in ("%Y%m%d%H%M%S", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(duration, timestampFormat)
+        except ValueError:
+            pass
+    parts = durationRegex.findall(duration)
+    if not parts:
+        raise ValueError(f"Unknown block duration: {duration}")
+    return timestamp + sum((int(count) * durationUnits[unit] for count, unit in parts), timedelta())
+
+
+@dataclass
+class BlockRecord:
+    # timestamps of "block" actions, oldest first
+    blocks: List[int] = field(default_factory=list)
+    # timestamp of the latest block log entry of any action (block, reblock, unblock)
+    lastEvent: int = 0
+
+
+class BlockIndex:
+    """Local index of the block log entries of IP addresses and ranges.
+
+    The index is seeded once from the block log, kept current with block log events
+    and persisted to disk so that a restart only needs to catch up. ready is set once
+    the seed or catch-up is done, until then lookups should go to the API."""
+
+    def __init__(self, path: str, saveInterval: int = 600) -> None:
+        self.path = path
+        self.saveInterval = saveInterval
+        self.trie: PrefixTrie[BlockRecord] = PrefixTrie()
+        # timestamp of the newest block log entry processed
+        self.lastTimestamp: Optional[datetime] = None
+        self.lastSaveTime = time.monotonic()
+        self.dirty = False
+        self.lock = threading.RLock()
+        # concurrent saves must not write the same temporary file
+        self.saveLock = threading.Lock()
+        self.ready = threading.Event()
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        if data["version"] != INDEX_VERSION:
+            return False
+        with self.lock:
+            self.trie = PrefixTrie()
+            for network, blocks, lastEvent in data["entries"]:
+                self.trie.set(toNetwork(network), BlockRecord(blocks=blocks, lastEvent=lastEvent))
+            self.lastTimestamp = datetime.utcfromtimestamp(data["lastTimestamp"]) if data["lastTimestamp"] else None
+        return True
+
+    def save(self) -> None:
+        with self.saveLock:
+            with self.lock:
+                data = {
+                    "version": INDEX_VERSION,
+                    "lastTimestamp": int(calendarTimestamp(self.lastTimestamp)) if self.lastTimestamp else 0,
+                    "entries": [[str(network), rec.blocks, rec.lastEvent] for network, rec in self.trie.items()],
+                }
+                self.dirty = False
+                self.lastSaveTime = time.monotonic()
+            tmpPath = f"{self.path}.tmp"
+            with open(tmpPath, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmpPath, self.path)
+
+    def saveIfDue(self) -> None:
+        if self.dirty and time.monotonic() - self.lastSaveTime >= self.saveInterval:
+            self.save()
+
+    def addEvent(self, target: str, action: str, timestamp: datetime, fromLog: bool = False) -> None:
+        """Record a block log entry for the IP address or range target, other targets are ignored.
+
+        Entries from elsewhere than the block log do not move the resume point before the index is ready,
+        an interrupted seed would skip the entries in between otherwise."""
+        try:
+            network = toNetwork(target)
+        except ValueError:
+            return
+        ts = int(calendarTimestamp(timestamp))
+        with self.lock:
+            rec = self.trie.get(network)
+            if rec is None:
+                rec = BlockRecord()
+                self.trie.set(network, rec)
+            if action == "block" and ts not in rec.blocks:
+                rec.blocks.append(ts)
+                rec.blocks.sort()
+            rec.lastEvent = max(rec.lastEvent, ts)
+            if (fromLog or self.ready.is_set()) and (not self.lastTimestamp or timestamp > self.lastTimestamp):
+                self.lastTimestamp = timestamp
+            self.dirty = True
+
+    def addLogEvent(self, event: Any) -> None:
+        """Record a pywikibot block log entry."""
+        self.addEvent(event.page().title(with_ns=False), event.action(), event.timestamp(), fromLog=True)
+
+    def update(self, site: pywikibot.site.APISite) -> None:
+        """Seed the index from the whole block log or catch up from the newest known entry.
+
+        Progress is saved periodically, an interrupted seed resumes from the newest saved entry.
+        Sets ready when done."""
+        for event in site.logevents(logtype="block", reverse=True, start=self.lastTimestamp):
+            if "actionhidden" in event.data:
+                continue
+            self.addLogEvent(event)
+            self.saveIfDue()
+        self.save()
+        self.ready.set()
+
+    def startUpdate(self, site: pywikibot.site.APISite) -> threading.Thread:
+        """Run update in a background thread."""
+        thread = threading.Thread(target=self.updateInBackground, args=(site,), name="block-index", daemon=True)
+        thread.start()
+        return thread
+
+    def updateInBackground(self, site: pywikibot.site.APISite) -> None:
+        try:
+            self.update(site)
+        except Exception as ex:  # pylint: disable=broad-except
+            pywikibot.error(f"Updating the block index failed, block log lookups stay with the API: {ex}")
+
+    def lastBlockTimestamps(self, ip: str) -> List[datetime]:
+        """Timestamps of the blocks of a single IP address, newest first."""
+        with self.lock:
+            rec = self.trie.get(toNetwork(ip))
+            blocks = list(rec.blocks) if rec else []
+        return [datetime.utcfromtimestamp(ts) for ts in reversed(blocks)]
+
+    def enclosingBlockedRanges(self, ip: str, minPrefixLen: int, maxPrefixLen: int) -> List[Tuple[str, int]]:
+        """Ranges containing ip with block log entries and the year of their latest entry, smallest range first."""
+        with self.lock:
+            ranges = [
+                (str(network), datetime.utcfromtimestamp(rec.lastEvent).year)
+                for network, rec in self.trie.enclosing(toNetwork(ip), minPrefixLen, maxPrefixLen)
+            ]
+        ranges.reverse()
+        return ranges
+
+
+def calendarTimestamp(ts: datetime) -> float:
+    """POSIX timestamp of a naive UTC datetime."""
+    return (ts - datetime(1970, 1, 1)).total_seconds()
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Sequence
+
+import metrics
+from dnsbl import DnsblChecker, DnsblException
+from prefixtrie import PrefixTrie, toNetwork
+from reputation import ReputationDb
+from vpncheck import PROVIDER_LIMITS, PROXY_SCORE, CheckException, CheckResult, QuotaExceededException, VpnCheck
+
+# cascade modes
+# proxy if every provider with a verdict says so, evaluation stops at the first negative verdict
+ALL = "all"
+# proxy if one provider says so, evaluation stops at the first positive verdict
+ANY = "any"
+
+# latency (seconds) assumed for a provider before it has been observed
+INITIAL_LATENCIES = {"teoh": 0.5, "iphub": 0.3, "ipcheck": 2.0}
+# cost of a request against a daily quota, in seconds of latency
+QUOTA_REQUEST_COST = 1.0
+
+
+class Provider(ABC):
+    """A source of VPN/proxy verdicts.
+
+    check returns None if the provider has no opinion on the address and raises CheckException if it
+    could not be asked."""
+
+    def __init__(self, name: str, initialLatency: float = 0.0, quotaCost: float = 0.0, remote: bool = False) -> None:
+        self.name = name
+        self.initialLatency = initialLatency
+        # cost of a request which is not served from a cache
+        self.quotaCost = quotaCost
+        # whether check may make a provider request
+        self.remote = remote
+
+    @abstractmethod
+    def check(self, ip: str) -> Optional[CheckResult]:
+        pass
+
+
+class VpnCheckProvider(Provider):
+    """One of the remote providers of VpnCheck, including its caches."""
+
+    def __init__(self, vpnCheck: VpnCheck, name: str) -> None:
+        limits = PROVIDER_LIMITS[name]
+        super().__init__(
+            name, INITIAL_LATENCIES.get(name, 1.0), QUOTA_REQUEST_COST if limits.get("dailyQuota") else 0.0, True
+        )
+        self.checkFunction = {
+            "teoh": vpnCheck.checkWithTeoh,
+            "iphub": vpnCheck.checkWithIphub,
+            "ipcheck": vpnCheck.checkWithIpCheck,
+        }[name]
+
+    def check(self, ip: str) -> Optional[CheckResult]:
+        return self.checkFunction(ip)
+
+
+class DnsblProvider(Provider):
+    """Addresses listed in a DNSBL zone are proxies, unlisted ones are not judged."""
+
+    def __init__(self, dnsbl: DnsblChecker, zoneName: str, score: int = PROXY_SCORE) -> None:
+        super().__init__(f"dnsbl-{zoneName}", initialLatency=0.05)
+        self.dnsbl = dnsbl
+        self.zoneName = zoneName
+        self.score = score
+
+    def check(self, ip: str) -> Optional[CheckResult]:
+        try:
+            listed = self.dnsbl.isListed(ip, self.zoneName)
+        except DnsblException as ex:
+            raise CheckException(f"{self.name} check failed: {ex}")
+        return CheckResult(score=self.score, cached=True, tier="dnsbl") if listed else None
+
+
+class LocalListProvider(Provider):
+    """Final verdicts for networks listed locally, e.g. known proxy ranges or misjudged ISPs.
+
+    Addresses outside the listed networks are looked up in the offline reputation database, if given,
+    so that the list can correct it."""
+
+    def __init__(self, name: str, verdicts: Dict[str, bool], reputation: Optional[ReputationDb] = None) -> None:
+        super().__init__(name)
+        self.trie: PrefixTrie[bool] = PrefixTrie()
+        for network, proxy in verdicts.items():
+            self.trie.set(toNetwork(network), proxy)
+        self.reputation = reputation
+
+    def check(self, ip: str) -> Optional[CheckResult]:
+        enclosing = list(self.trie.enclosing(toNetwork(ip)))
+        if not enclosing:
+            known = self.reputation.lookup(ip) if self.reputation else None
+            if known is None:
+                return None
+            return CheckResult(score=PROXY_SCORE if known.proxy else 0, cached=True, tier="reputation", final=True)
+        # the most specific network wins
+        proxy = enclosing[-1][1]
+        return CheckResult(score=PROXY_SCORE if proxy else 0, cached=True, tier="local", final=True)
+
+
+def loadLocalList(path: str) -> Dict[str, bool]:
+    """Read "<network> proxy|clean" lines, # starts a comment. A missing file is an empty list."""
+    verdicts: Dict[str, bool] = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for lineNo, line in enumerate(f, 1):
+                fields = line.split("#", 1)[0].split()
+                if not fields:
+                    continue
+                if len(fields) != 2 or fields[1] not in ("proxy", "clean"):
+                    raise ValueError(f"{path}:{lineNo}: expected <network> proxy|clean")
+                verdicts[fields[0]] = fields[1] == "proxy"
+    except FileNotFoundError:
+        pass
+    return verdicts
+
+
+@dataclass
+class ProviderStats:
+    calls: int = 0
+    proxies: int = 0
+    clean: int = 0
+    abstentions: int = 0
+    errors: int = 0
+    # final verdicts and verdicts which ended the evaluation
+    decisions: int = 0
+    # moving averages of the latency and of the share of calls which were not served from a cache
+    latency: float = 0.0
+    remoteRate: float = 0.0
+
+
+class Cascade:
+    """Evaluates providers one after another until the verdict is decided.
+
+    The providers are ordered by expected cost per decision: the observed latency plus the quota cost of
+    uncached requests, divided by the observed probability that the provider ends the evaluation. The
+    order adapts as the statistics change, ties keep the configured order."""
+
+    def __init__(self, name: str, providers: Sequence[Provider], mode: str = ALL, smoothing: float = 0.05) -> None:
+        if mode not in (ALL, ANY):
+            raise ValueError(f"Unknown cascade mode: {mode}")
+        self.name = name
+        self.providers = list(providers)
+        self.mode = mode
+        # weight of a new observation in the moving averages
+        self.smoothing = smoothing
+        self.stats = {
+            provider.name: ProviderStats(latency=provider.initialLatency, remoteRate=1.0) for provider in providers
+        }
+        self.lock = threading.Lock()
+
+    def maxRequests(self) -> int:
+        """Provider requests a check makes at most, not counting retries."""
+        return sum(1 for provider in self.providers if provider.remote)
+
+    def expectedCost(self, provider: Provider) -> float:
+        stats = self.stats[provider.name]
+        cost = stats.latency + provider.quotaCost * stats.remoteRate
+        # Laplace smoothed, unobserved providers are assumed to decide half of the time
+        decisionRate = (stats.decisions + 1) / (stats.calls + 2)
+        return cost / decisionRate
+
+    def order(self) -> List[Provider]:
+        with self.lock:
+            return sorted(self.providers, key=self.expectedCost)
+
+    def decides(self, result: CheckResult) -> bool:
+        return result.final or result.isProxy == (self.mode == ANY)
+
+    def record(self, provider: Provider, result: Optional[CheckResult], error: bool, elapsed: float) -> None:
+        if error:
+            outcome = "error"
+        elif result is None:
+            outcome = "abstain"
+        else:
+            outcome = "proxy" if result.isProxy else "clean"
+        metrics.cascadeChecks.inc(self.name, provider.name, outcome)
+        with self.lock:
+            stats = self.stats[provider.name]
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            elif result is None:
+                stats.abstentions += 1
+            elif result.isProxy:
+                stats.proxies += 1
+            else:
+                stats.clean += 1
+            if result and self.decides(result):
+                stats.decisions += 1
+            remote = 1.0 if result and result.tier == "remote" else 0.0
+            stats.latency += self.smoothing * (elapsed - stats.latency)
+            stats.remoteRate += self.smoothing * (remote - stats.remoteRate)
+
+    def check(self, ip: str) -> CheckResult:
+        """Return the verdict of the first provider which decides it.
+
+        If none decides, the weakest positive (ALL) or strongest negative (ANY) verdict is returned. If
+        the verdict could not be decided because providers failed, the last error is raised. An exhausted
+        quota is raised immediately, the other providers are not meant to stand in for the provider."""
+        verdicts: List[CheckResult] = []
+        lastError: Optional[CheckException] = None
+        for provider in self.order():
+            start = time.perf_counter()
+            try:
+                result = provider.check(ip)
+            except QuotaExceededException:
+                self.record(provider, None, True, time.perf_counter() - start)
+                raise
+            except CheckException as ex:
+                self.record(provider, None, True, time.perf_counter() - start)
+                lastError = ex
+                continue
+            self.record(provider, result, False, time.perf_counter() - start)
+            if result is None:
+                continue
+            if self.decides(result):
+                metrics.cascadeDecisions.inc(self.name, provider.name)
+                return result
+            verdicts.append(result)
+        if lastError:
+            raise lastError
+        if not verdicts:
+            # nobody has an opinion
+            return CheckResult(score=0, cached=True, tier="local")
+        if self.mode == ALL:
+            return min(verdicts, key=lambda verdict: verdict.score)
+        return max(verdicts, key=lambda verdict: verdict.score)
+
+    def providerStats(self) -> Dict[str, ProviderStats]:
+        """Statistics per provider, in the current evaluation order."""
+        order = self.order()
+        with self.lock:
+            return {provider.name: replace(self.stats[provider.name]) for provider in order}
+
+
+def createCascades(vpnCheck: VpnCheck, localProviders: Sequence[Provider] = ()) -> Dict[str, Cascade]:
+    """The cascades for reverted IPs ("rollback") and for reported and blocked IPs ("report").
+
+    Reverted IPs need the agreement of IPHub and ipcheck, the others are judged by ipcheck alone."""
+    return {
+        "rollback": Cascade(
+            "rollback", [*localProviders, VpnCheckProvider(vpnCheck, "iphub"), VpnCheckProvider(vpnCheck, "ipcheck")]
+        ),
+        "report": Cascade("report", [*localProviders, VpnCheckProvider(vpnCheck, "ipcheck")]),
+    }
@@ -6,23 +6,175 @@
 
 from __future__ import unicode_literals
 
+import ipaddress
+import json
 import locale
+import os
 import re
+import time
 from datetime import datetime, timedelta
-from typing import Any, Set
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, cast
 
 import pytz
 
 import pywikibot
-from vpncheck import VpnCheck, CheckException, QuotaExceededException
+from blockindex import calendarTimestamp, parseBlockExpiry
+from cascade import LocalListProvider, createCascades, loadLocalList
+from dnsbl import DnsblChecker
+from prefixtrie import PrefixTrie, toNetwork
+from quota import BATCH
+from reputation import ReputationDb
+from vpncheck import PROXY_SCORE, VpnCheck, CheckResult, QuotaExceededException
+
+CONCURRENCY = 8  # parallel lookups per provider
+STATE_VERSION = 2
+WINDOW = timedelta(hours=24)
+SHORT_BLOCK_DURATION = timedelta(days=7)
+
+newUserReportComment = re.compile(r"Neuer Abschnitt /\* Benutzer:(.*) \*/")
+rollbackRegex = re.compile(r"Änderungen von \[\[(?:Special:Contributions|Spezial:Beiträge)/([^|]+)\|.+")
+undoRegex = re.compile(r"Änderung [0-9]+ von \[\[Special:Contribs/([^|]+)\|.+")
+
+
+def parseTimestamp(ts: str) -> int:
+    return int(calendarTimestamp(datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ")))
+
+
+class Aggregates:
+    """Per-IP aggregates of the recent changes in the report window, built in a single pass.
+
+    Changes can be added in any order. In incremental mode the aggregates, the continuation point
+    and the scores of already checked addresses are persisted between runs."""
+
+    def __init__(self, site: pywikibot.site.APISite) -> None:
+        self.site = site
+        # ip -> timestamps of the reverts of its edits
+        self.reverts: Dict[str, List[int]] = {}
+        # ip -> timestamp of the latest new section about it on the vandalism noticeboard
+        self.reports: Dict[str, int] = {}
+        # ip -> [timestamp, expiry] of its blocks which are not infinite
+        self.blocks: Dict[str, List[Tuple[int, int]]] = {}
+        # cascade -> ip -> score of the addresses which have already been checked
+        self.scores: Dict[str, Dict[str, int]] = {"rollback": {}, "report": {}}
+        # timestamp of the newest change processed and the ids of all changes with that timestamp
+        self.lastTimestamp = 0
+        self.lastRcIds: List[int] = []
+
+    def load(self, path: str) -> bool:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        if data["version"] != STATE_VERSION:
+            return False
+        self.reverts = data["reverts"]
+        self.reports = data["reports"]
+        self.blocks = {ip: [(ts, expiry) for ts, expiry in blocks] for ip, blocks in data["blocks"].items()}
+        self.scores = data["scores"]
+        self.lastTimestamp = data["lastTimestamp"]
+        self.lastRcIds = data["lastRcIds"]
+        return True
+
+    def save(self, path: str) -> None:
+        data = {
+            "version": STATE_VERSION,
+            "reverts": self.reverts,
+            "reports": self.reports,
+            "blocks": self.blocks,
+            "scores": self.scores,
+            "lastTimestamp": self.lastTimestamp,
+            "lastRcIds": self.lastRcIds,
+        }
+        tmpPath = f"{path}.tmp"
+        with open(tmpPath, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmpPath, path)
+
+    def isAnonymous(self, username: str) -> bool:
+        return cast(bool, pywikibot.User(self.site, username).isAnonymous())
+
+    def add(self, ch: Dict[str, Any]) -> None:
+        timestamp = parseTimestamp(ch["timestamp"])
+        if ch["type"] == "edit":
+            if "commenthidden" in ch:
+                return
+            comment = ch["comment"]
+            revertedUser = None
+            if "mw-rollback" in ch["tags"]:
+                searchRes = rollbackRegex.search(comment)
+                if searchRes:
+                    revertedUser = searchRes.group(1)
+            elif "mw-undo" in ch["tags"]:
+                searchRes = undoRegex.search(comment)
+                if searchRes:
+                    revertedUser = searchRes.group(1)
+            if revertedUser and self.isAnonymous(revertedUser):
+                self.reverts.setdefault(revertedUser, []).append(timestamp)
+            if ch["title"] == "Wikipedia:Vandalismusmeldung":
+                matchRes = newUserReportComment.match(comment)
+                if matchRes and self.isAnonymous(matchRes.group(1)):
+                    reportedUser = matchRes.group(1)
+                    self.reports[reportedUser] = max(self.reports.get(reportedUser, 0), timestamp)
+        elif (
+            ch["type"] == "log" and not "actionhidden" in ch and ch["logtype"] == "block" and ch["logaction"] == "block"
+        ):
+            expiry = parseBlockExpiry(ch["logparams"], datetime.strptime(ch["timestamp"], "%Y-%m-%dT%H:%M:%SZ"))
+            pyUser = pywikibot.User(self.site, ch["title"])
+            if expiry and pyUser.isAnonymous():
+                self.blocks.setdefault(pyUser.username, []).append((timestamp, int(calendarTimestamp(expiry))))
+
+    def update(self, windowStart: datetime) -> int:
+        """Add the changes since the last update, return their number."""
+        start = max(int(calendarTimestamp(windowStart)), self.lastTimestamp)
+        count = 0
+        for ch in self.site.recentchanges(start=datetime.utcfromtimestamp(start), reverse=True):
+            timestamp = parseTimestamp(ch["timestamp"])
+            if timestamp == self.lastTimestamp and ch["rcid"] in self.lastRcIds:
+                continue
+            self.add(ch)
+            count += 1
+            if timestamp > self.lastTimestamp:
+                self.lastTimestamp = timestamp
+                self.lastRcIds = []
+            self.lastRcIds.append(ch["rcid"])
+        return count
+
+    def prune(self, windowStart: datetime) -> None:
+        """Drop the changes before windowStart and the scores of addresses without remaining changes."""
+        start = int(calendarTimestamp(windowStart))
+        self.reverts = {ip: [ts for ts in tss if ts >= start] for ip, tss in self.reverts.items()}
+        self.reverts = {ip: tss for ip, tss in self.reverts.items() if tss}
+        self.reports = {ip: ts for ip, ts in self.reports.items() if ts >= start}
+        self.blocks = {ip: [b for b in blocks if b[0] >= start] for ip, blocks in self.blocks.items()}
+        self.blocks = {ip: blocks for ip, blocks in self.blocks.items() if blocks}
+        ips = set(self.reverts).union(self.reports, self.blocks)
+        for cascade, scores in self.scores.items():
+            self.scores[cascade] = {ip: score for ip, score in scores.items() if ip in ips}
+
+    def shortlyBlockedIps(self, cutoff: datetime) -> Set[str]:
+        """Addresses with a block in the window expiring before cutoff."""
+        ts = calendarTimestamp(cutoff)
+        return {ip for ip, blocks in self.blocks.items() if any(expiry < ts for _, expiry in blocks)}
 
 
 class Program:
-    def __init__(self) -> None:
+    def __init__(self, statePath: Optional[str] = None) -> None:
         self.site = pywikibot.Site()
         self.site.login()
         self.timezone = pytz.timezone("Europe/Berlin")
-        self.vpnCheck = VpnCheck()
+        # a single run, the caches are synced when it is done
+        self.vpnCheck = VpnCheck(priority=BATCH, syncInterval=None)
+        self.dnsbl = DnsblChecker()
+        self.cascades = createCascades(
+            self.vpnCheck,
+            [LocalListProvider("local", loadLocalList("local-verdicts.txt"), ReputationDb("reputation.db"))],
+        )
+        self.apiCalls = 0
+        self.statePath = statePath
+        self.aggregates = Aggregates(self.site)
+        if statePath and self.aggregates.load(statePath):
+            print(f"Resuming from {datetime.utcfromtimestamp(self.aggregates.lastTimestamp)}.")
 
     def getAllIps(self, recentChanges: Any) -> Set[str]:
         ips: Set[str] = set()
@@ -33,113 +185,137 @@ class Program:
                 ips.add(ch["user"])
         return ips
 
-    def listIPs(self) -> None:
-        print("Retrieving recent changes...")
-        startTime = datetime.utcnow() - timedelta(hours=24)
-        endTime = datetime.utcnow()
-        recentChanges = list(self.site.recentchanges(end=startTime, start=endTime))  # reverse order
-        #        ips = self.getAllIps(recentChanges)
-
-        reportedIps = set()
-        ipToRevertCount = {}
-        ipToEditCount = {}
-        shortlyBlockedIps = set()
-        newUserReportComment = re.compile(r"Neuer Abschnitt /\* Benutzer:(.*) \*/")
-        rollbackRegex = re.compile(r"Änderungen von \[\[(?:Special:Contributions|Spezial:Beiträge)/([^|]+)\|.+")
-        undoRegex = re.compile(r"Änderung [0-9]+ von \[\[Special:Contribs/([^|]+)\|.+")
-        for ch in recentChanges:
-            if (ch["type"] == "edit" or ch["type"] == "new") and "anon" in ch:
-                if ch["user"] not in ipToEditCount:
-                    ipToEditCount[ch["user"]] = 1
-                else:
-                    ipToEditCount[ch["user"]] += 1
-            if ch["type"] == "edit":
-                if "commenthidden" in ch:
-                    continue
-                comment = ch["comment"]
-                rollbackedUser = None
-                if "mw-rollback" in ch["tags"]:
-                    searchRes = rollbackRegex.search(comment)
-                    if searchRes:
-                        rollbackedUser = searchRes.group(1)
-                elif "mw-undo" in ch["tags"]:
-                    searchRes = undoRegex.search(comment)
-                    if searchRes:
-                        rollbackedUser = searchRes.group(1)
-                if rollbackedUser:
-                    pyUser = pywikibot.User(self.site, rollbackedUser)
-                    if pyUser.isAnonymous() and not pyUser.isBlocked():
-                        if not rollbackedUser in ipToRevertCount:
-                            ipToRevertCount[rollbackedUser] = 1
-                        else:
-                            ipToRevertCount[rollbackedUser] += 1
-                if ch["title"] == "Wikipedia:Vandalismusmeldung":
-                    matchRes = newUserReportComment.match(comment)
-                    if matchRes:
-                        reportedUser = matchRes.group(1)
-                        pyUser = pywikibot.User(self.site, reportedUser)
-                        if pyUser.isAnonymous():
-                            reportedIps.add(reportedUser)
-            elif (
-                ch["type"] == "log"
-                and not "actionhidden" in ch
-                and ch["logtype"] == "block"
-                and ch["logaction"] == "block"
-            ):
-                cutoff = datetime.utcnow() + timedelta(days=7)
-                if ch["logparams"]["duration"] != "infinity":
-                    expiry = datetime.strptime(ch["logparams"]["expiry"], "%Y-%m-%dT%H:%M:%SZ")
-                    if expiry < cutoff:
-                        pyUser = pywikibot.User(self.site, ch["title"])
-                        if pyUser.isAnonymous():
-                            shortlyBlockedIps.add(pyUser.username)
+    def getBlockedIps(self, ips: Iterable[str]) -> Set[str]:
+        """Return those ips which are currently blocked, querying the blocks of many addresses at once.
 
+        list=blocks only returns the blocks of the exact addresses queried, so the active range blocks are
+        fetched as well and matched locally, like isBlocked() which takes range blocks into account."""
+        normalizedToIp = {ipaddress.ip_address(ip).compressed: ip for ip in ips}
+        normalizedIps = sorted(normalizedToIp)
+        highLimits = self.site.has_right("apihighlimits")
+        batchSize = 500 if highLimits else 50
+        blockedIps = set()
+        for i in range(0, len(normalizedIps), batchSize):
+            self.apiCalls += 1
+            for block in self.site.blocks(users=normalizedIps[i : i + batchSize]):
+                normalized = ipaddress.ip_address(block["user"]).compressed
+                if normalized in normalizedToIp:
+                    blockedIps.add(normalizedToIp[normalized])
+        rangeBlocks: PrefixTrie[bool] = PrefixTrie()
+        pageSize = 5000 if highLimits else 500
+        rangeBlockCount = 0
+        for block in self.site.blocks(ip_range=True):
+            rangeBlocks.set(toNetwork(block["user"]), True)
+            rangeBlockCount += 1
+        self.apiCalls += rangeBlockCount // pageSize + 1
+        for normalized, ip in normalizedToIp.items():
+            if ip not in blockedIps and next(rangeBlocks.enclosing(toNetwork(normalized)), None):
+                blockedIps.add(ip)
+        return blockedIps
+
+    def checkScores(self, ips: Iterable[str], cascade: str) -> int:
+        """Check the ips which have not been scored by an earlier run, return the number of uncached lookups."""
+        scores = self.aggregates.scores[cascade]
         uncached = 0
-        print(f"Checking {len(ipToRevertCount.keys())} addresses with IPHub...")
-        for ip in ipToRevertCount:
-            try:
-                checkRes = self.vpnCheck.checkWithIphub(ip)
-                if not checkRes.cached:
-                    uncached += 1
-                if checkRes.score >= 2:
-                    checkRes = self.vpnCheck.checkWithIpCheck(ip)
-            except QuotaExceededException as ex:
-                print(f"Quota exceeded, aborting.")
-                break
-            except CheckException as ex:
-                print(f"{ip} could not be checked: {ex}")
-            else:
-                if checkRes.score >= 2:
-                    print(f"Likely VPN or proxy: {ip}, score: {checkRes.score}")
+        check = self.cascades[cascade].check
+        for batchRes in self.vpnCheck.checkMany([ip for ip in ips if ip not in scores], check, CONCURRENCY):
+            if batchRes.error:
+                print(f"{batchRes.ip} could not be checked: {batchRes.error}")
+                continue
+            checkRes = cast(CheckResult, batchRes.result)
+            if not checkRes.cached:
+                uncached += 1
+            scores[batchRes.ip] = checkRes.score
+        return uncached
+
+    def printLikelyProxies(self, ips: Iterable[str], cascade: str) -> None:
+        scores = self.aggregates.scores[cascade]
+        for ip in sorted(ips):
+            if scores.get(ip, 0) >= PROXY_SCORE:
+                print(f"Likely VPN or proxy: {ip}, score: {scores[ip]}")
+
+    def listIPs(self, recentChanges: Optional[List[Dict[str, Any]]] = None) -> None:
+        listStartTime = time.monotonic()
+        if recentChanges is None:
+            print("Retrieving recent changes...")
+            now = datetime.utcnow()
+            processed = self.aggregates.update(now - WINDOW)
+            self.aggregates.prune(now - WINDOW)
+            print(f"Processed {processed} new changes.")
+        else:
+            now = datetime.utcnow()
+            for ch in recentChanges:
+                self.aggregates.add(ch)
+
+        revertedIps = set(self.aggregates.reverts)
+        blockCheckStartTime = time.monotonic()
+        blockedIps = self.getBlockedIps(revertedIps)
+        print(
+            f"Block status of {len(revertedIps)} reverted ips: "
+            f"{self.apiCalls} API calls, {time.monotonic() - blockCheckStartTime:.2f} s"
+        )
+        revertedIps -= blockedIps
+
+        uncached = 0
+        print(f"Checking {len(revertedIps)} reverted addresses...")
+        try:
+            uncached = self.checkScores(revertedIps, "rollback")
+        except QuotaExceededException:
+            print(f"Quota exceeded, aborting.")
+        self.printLikelyProxies(revertedIps, "rollback")
         print(f"Uncached: {uncached}")
 
+        shortlyBlockedIps = self.aggregates.shortlyBlockedIps(now + SHORT_BLOCK_DURATION)
+        reportedIps = set(self.aggregates.reports)
         print(f"Blocked ips: {len(shortlyBlockedIps)}")
-        ips = set(shortlyBlockedIps).union(reportedIps)
+        ips = shortlyBlockedIps.union(reportedIps)
         print(f"Reported ips: {len(reportedIps)}")
         print(f"Reported but not blocked ips: {len(ips) - len(shortlyBlockedIps)}")
+        dynamicIps = self.dnsbl.lookupMany(ips, "dul")
+        print(f"Dynamic ips: {sum(dynamicIps.values())}")
         print(f"Checking {len(ips)} addresses...")
 
         uncached = 0
-        # ips = ["103.224.240.72"]
-        for ip in ips:
-            try:
-                checkRes = self.vpnCheck.checkWithIpCheck(ip)
-            except CheckException as ex:
-                print(f"{ip} could not be checked: {ex}")
-            else:
-                if checkRes.score >= 2:
-                    print(f"Likely VPN or proxy: {ip}, score: {checkRes.score}")
-                if not checkRes.cached:
-                    uncached += 1
+        try:
+            uncached = self.checkScores(ips, "report")
+        except QuotaExceededException:
+            print(f"Quota exceeded, aborting.")
+        self.printLikelyProxies(ips, "report")
 
         print(f"Uncached: {uncached}")
+        print(f"Requests saved by coalescing lookups: {self.vpnCheck.savedRequests}")
+        for cascade in self.cascades.values():
+            for provider, stats in cascade.providerStats().items():
+                print(f"Cascade {cascade.name}, {provider}: {stats.calls} checks, {stats.decisions} decisions")
+        print(f"Total time: {time.monotonic() - listStartTime:.2f} s")
+        if self.statePath:
+            self.aggregates.save(self.statePath)
 
 
 def main() -> None:
     locale.setlocale(locale.LC_ALL, "de_DE.utf8")
-    pywikibot.handle_args()
+    recentChanges = None
+    statePath = None
+    for arg in pywikibot.handle_args():
+        if arg == "-incremental":
+            # only process the changes since the last run, aggregates are kept in the state file
+            statePath = "cache/check-ips-state.json"
+        elif arg.startswith("-rcfixture:"):
+            # recent changes recorded with -saverc, for comparing runs on the same data
+            with open(arg[len("-rcfixture:") :], "r", encoding="utf-8") as f:
+                recentChanges = json.load(f)
+        elif arg.startswith("-saverc:"):
+            site = pywikibot.Site()
+            endTime = datetime.utcnow()
+            with open(arg[len("-saverc:") :], "w", encoding="utf-8") as f:
+                json.dump(list(site.recentchanges(end=endTime - timedelta(hours=24), start=endTime)), f)
+            return
     # res = VpnCheck().checkWithIphub("81.92.17.129")
-    Program().listIPs()
+    program = Program(statePath)
+    try:
+        program.listIPs(recentChanges)
+    finally:
+        program.vpnCheck.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Callable, Deque, Optional
+
+CHECKPOINT_VERSION = 1
+
+
+@dataclass
+class StreamPosition:
+    # id of the EventStreams event (Last-Event-ID), None if the stream does not provide ids
+    eventId: Optional[str]
+    # timestamp of the event (seconds since the epoch)
+    timestamp: float
+
+
+class StreamCheckpoint:
+    """Position in the event stream up to which all events have been handled, saved periodically.
+
+    Events are handled when the stream thread is done with them, but their jobs may still be queued or
+    running. The saved position is therefore held back to the last event before the oldest pending job,
+    so that a restart resumes from there and no event gets lost."""
+
+    def __init__(
+        self,
+        path: str,
+        oldestPendingTime: Callable[[], Optional[float]],
+        saveInterval: float = 30,
+        maxTracked: int = 100000,
+    ) -> None:
+        self.path = path
+        self.oldestPendingTime = oldestPendingTime
+        self.saveInterval = saveInterval
+        # positions of the handled events which may still have pending jobs, oldest first
+        self.positions: Deque[StreamPosition] = deque(maxlen=maxTracked)
+        self.saved: Optional[StreamPosition] = None
+        self.lastSaveTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def load(self) -> Optional[StreamPosition]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data.get("version") != CHECKPOINT_VERSION:
+            return None
+        self.saved = StreamPosition(eventId=data["eventId"], timestamp=data["timestamp"])
+        return self.saved
+
+    def advance(self, eventId: Optional[str], timestamp: float) -> None:
+        """Record that the stream thread is done with an event."""
+        with self.lock:
+            self.positions.append(StreamPosition(eventId=eventId, timestamp=timestamp))
+
+    def safePosition(self) -> Optional[StreamPosition]:
+        """The newest position before which no job is pending, older positions are forgotten."""
+        oldestPending = self.oldestPendingTime()
+        with self.lock:
+            safe = None
+            while self.positions and (oldestPending is None or self.positions[0].timestamp < oldestPending):
+                safe = self.positions.popleft()
+            if safe:
+                # kept as the fallback while the newer events still have pending jobs
+                self.positions.appendleft(safe)
+            return safe
+
+    def save(self) -> None:
+        position = self.safePosition()
+        self.lastSaveTime = time.monotonic()
+        if position is None or position == self.saved:
+            return
+        tmpPath = f"{self.path}.tmp"
+        with open(tmpPath, "w", encoding="utf-8") as f:
+            json.dump({"version": CHECKPOINT_VERSION, **asdict(position)}, f)
+        os.replace(tmpPath, self.path)
+        self.saved = position
+
+    def saveIfDue(self) -> None:
+        if time.monotonic() - self.lastSaveTime >= self.saveInterval:
+            self.save()
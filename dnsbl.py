@@ -0,0 +1,209 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import errno
+import ipaddress
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pywikibot
+
+DNS_TYPE_A = 1
+DNS_TYPE_SOA = 6
+DNS_CLASS_IN = 1
+DNS_RCODE_NXDOMAIN = 3
+
+dnsHeader = struct.Struct("!HHHHHH")
+dnsRecordFixed = struct.Struct("!HHIH")
+
+
+class DnsblException(Exception):
+    pass
+
+
+@dataclass
+class DnsblZone:
+    name: str
+    zone: str
+    # whether the zone lists IPv6 addresses (nibble format)
+    ipv6: bool = False
+
+
+SORBS_DUL = DnsblZone(name="dul", zone="dul.dnsbl.sorbs.net")
+
+
+def getSystemNameserver() -> Optional[str]:
+    try:
+        with open("/etc/resolv.conf", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    return fields[1]
+    except OSError:
+        pass
+    return None
+
+
+def reverseName(ip: str, zone: str) -> str:
+    addr = ipaddress.ip_address(ip)
+    if isinstance(addr, ipaddress.IPv4Address):
+        labels = str(addr).split(".")
+    else:
+        labels = list(addr.exploded.replace(":", ""))
+    labels.reverse()
+    return f"{'.'.join(labels)}.{zone}"
+
+
+def skipName(packet: bytes, offset: int) -> int:
+    while True:
+        length = packet[offset]
+        if length & 0xC0 == 0xC0:
+            # compression pointer, ends the name
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def buildQuery(queryId: int, name: str) -> bytes:
+    question = b"".join(bytes([len(label)]) + label.encode("ascii") for label in name.split(".")) + b"\0"
+    return dnsHeader.pack(queryId, 0x0100, 1, 0, 0, 0) + question + struct.pack("!HH", DNS_TYPE_A, DNS_CLASS_IN)
+
+
+def parseResponse(packet: bytes, queryId: int) -> Tuple[bool, Optional[int]]:
+    """Return whether the name exists and the TTL of the answer or of the negative answer if known."""
+    responseId, flags, qdCount, anCount, nsCount, _ = dnsHeader.unpack_from(packet)
+    if responseId != queryId:
+        raise DnsblException("DNS response id mismatch")
+    rcode = flags & 0xF
+    if rcode not in (0, DNS_RCODE_NXDOMAIN):
+        raise DnsblException(f"DNS query failed with rcode {rcode}")
+    offset = dnsHeader.size
+    for _ in range(qdCount):
+        offset = skipName(packet, offset) + 4
+    ttls: List[int] = []
+    found = False
+    for section, count in ((0, anCount), (1, nsCount)):
+        for _ in range(count):
+            offset = skipName(packet, offset)
+            recordType, _, ttl, dataLength = dnsRecordFixed.unpack_from(packet, offset)
+            offset += dnsRecordFixed.size
+            if section == 0 and recordType == DNS_TYPE_A:
+                found = True
+                ttls.append(ttl)
+            elif section == 1 and recordType == DNS_TYPE_SOA and rcode == DNS_RCODE_NXDOMAIN:
+                # negative answers are cached for min(SOA TTL, SOA minimum), see RFC 2308
+                minimum = struct.unpack_from("!I", packet, offset + dataLength - 4)[0]
+                ttls.append(min(ttl, minimum))
+            offset += dataLength
+    return found, min(ttls) if ttls else None
+
+
+class DnsblChecker:
+    """Cached, concurrent DNSBL lookups with a per-query timeout.
+
+    Queries are sent directly to nameserver (default: the first one in /etc/resolv.conf). Without a
+    nameserver the system resolver is used, which does not report TTLs."""
+
+    def __init__(
+        self,
+        zones: Iterable[DnsblZone] = (SORBS_DUL,),
+        nameserver: Optional[str] = None,
+        port: int = 53,
+        timeout: float = 2.0,
+        attempts: int = 2,
+        defaultTtl: int = 3600,
+        minTtl: int = 60,
+        maxTtl: int = 86400,
+        maxEntries: int = 10000,
+        maxWorkers: int = 8,
+    ) -> None:
+        self.zones: Dict[str, DnsblZone] = {zone.name: zone for zone in zones}
+        self.nameserver = nameserver or getSystemNameserver()
+        self.port = port
+        self.timeout = timeout
+        self.attempts = attempts
+        self.defaultTtl = defaultTtl
+        self.minTtl = minTtl
+        self.maxTtl = maxTtl
+        self.maxEntries = maxEntries
+        self.cache: "OrderedDict[Tuple[str, str], Tuple[float, bool]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="dnsbl")
+
+    def isListed(self, ip: str, zoneName: str) -> bool:
+        zone = self.zones[zoneName]
+        if ipaddress.ip_address(ip).version == 6 and not zone.ipv6:
+            return False
+        key = (zoneName, ip)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.cache.move_to_end(key)
+                return entry[1]
+        listed, ttl = self.query(reverseName(ip, zone.zone))
+        ttl = max(self.minTtl, min(self.maxTtl, ttl if ttl is not None else self.defaultTtl))
+        with self.lock:
+            self.cache[key] = (time.monotonic() + ttl, listed)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.maxEntries:
+                self.cache.popitem(last=False)
+        return listed
+
+    def lookup(self, ip: str, zoneName: str) -> "Future[bool]":
+        """Start a lookup in the background."""
+        return self.executor.submit(self.isListed, ip, zoneName)
+
+    def lookupMany(self, ips: Iterable[str], zoneName: str) -> Dict[str, bool]:
+        """Look up all ips concurrently. Addresses which could not be looked up are left out."""
+        futures = {ip: self.lookup(ip, zoneName) for ip in ips}
+        res = {}
+        for ip, future in futures.items():
+            try:
+                res[ip] = future.result()
+            except DnsblException as ex:
+                pywikibot.warning(f"DNSBL lookup for {ip} failed: {ex}")
+        return res
+
+    def query(self, name: str) -> Tuple[bool, Optional[int]]:
+        if not self.nameserver:
+            return self.querySystemResolver(name)
+        lastError = None
+        for _ in range(self.attempts):
+            queryId = random.getrandbits(16)
+            sock = socket.socket(socket.AF_INET6 if ":" in self.nameserver else socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.sendto(buildQuery(queryId, name), (self.nameserver, self.port))
+                while True:
+                    packet, source = sock.recvfrom(4096)
+                    if source[0] == self.nameserver and packet[:2] == struct.pack("!H", queryId):
+                        return parseResponse(packet, queryId)
+            except (socket.timeout, OSError, struct.error, IndexError) as ex:
+                lastError = ex
+            finally:
+                sock.close()
+        raise DnsblException(f"DNS query for {name} failed: {lastError}")
+
+    def querySystemResolver(self, name: str) -> Tuple[bool, Optional[int]]:
+        try:
+            socket.gethostbyname(name)
+            return True, None
+        except socket.gaierror as ex:
+            if ex.errno == -errno.ENOENT or ex.errno == socket.EAI_NONAME or ex.errno == 11001:
+                # 11001 == WSAHOST_NOT_FOUND
+                return False, None
+            raise DnsblException(str(ex))
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import ipaddress
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import metrics
+
+KEEP = "keep"
+DROP = "drop"
+
+
+def isIpAddress(username: str) -> bool:
+    try:
+        ipaddress.ip_address(username)
+    except ValueError:
+        return False
+    return True
+
+
+@dataclass(frozen=True)
+class FilterRule:
+    """Matches raw recent change events on which all given conditions hold."""
+
+    name: str
+    action: str
+    type: Optional[str] = None
+    namespace: Optional[int] = None
+    title: Optional[str] = None
+    logType: Optional[str] = None
+    bot: Optional[bool] = None
+    # whether the performing user is an IP address
+    anonymous: Optional[bool] = None
+    # at least one of the tags (events from EventStreams carry no tags, API results do)
+    tags: Tuple[str, ...] = ()
+    # at least one of the strings occurs in the edit summary
+    commentContains: Tuple[str, ...] = ()
+
+    def matches(self, event: Dict[str, Any]) -> bool:
+        if self.type is not None and event.get("type") != self.type:
+            return False
+        if self.namespace is not None and event.get("namespace") != self.namespace:
+            return False
+        if self.title is not None and event.get("title") != self.title:
+            return False
+        if self.logType is not None and event.get("log_type") != self.logType:
+            return False
+        if self.bot is not None and bool(event.get("bot")) != self.bot:
+            return False
+        if self.anonymous is not None and isIpAddress(event.get("user", "")) != self.anonymous:
+            return False
+        if self.tags and not set(self.tags).intersection(event.get("tags", ())):
+            return False
+        if self.commentContains:
+            comment = event.get("comment", "")
+            if not any(text in comment for text in self.commentContains):
+                return False
+        return True
+
+
+class EventFilter:
+    """Ordered rules deciding which stream events are processed, the first matching rule wins.
+
+    Runs on the raw event dicts, before any Page object is created. Matches are counted per rule."""
+
+    def __init__(self, rules: Sequence[FilterRule], defaultAction: str = DROP) -> None:
+        for rule in rules:
+            if rule.action not in (KEEP, DROP):
+                raise ValueError(f"Unknown action of filter rule {rule.name}: {rule.action}")
+        self.rules = list(rules)
+        self.defaultRule = FilterRule("default", defaultAction)
+        self.counts: Dict[str, int] = {rule.name: 0 for rule in self.rules + [self.defaultRule]}
+        self.lock = threading.Lock()
+
+    def match(self, event: Dict[str, Any]) -> FilterRule:
+        rule = next((rule for rule in self.rules if rule.matches(event)), self.defaultRule)
+        with self.lock:
+            self.counts[rule.name] += 1
+        metrics.streamEvents.inc(rule.name, rule.action)
+        return rule
+
+    def dropCounts(self) -> Dict[str, int]:
+        """Dropped events per rule."""
+        with self.lock:
+            return {
+                rule.name: self.counts[rule.name] for rule in self.rules + [self.defaultRule] if rule.action == DROP
+            }
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+import time
+import traceback
+from typing import List
+
+import metrics
+import pywikibot
+from pywikibot.data import api
+
+
+class LogWriter:
+    """Collects log entries and appends them to a wiki page in batches.
+
+    Entries are flushed as a single edit once maxEntries are pending or the oldest pending entry is
+    flushInterval seconds old. Pending entries are kept in a journal file until they have been saved,
+    so they survive a crash."""
+
+    def __init__(
+        self,
+        site: pywikibot.site.APISite,
+        title: str,
+        journalPath: str,
+        flushInterval: float = 60,
+        maxEntries: int = 10,
+        summary: str = "Bot: Update",
+    ) -> None:
+        self.site = site
+        self.title = title
+        self.journalPath = journalPath
+        self.flushInterval = flushInterval
+        self.maxEntries = maxEntries
+        self.summary = summary
+        self.pending: List[str] = []
+        self.oldestPendingTime = 0.0
+        # set after a failed edit to wait a whole interval before retrying
+        self.retryTime = 0.0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.loadJournal()
+        self.thread = threading.Thread(target=self.run, name="logwriter", daemon=True)
+        self.thread.start()
+
+    def loadJournal(self) -> None:
+        try:
+            with open(self.journalPath, "r", encoding="utf-8") as f:
+                self.pending = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return
+        if self.pending:
+            pywikibot.output(f"Recovered {len(self.pending)} unsaved log entries from journal.")
+            self.oldestPendingTime = time.monotonic()
+
+    def add(self, entry: str) -> None:
+        with self.lock:
+            with open(self.journalPath, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if not self.pending:
+                self.oldestPendingTime = time.monotonic()
+            self.pending.append(entry)
+            if len(self.pending) >= self.maxEntries:
+                self.wakeup.set()
+
+    def setBatching(self, maxEntries: int, flushInterval: float) -> None:
+        with self.lock:
+            self.maxEntries = maxEntries
+            self.flushInterval = flushInterval
+        self.wakeup.set()
+
+    def isFlushDue(self) -> bool:
+        with self.lock:
+            if not self.pending or (time.monotonic() < self.retryTime and not self.stopping):
+                return False
+            return (
+                len(self.pending) >= self.maxEntries
+                or time.monotonic() - self.oldestPendingTime >= self.flushInterval
+                or self.stopping
+            )
+
+    def flush(self) -> None:
+        with self.lock:
+            entries = list(self.pending)
+        if not entries:
+            return
+        request = api.Request(
+            site=self.site,
+            parameters={
+                "action": "edit",
+                "title": self.title,
+                "appendtext": "".join(f"\n* {e}" for e in entries),
+                "summary": self.summary,
+                "nocreate": True,
+                "token": self.site.tokens["csrf"],
+            },
+        )
+        with metrics.mediawikiRequestSeconds.time("edit"):
+            request.submit()
+        with self.lock:
+            del self.pending[: len(entries)]
+            # rewrite the journal with the entries added during the edit
+            tmpPath = f"{self.journalPath}.tmp"
+            with open(tmpPath, "w", encoding="utf-8") as f:
+                for entry in self.pending:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmpPath, self.journalPath)
+            self.oldestPendingTime = time.monotonic()
+
+    def run(self) -> None:
+        while True:
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+            if self.isFlushDue():
+                try:
+                    self.flush()
+                except Exception:
+                    pywikibot.error(f"Saving log entries failed: {traceback.format_exc()}")
+                    self.retryTime = time.monotonic() + self.flushInterval
+                    if self.stopping:
+                        return
+            elif self.stopping:
+                return
+
+    def stop(self) -> None:
+        """Flush all pending entries."""
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escapeLabelValue(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatSample(name: str, labels: Sequence[Tuple[str, str]], value: float) -> str:
+    labelText = ",".join(f'{label}="{escapeLabelValue(labelValue)}"' for label, labelValue in labels)
+    if math.isinf(value):
+        valueText = "+Inf" if value > 0 else "-Inf"
+    else:
+        valueText = repr(float(value))
+    return f"{name}{{{labelText}}} {valueText}" if labelText else f"{name} {valueText}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List["Metric"] = []
+        self.lock = threading.Lock()
+
+    def register(self, metric: "Metric") -> None:
+        with self.lock:
+            self.metrics.append(metric)
+
+    def exposition(self) -> str:
+        """All metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """Base class of labelled metrics, children are created on first use of a label combination."""
+
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelNames: Sequence[str] = (), registry: Registry = REGISTRY
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.function: Optional[Callable[[], float]] = None
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def key(self, labelValues: Sequence[str]) -> Tuple[str, ...]:
+        if len(labelValues) != len(self.labelNames):
+            raise ValueError(f"{self.name} expects labels {self.labelNames}, got {labelValues}")
+        return tuple(str(value) for value in labelValues)
+
+    def add(self, labelValues: Sequence[str], amount: float) -> None:
+        key = self.key(labelValues)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def setFunction(self, function: Callable[[], float]) -> None:
+        """Read the value of an unlabelled metric from function when scraped."""
+        self.function = function
+
+    def samples(self) -> List[str]:
+        if self.function:
+            return [formatSample(self.name, [], self.function())]
+        with self.lock:
+            values = sorted(self.values.items())
+        return [formatSample(self.name, list(zip(self.labelNames, key)), value) for key, value in values]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelValues: str, amount: float = 1.0) -> None:
+        self.add(labelValues, amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labelValues: str) -> None:
+        key = self.key(labelValues)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelNames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        registry: Registry = REGISTRY,
+    ) -> None:
+        super().__init__(name, documentation, labelNames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (count per bucket, sum)
+        self.observations: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, *labelValues: str) -> None:
+        key = self.key(labelValues)
+        with self.lock:
+            counts, total = self.observations.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.observations[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labelValues: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelValues)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            observations = sorted((key, (list(counts), total)) for key, (counts, total) in self.observations.items())
+        lines = []
+        for key, (counts, total) in observations:
+            labels = list(zip(self.labelNames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(formatSample(f"{self.name}_bucket", labels + [("le", le)], cumulative))
+            lines.append(formatSample(f"{self.name}_sum", labels, total))
+            lines.append(formatSample(f"{self.name}_count", labels, cumulative))
+        return lines
+
+
+providerRequests = Counter(
+    "sentinel_provider_requests_total",
+    "HTTP requests to the VPN/proxy check providers by outcome (ok, retryable, quota, error).",
+    ["provider", "outcome"],
+)
+providerRequestSeconds = Histogram(
+    "sentinel_provider_request_seconds", "Duration of the HTTP requests to the providers.", ["provider"]
+)
+providerRetries = Counter("sentinel_provider_retries_total", "Repeated provider requests.", ["provider"])
+providerQuotaErrors = Counter(
+    "sentinel_provider_quota_errors_total", "Lookups refused because a quota is exhausted.", ["provider"]
+)
+cacheLookups = Counter(
+    "sentinel_cache_lookups_total",
+    "Verdict cache lookups per tier (memory, disk, prefix, coalesced) and result (hit, miss).",
+    ["provider", "tier", "result"],
+)
+cascadeChecks = Counter(
+    "sentinel_cascade_checks_total",
+    "Provider checks made by the scoring cascades by outcome (proxy, clean, abstain, error).",
+    ["cascade", "provider", "outcome"],
+)
+cascadeDecisions = Counter(
+    "sentinel_cascade_decisions_total",
+    "Verdicts of the scoring cascades by the provider which decided them.",
+    ["cascade", "provider"],
+)
+prefetchLookups = Counter(
+    "sentinel_prefetch_lookups_total",
+    "Speculative lookups of anonymous editors by outcome (queued, expired, checked, error).",
+    ["outcome"],
+)
+prefetchLiveChecks = Counter(
+    "sentinel_prefetch_live_checks_total", "Live checks by whether the address had been prefetched.", ["result"]
+)
+prefetchRequests = Counter("sentinel_prefetch_provider_requests_total", "Provider requests made by prefetching.")
+mediawikiRequestSeconds = Histogram(
+    "sentinel_mediawiki_request_seconds", "Duration of MediaWiki API requests by kind.", ["request"]
+)
+sseConnections = Counter("sentinel_sse_connections_total", "Connections made to the EventStreams server.")
+streamEvents = Counter(
+    "sentinel_stream_events_total", "Stream events by the filter rule which matched them.", ["rule", "action"]
+)
+streamLag = Gauge("sentinel_stream_lag_seconds", "Age of the latest stream event when it was read.")
+catchingUp = Gauge("sentinel_catching_up", "1 while the backlog after a restart is processed.")
+treatStageSeconds = Histogram(
+    "sentinel_treat_stage_seconds", "Time spent in the stages of handling a stream event.", ["stage"]
+)
+jobQueueSeconds = Histogram("sentinel_job_queue_seconds", "Time jobs waited in the pipeline queue.", ["job"])
+jobSeconds = Histogram("sentinel_job_seconds", "Run time of pipeline jobs.", ["job"])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+def startServer(port: int, address: str = "") -> ThreadingHTTPServer:
+    """Serve the metrics on http://address:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
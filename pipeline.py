@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import queue
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+import metrics
+import pywikibot
+
+
+@dataclass
+class Job:
+    # event timestamp (seconds since the epoch) used for the end-to-end latency
+    eventTime: float
+    func: Callable[..., None]
+    args: Tuple[Any, ...]
+    submitTime: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class PipelineStats:
+    queueDepth: int
+    outputQueueDepth: int
+    busyWorkers: int
+    processedJobs: int
+    writtenEntries: int
+    # end-to-end latency from event timestamp to written log entry (seconds) over the recent entries
+    latencyP50: float
+    latencyP99: float
+    latencyMax: float
+
+
+class Pipeline:
+    """Staged processing of stream events.
+
+    The ingest stage (the stream thread) submits jobs into a bounded queue and blocks while it is full.
+    A pool of workers runs the jobs, output produced by them is serialized by a single writer thread."""
+
+    def __init__(self, workers: int, writer: Callable[[str], None], queueSize: int = 100) -> None:
+        self.writer = writer
+        self.jobs: "queue.Queue[Optional[Job]]" = queue.Queue(maxsize=queueSize)
+        self.outputs: "queue.Queue[Optional[Tuple[str, float]]]" = queue.Queue()
+        self.context = threading.local()
+        self.latencies: Deque[float] = deque(maxlen=1000)
+        self.lock = threading.Lock()
+        self.busyWorkers = 0
+        # event time -> number of jobs for it which are queued or running
+        self.pendingEventTimes: "Counter[float]" = Counter()
+        self.processedJobs = 0
+        self.writtenEntries = 0
+        self.workerThreads = [
+            threading.Thread(target=self.work, name=f"worker-{i}", daemon=True) for i in range(workers)
+        ]
+        self.writerThread = threading.Thread(target=self.write, name="writer", daemon=True)
+        for thread in self.workerThreads:
+            thread.start()
+        self.writerThread.start()
+
+    def submit(self, eventTime: float, func: Callable[..., None], *args: Any) -> None:
+        """Queue func(*args), blocks while the queue is full."""
+        with self.lock:
+            self.pendingEventTimes[eventTime] += 1
+        self.jobs.put(Job(eventTime=eventTime, func=func, args=args))
+
+    def oldestPendingEventTime(self) -> Optional[float]:
+        """Event time of the oldest job which is queued or running."""
+        with self.lock:
+            return min(self.pendingEventTimes) if self.pendingEventTimes else None
+
+    def addWorkers(self, count: int) -> None:
+        with self.lock:
+            threads = [threading.Thread(target=self.work, daemon=True) for _ in range(count)]
+            for thread in threads:
+                thread.name = f"worker-{len(self.workerThreads)}"
+                self.workerThreads.append(thread)
+        for thread in threads:
+            thread.start()
+
+    def removeWorkers(self, count: int) -> None:
+        """Let count workers exit after the jobs queued so far have been started."""
+        for _ in range(count):
+            self.jobs.put(None)
+
+    def output(self, entry: str) -> None:
+        """Hand entry to the writer, may only be called from jobs."""
+        self.outputs.put((entry, getattr(self.context, "eventTime", time.time())))
+
+    def work(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                with self.lock:
+                    self.workerThreads.remove(threading.current_thread())
+                return
+            with self.lock:
+                self.busyWorkers += 1
+            self.context.eventTime = job.eventTime
+            metrics.jobQueueSeconds.observe(time.monotonic() - job.submitTime, job.func.__name__)
+            try:
+                with metrics.jobSeconds.time(job.func.__name__):
+                    job.func(*job.args)
+            except Exception:
+                pywikibot.error(f"Job {job.func.__name__}{job.args} failed: {traceback.format_exc()}")
+            finally:
+                del self.context.eventTime
+                with self.lock:
+                    self.busyWorkers -= 1
+                    self.processedJobs += 1
+                    self.pendingEventTimes[job.eventTime] -= 1
+                    if not self.pendingEventTimes[job.eventTime]:
+                        del self.pendingEventTimes[job.eventTime]
+
+    def write(self) -> None:
+        while True:
+            item = self.outputs.get()
+            if item is None:
+                return
+            entry, eventTime = item
+            try:
+                self.writer(entry)
+            except Exception:
+                pywikibot.error(f"Writing {entry} failed: {traceback.format_exc()}")
+            with self.lock:
+                self.writtenEntries += 1
+                self.latencies.append(time.time() - eventTime)
+
+    def stats(self) -> PipelineStats:
+        with self.lock:
+            latencies: List[float] = sorted(self.latencies)
+            busyWorkers = self.busyWorkers
+            processedJobs = self.processedJobs
+            writtenEntries = self.writtenEntries
+        return PipelineStats(
+            queueDepth=self.jobs.qsize(),
+            outputQueueDepth=self.outputs.qsize(),
+            busyWorkers=busyWorkers,
+            processedJobs=processedJobs,
+            writtenEntries=writtenEntries,
+            latencyP50=latencies[len(latencies) // 2] if latencies else 0.0,
+            latencyP99=latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+            latencyMax=latencies[-1] if latencies else 0.0,
+        )
+
+    def stop(self) -> None:
+        """Finish all queued jobs and outputs."""
+        with self.lock:
+            threads = list(self.workerThreads)
+        for _ in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join()
+        self.outputs.put(None)
+        self.writerThread.join()
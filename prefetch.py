@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+import pywikibot
+from eventfilter import isIpAddress
+from quota import QuotaRefusedError, RequestBudget
+from vpncheck import CheckException, CheckResult, VpnCheck
+
+# bytes removed by an edit from which on it counts as suspicious
+LARGE_REMOVAL = 500
+
+
+@dataclass
+class PrefetchStats:
+    queued: int
+    prefetched: int
+    errors: int
+    # live checks and those of them for addresses which had been prefetched
+    liveChecks: int
+    hits: int
+    requestsUsed: int
+    requestsRemaining: int
+
+    @property
+    def hitRate(self) -> float:
+        return self.hits / self.liveChecks if self.liveChecks else 0.0
+
+
+class Prefetcher:
+    """Checks anonymous editors from the stream in the background before they are reverted, reported or blocked.
+
+    Edits get a suspicion score: one point per earlier edit of the same address within the tracking
+    period, two points for large removals and two points if proxies have been found in the network of
+    the address. Addresses reaching minScore are queued, the most suspicious first, and checked with
+    check within the request budget, so that the later live check is served from the caches. cost requests,
+    the most check may make, are reserved from the budget before an address is taken from the queue."""
+
+    def __init__(
+        self,
+        vpnCheck: VpnCheck,
+        check: Callable[[str], CheckResult],
+        budget: RequestBudget,
+        cost: int = 1,
+        minScore: int = 2,
+        maxAge: float = 600,
+        maxQueued: int = 1000,
+        maxTracked: int = 50000,
+        workers: int = 2,
+    ) -> None:
+        self.vpnCheck = vpnCheck
+        self.check = check
+        self.budget = budget
+        self.cost = cost
+        self.minScore = minScore
+        # queued addresses older than this are dropped, edit counts are reset after it
+        self.maxAge = maxAge
+        self.maxQueued = maxQueued
+        self.maxTracked = maxTracked
+        # ip -> (number of edits, time of the first one)
+        self.edits: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        # (-score, sequence number, queue time, ip)
+        self.queue: List[Tuple[int, int, float, str]] = []
+        self.queuedIps: Dict[str, int] = {}
+        self.sequence = itertools.count()
+        self.prefetchedIps: "OrderedDict[str, None]" = OrderedDict()
+        self.prefetched = 0
+        self.errors = 0
+        self.liveChecks = 0
+        self.hits = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.threads = [threading.Thread(target=self.work, name=f"prefetch-{i}", daemon=True) for i in range(workers)]
+        metrics.prefetchRequests.setFunction(lambda: self.budget.used)
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def score(self, ip: str, event: Dict[str, Any], now: float) -> int:
+        count, firstSeen = self.edits.pop(ip, (0, now))
+        if now - firstSeen > self.maxAge:
+            count, firstSeen = 0, now
+        self.edits[ip] = (count + 1, firstSeen)
+        if len(self.edits) > self.maxTracked:
+            self.edits.popitem(last=False)
+        score = count
+        length = event.get("length") or {}
+        if (length.get("old") or 0) - (length.get("new") or 0) >= LARGE_REMOVAL:
+            score += 2
+        if any(prefixVerdicts.proxiesNear(ip) for prefixVerdicts in self.vpnCheck.prefixVerdicts.values()):
+            score += 2
+        return score
+
+    def observe(self, event: Dict[str, Any]) -> None:
+        """Look at a raw stream event, called from the stream thread for every event."""
+        if event.get("type") not in ("edit", "new"):
+            return
+        ip = event.get("user", "")
+        if not isIpAddress(ip):
+            return
+        now = time.monotonic()
+        with self.condition:
+            score = self.score(ip, event, now)
+            if score < self.minScore or ip in self.prefetchedIps or self.queuedIps.get(ip, -1) >= score:
+                return
+            # a higher score replaces the queued entry, the old one is skipped when it comes up
+            self.queuedIps[ip] = score
+            heapq.heappush(self.queue, (-score, next(self.sequence), now, ip))
+            if len(self.queue) > self.maxQueued * 2:
+                # a sorted list is a heap
+                self.queue = heapq.nsmallest(self.maxQueued, self.queue)
+                self.queuedIps = {
+                    queuedIp: -negScore
+                    for negScore, _, _, queuedIp in self.queue
+                    if self.queuedIps.get(queuedIp) == -negScore
+                }
+            metrics.prefetchLookups.inc("queued")
+            self.condition.notify()
+
+    def next(self) -> Optional[str]:
+        """Wait for the next address to prefetch, None when stopping."""
+        with self.condition:
+            while True:
+                if self.stopping:
+                    return None
+                now = time.monotonic()
+                while self.queue:
+                    negScore, _, queued, ip = heapq.heappop(self.queue)
+                    if self.queuedIps.get(ip) != -negScore:
+                        continue
+                    del self.queuedIps[ip]
+                    if now - queued > self.maxAge:
+                        metrics.prefetchLookups.inc("expired")
+                        continue
+                    return ip
+                self.condition.wait()
+
+    def work(self) -> None:
+        while True:
+            try:
+                reservation = self.budget.reserve(self.cost)
+            except QuotaRefusedError:
+                # wait for the next period
+                with self.condition:
+                    if self.stopping:
+                        return
+                    self.condition.wait(60)
+                continue
+            ip = self.next()
+            if ip is None:
+                reservation.release()
+                return
+            try:
+                with self.vpnCheck.background(reservation):
+                    self.check(ip)
+            except CheckException as ex:
+                pywikibot.log(f"Prefetching {ip} failed: {ex}")
+                with self.condition:
+                    self.errors += 1
+                metrics.prefetchLookups.inc("error")
+                continue
+            finally:
+                # requests the check did not need
+                reservation.release()
+            with self.condition:
+                self.prefetched += 1
+                self.prefetchedIps[ip] = None
+                if len(self.prefetchedIps) > self.maxTracked:
+                    self.prefetchedIps.popitem(last=False)
+            metrics.prefetchLookups.inc("checked")
+
+    def recordLiveCheck(self, ip: str) -> None:
+        """Count a live check of ip, a hit if ip has been prefetched."""
+        with self.condition:
+            self.liveChecks += 1
+            hit = ip in self.prefetchedIps
+            if hit:
+                self.hits += 1
+        metrics.prefetchLiveChecks.inc("hit" if hit else "miss")
+
+    def stats(self) -> PrefetchStats:
+        with self.condition:
+            return PrefetchStats(
+                queued=len(self.queuedIps),
+                prefetched=self.prefetched,
+                errors=self.errors,
+                liveChecks=self.liveChecks,
+                hits=self.hits,
+                requestsUsed=self.budget.used,
+                requestsRemaining=self.budget.remaining(),
+            )
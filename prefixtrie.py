@@ -0,0 +1,129 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import ipaddress
+from typing import Generic, Iterator, List, Optional, Tuple, TypeVar, Union
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+T = TypeVar("T")
+
+
+def toNetwork(ipOrRange: str) -> IPNetwork:
+    """Parse an IP address or CIDR range, host bits of ranges are ignored."""
+    return ipaddress.ip_network(ipOrRange.strip(), strict=False)
+
+
+class Node(Generic[T]):
+    __slots__ = ["address", "prefixLen", "children", "value"]
+
+    def __init__(self, address: int, prefixLen: int, value: Optional[T] = None) -> None:
+        self.address = address
+        self.prefixLen = prefixLen
+        self.children: List[Optional[Node[T]]] = [None, None]
+        self.value = value
+
+
+class PrefixTrie(Generic[T]):
+    """Path-compressed binary (radix) trie mapping IPv4 and IPv6 networks to values.
+
+    Lookups visit at most one node per prefix bit, nodes only exist for stored
+    networks and for the branching points between them."""
+
+    def __init__(self) -> None:
+        self.roots = {4: Node[T](0, 0), 6: Node[T](0, 0)}
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @staticmethod
+    def bitAt(address: int, position: int, maxPrefixLen: int) -> int:
+        return (address >> (maxPrefixLen - position - 1)) & 1
+
+    @staticmethod
+    def contains(node: Node[T], address: int, prefixLen: int, maxPrefixLen: int) -> bool:
+        shift = maxPrefixLen - node.prefixLen
+        return node.prefixLen <= prefixLen and (node.address >> shift) == (address >> shift)
+
+    def walk(self, network: IPNetwork) -> Iterator[Node[T]]:
+        """Yield the existing nodes whose networks contain network, shortest prefix first."""
+        maxPrefixLen = network.max_prefixlen
+        address = int(network.network_address)
+        prefixLen = network.prefixlen
+        node: Optional[Node[T]] = self.roots[network.version]
+        while node is not None and self.contains(node, address, prefixLen, maxPrefixLen):
+            yield node
+            if node.prefixLen == prefixLen:
+                return
+            node = node.children[self.bitAt(address, node.prefixLen, maxPrefixLen)]
+
+    def get(self, network: IPNetwork) -> Optional[T]:
+        for node in self.walk(network):
+            if node.prefixLen == network.prefixlen:
+                return node.value
+        return None
+
+    def set(self, network: IPNetwork, value: T) -> None:
+        maxPrefixLen = network.max_prefixlen
+        address = int(network.network_address)
+        prefixLen = network.prefixlen
+        node = self.roots[network.version]
+        while True:
+            if node.prefixLen == prefixLen:
+                if node.value is None:
+                    self.size += 1
+                node.value = value
+                return
+            bit = self.bitAt(address, node.prefixLen, maxPrefixLen)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = Node(address, prefixLen, value)
+                self.size += 1
+                return
+            if self.contains(child, address, prefixLen, maxPrefixLen):
+                node = child
+                continue
+            # split the edge to child at the first differing bit
+            difference = child.address ^ address
+            common = min(child.prefixLen, prefixLen, maxPrefixLen - difference.bit_length())
+            if common == prefixLen:
+                inserted = Node(address, prefixLen, value)
+                inserted.children[self.bitAt(child.address, common, maxPrefixLen)] = child
+            else:
+                mask = ((1 << common) - 1) << (maxPrefixLen - common)
+                inserted = Node[T](address & mask, common)
+                inserted.children[self.bitAt(child.address, common, maxPrefixLen)] = child
+                inserted.children[self.bitAt(address, common, maxPrefixLen)] = Node(address, prefixLen, value)
+            node.children[bit] = inserted
+            self.size += 1
+            return
+
+    def remove(self, network: IPNetwork) -> None:
+        for node in self.walk(network):
+            if node.prefixLen == network.prefixlen and node.value is not None:
+                node.value = None
+                self.size -= 1
+
+    def enclosing(
+        self, network: IPNetwork, minPrefixLen: int = 0, maxPrefixLen: int = 128
+    ) -> Iterator[Tuple[IPNetwork, T]]:
+        """Yield all stored networks containing network, shortest prefix first."""
+        for node in self.walk(network):
+            if node.value is not None and minPrefixLen <= node.prefixLen <= maxPrefixLen:
+                yield network.supernet(new_prefix=node.prefixLen), node.value
+
+    def items(self) -> Iterator[Tuple[IPNetwork, T]]:
+        for version, root in self.roots.items():
+            networkClass = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if node.value is not None:
+                    yield networkClass((node.address, node.prefixLen)), node.value
+                stack.extend(child for child in reversed(node.children) if child is not None)
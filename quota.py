@@ -0,0 +1,220 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Iterator, Optional
+
+from retry import CallRefusedError
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, the state is only shared between the threads of a process
+    fcntl = None  # type: ignore
+
+# priority classes
+LIVE = 0
+BATCH = 1
+
+
+class QuotaRefusedError(CallRefusedError):
+    pass
+
+
+@dataclass
+class QuotaState:
+    # UTC day the used counter belongs to
+    day: str
+    used: int
+    tokens: float
+    updated: float
+
+
+@dataclass
+class QuotaStatus:
+    provider: str
+    used: int
+    dailyQuota: Optional[int]
+    batchReserve: int
+    tokens: float
+
+
+class QuotaLimiter:
+    """Rate limit (token bucket) and daily quota of a provider, shared between processes.
+
+    The state is kept in a JSON file which is only accessed while holding an exclusive lock on a lock file.
+    Live requests may use the whole quota. Batch requests are refused once no more than batchReserve
+    requests are left for the day and only take a token while more than liveBurst tokens remain, so that
+    live requests do not have to wait behind a batch run."""
+
+    def __init__(
+        self,
+        path: str,
+        provider: str,
+        dailyQuota: Optional[int],
+        rate: float,
+        burst: int,
+        batchReserve: int = 0,
+        liveBurst: int = 2,
+    ) -> None:
+        self.path = path
+        self.provider = provider
+        self.dailyQuota = dailyQuota
+        self.rate = rate
+        self.burst = burst
+        self.batchReserve = batchReserve
+        self.liveBurst = min(liveBurst, burst - 1)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def locked(self) -> Iterator[QuotaState]:
+        """Yield the current state, changes are saved when the block is left without an exception."""
+        with self.lock, open(f"{self.path}.lock", "a") as lockFile:
+            if fcntl:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                state = self.load()
+                yield state
+                self.save(state)
+            finally:
+                if fcntl:
+                    fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def load(self) -> QuotaState:
+        now = time.time()
+        today = datetime.utcfromtimestamp(now).strftime("%Y-%m-%d")
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = QuotaState(**json.load(f))
+        except (FileNotFoundError, ValueError, TypeError):
+            state = QuotaState(day=today, used=0, tokens=float(self.burst), updated=now)
+        if state.day != today:
+            state.day = today
+            state.used = 0
+        state.tokens = min(float(self.burst), state.tokens + max(0.0, now - state.updated) * self.rate)
+        state.updated = now
+        return state
+
+    def save(self, state: QuotaState) -> None:
+        tmpPath = f"{self.path}.tmp"
+        with open(tmpPath, "w", encoding="utf-8") as f:
+            json.dump(asdict(state), f)
+        os.replace(tmpPath, self.path)
+
+    def acquire(self, priority: int = LIVE) -> None:
+        """Take one request from the quota, waiting for the rate limit if necessary.
+
+        Raises QuotaRefusedError if the daily quota is used up, for batch requests already if only the
+        reserve is left."""
+        needed = 1.0 if priority == LIVE else 1.0 + self.liveBurst
+        while True:
+            with self.locked() as state:
+                if self.dailyQuota is not None:
+                    remaining = self.dailyQuota - state.used
+                    if remaining <= 0:
+                        raise QuotaRefusedError(f"{self.provider}: daily quota of {self.dailyQuota} used up")
+                    if priority != LIVE and remaining <= self.batchReserve:
+                        raise QuotaRefusedError(
+                            f"{self.provider}: the remaining {remaining} requests are reserved for live checks"
+                        )
+                if state.tokens >= needed:
+                    state.tokens -= 1.0
+                    state.used += 1
+                    return
+                wait = (needed - state.tokens) / self.rate
+            time.sleep(wait)
+
+    def exhaust(self) -> None:
+        """Mark the daily quota as used up, e.g. after the provider reported so."""
+        if self.dailyQuota is None:
+            return
+        with self.locked() as state:
+            state.used = max(state.used, self.dailyQuota)
+
+    def status(self) -> QuotaStatus:
+        with self.locked() as state:
+            return QuotaStatus(
+                provider=self.provider,
+                used=state.used,
+                dailyQuota=self.dailyQuota,
+                batchReserve=self.batchReserve,
+                tokens=state.tokens,
+            )
+
+
+class RequestBudget:
+    """Provider requests a background task may make per period, counted across all providers."""
+
+    def __init__(self, limit: int, period: float = 86400) -> None:
+        self.limit = limit
+        self.period = period
+        self.periodStart = time.monotonic()
+        self.usedInPeriod = 0
+        # requests set aside by reservations and not made yet
+        self.reserved = 0
+        # requests made since the budget was created
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        if now - self.periodStart >= self.period:
+            self.periodStart = now
+            self.usedInPeriod = 0
+
+    def remaining(self) -> int:
+        with self.lock:
+            self.refresh()
+            return self.limit - self.usedInPeriod - self.reserved
+
+    def take(self) -> None:
+        """Account for one request, raises QuotaRefusedError if the budget of the period is used up."""
+        with self.lock:
+            self.refresh()
+            if self.usedInPeriod + self.reserved >= self.limit:
+                raise QuotaRefusedError(f"budget of {self.limit} requests used up")
+            self.usedInPeriod += 1
+            self.used += 1
+
+    def reserve(self, requests: int) -> "Reservation":
+        """Set aside requests for a task, raises QuotaRefusedError if not that many are left."""
+        with self.lock:
+            self.refresh()
+            if self.usedInPeriod + self.reserved + requests > self.limit:
+                raise QuotaRefusedError(f"budget of {self.limit} requests used up")
+            self.reserved += requests
+        return Reservation(self, requests)
+
+
+class Reservation:
+    """Requests set aside from a RequestBudget, those not taken are returned by release."""
+
+    def __init__(self, budget: RequestBudget, requests: int) -> None:
+        self.budget = budget
+        self.left = requests
+
+    def take(self) -> None:
+        """Account for one request, raises QuotaRefusedError if the reservation is used up."""
+        with self.budget.lock:
+            if self.left <= 0:
+                raise QuotaRefusedError(f"reservation of the budget of {self.budget.limit} requests used up")
+            self.left -= 1
+            self.budget.reserved -= 1
+            self.budget.usedInPeriod += 1
+            self.budget.used += 1
+
+    def release(self) -> None:
+        with self.budget.lock:
+            self.budget.reserved -= self.left
+            self.left = 0
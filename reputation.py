@@ -0,0 +1,337 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import argparse
+import ipaddress
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import pywikibot
+from prefixtrie import IPNetwork, toNetwork
+
+MAGIC = b"IPREP"
+FORMAT_VERSION = 1
+# magic, format version, number of sources, number of IPv4 and IPv6 intervals
+fileHeader = struct.Struct(">5sBHII")
+# first and last address, proxy flag, source index
+intervalRecords = {4: struct.Struct(">IIBH"), 6: struct.Struct(">16s16sBH")}
+addressSizes = {4: 4, 6: 16}
+
+# start, end, proxy, source index
+Interval = Tuple[int, int, bool, int]
+
+
+@dataclass
+class Reputation:
+    proxy: bool
+    # name of the list the verdict comes from
+    source: str
+
+
+def flatten(networks: Iterable[Tuple[IPNetwork, bool, int]]) -> Dict[int, List[Interval]]:
+    """Turn possibly nested networks into sorted, disjoint intervals per IP version.
+
+    The most specific network wins, of identical networks the last one. Adjacent intervals with the
+    same verdict and source are merged."""
+    byVersion: Dict[int, List[Tuple[int, int, int, bool, int]]] = {4: [], 6: []}
+    for order, (network, proxy, source) in enumerate(networks):
+        start = int(network.network_address)
+        byVersion[network.version].append((start, -int(network.broadcast_address), order, proxy, source))
+    result: Dict[int, List[Interval]] = {}
+    for version, entries in byVersion.items():
+        entries.sort()
+        intervals: List[Interval] = []
+
+        def emit(start: int, end: int, proxy: bool, source: int) -> None:
+            if start > end:
+                return
+            if intervals and intervals[-1][1] + 1 == start and intervals[-1][2:] == (proxy, source):
+                intervals[-1] = (intervals[-1][0], end, proxy, source)
+            else:
+                intervals.append((start, end, proxy, source))
+
+        # enclosing networks which have not been emitted up to their end yet, innermost last
+        stack: List[Tuple[int, bool, int]] = []
+        position = 0
+        for start, negEnd, _, proxy, source in entries:
+            while stack and stack[-1][0] < start:
+                end, outerProxy, outerSource = stack.pop()
+                emit(position, end, outerProxy, outerSource)
+                position = max(position, end + 1)
+            if stack:
+                emit(position, start - 1, stack[-1][1], stack[-1][2])
+            stack.append((-negEnd, proxy, source))
+            position = start
+        while stack:
+            end, proxy, source = stack.pop()
+            emit(position, end, proxy, source)
+            position = max(position, end + 1)
+        result[version] = intervals
+    return result
+
+
+def writeDatabase(path: str, sources: List[str], intervals: Dict[int, List[Interval]]) -> None:
+    """Write the database atomically, readers see either the old or the new file."""
+    tmpPath = f"{path}.tmp"
+    with open(tmpPath, "wb") as f:
+        f.write(fileHeader.pack(MAGIC, FORMAT_VERSION, len(sources), len(intervals[4]), len(intervals[6])))
+        for source in sources:
+            name = source.encode("utf-8")
+            f.write(struct.pack(">B", len(name)) + name)
+        for version in (4, 6):
+            record = intervalRecords[version]
+            for start, end, proxy, sourceIndex in intervals[version]:
+                if version == 4:
+                    f.write(record.pack(start, end, proxy, sourceIndex))
+                else:
+                    f.write(record.pack(start.to_bytes(16, "big"), end.to_bytes(16, "big"), proxy, sourceIndex))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
+
+
+class IntervalFile:
+    """A memory-mapped reputation database, looked up by binary search over the sorted intervals."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat.st_size < fileHeader.size:
+                raise ValueError(f"{path} is not a reputation database")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, sourceCount, count4, count6 = fileHeader.unpack_from(self.data, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a reputation database of version {FORMAT_VERSION}")
+        offset = fileHeader.size
+        self.sources: List[str] = []
+        for _ in range(sourceCount):
+            length = self.data[offset]
+            self.sources.append(str(self.data[offset + 1 : offset + 1 + length], "utf-8"))
+            offset += 1 + length
+        self.counts = {4: count4, 6: count6}
+        self.offsets = {4: offset, 6: offset + count4 * intervalRecords[4].size}
+        if self.offsets[6] + count6 * intervalRecords[6].size != len(self.data):
+            raise ValueError(f"{path} is truncated")
+
+    def interval(self, version: int, index: int) -> Interval:
+        record = intervalRecords[version]
+        start, end, proxy, source = record.unpack_from(self.data, self.offsets[version] + index * record.size)
+        if version == 6:
+            start, end = int.from_bytes(start, "big"), int.from_bytes(end, "big")
+        return start, end, bool(proxy), source
+
+    def start(self, version: int, index: int) -> int:
+        offset = self.offsets[version] + index * intervalRecords[version].size
+        return int.from_bytes(self.data[offset : offset + addressSizes[version]], "big")
+
+    def lookup(self, ip: str) -> Optional[Reputation]:
+        address = ipaddress.ip_address(ip)
+        version = address.version
+        value = int(address)
+        # find the last interval starting at or before the address
+        low, high = 0, self.counts[version]
+        while low < high:
+            middle = (low + high) // 2
+            if self.start(version, middle) <= value:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        _, end, proxy, source = self.interval(version, low - 1)
+        if value > end:
+            return None
+        return Reputation(proxy=proxy, source=self.sources[source])
+
+    def intervalCount(self) -> int:
+        return self.counts[4] + self.counts[6]
+
+
+class ReputationDb:
+    """Offline verdicts for known hosting, VPN and ISP networks, compiled by the build command.
+
+    The file is reopened when it has been replaced, at most every checkInterval seconds, so that a
+    running process picks up rebuilds without restarting. A missing file has no verdicts."""
+
+    def __init__(self, path: str, checkInterval: float = 60) -> None:
+        self.path = path
+        self.checkInterval = checkInterval
+        self.file: Optional[IntervalFile] = None
+        self.lastCheck = float("-inf")
+        self.lock = threading.Lock()
+
+    def reload(self) -> None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.file = None
+            return
+        if self.file and self.file.identity == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            return
+        try:
+            # lookups still running on the old mapping keep it alive until they are done
+            self.file = IntervalFile(self.path)
+        except (OSError, ValueError) as ex:
+            pywikibot.warning(f"Loading {self.path} failed, keeping the previous version: {ex}")
+            return
+        pywikibot.log(f"Loaded {self.path} with {self.file.intervalCount()} intervals")
+
+    def current(self) -> Optional[IntervalFile]:
+        now = time.monotonic()
+        if now - self.lastCheck >= self.checkInterval:
+            with self.lock:
+                if now - self.lastCheck >= self.checkInterval:
+                    self.lastCheck = now
+                    self.reload()
+        return self.file
+
+    def lookup(self, ip: str) -> Optional[Reputation]:
+        file = self.current()
+        return file.lookup(ip) if file else None
+
+
+def uncommentedLines(path: str) -> Iterator[Tuple[int, List[str]]]:
+    """Fields of the lines of path, # and ; start comments."""
+    with open(path, "r", encoding="utf-8") as f:
+        for lineNo, line in enumerate(f, 1):
+            fields = re.split(r"[#;]", line, 1)[0].split()
+            if fields:
+                yield lineNo, fields
+
+
+def readNetworks(path: str) -> Iterator[IPNetwork]:
+    """Read a list with one address or CIDR range at the start of each line."""
+    for lineNo, fields in uncommentedLines(path):
+        try:
+            yield toNetwork(fields[0])
+        except ValueError:
+            raise ValueError(f"{path}:{lineNo}: expected an address or CIDR range")
+
+
+def parseAsn(text: str) -> int:
+    return int(text[2:] if text.upper().startswith("AS") else text)
+
+
+def readAsns(path: str) -> Set[int]:
+    """Read a list with one AS number (1234 or AS1234) at the start of each line."""
+    asns: Set[int] = set()
+    for lineNo, fields in uncommentedLines(path):
+        try:
+            asns.add(parseAsn(fields[0]))
+        except ValueError:
+            raise ValueError(f"{path}:{lineNo}: expected an AS number")
+    return asns
+
+
+def readAsnPrefixes(path: str) -> Iterator[Tuple[IPNetwork, Set[int]]]:
+    """Read an ASN-to-prefix dump, either "<prefix> <asn>" or "<address> <length> <asn>" (CAIDA pfx2as).
+
+    Prefixes announced by several ASes list them separated by _ or ,."""
+    for lineNo, fields in uncommentedLines(path):
+        try:
+            if len(fields) == 2:
+                network = toNetwork(fields[0])
+            elif len(fields) == 3:
+                network = toNetwork(f"{fields[0]}/{fields[1]}")
+            else:
+                raise ValueError("wrong number of fields")
+            asns = {parseAsn(asn) for asn in re.split(r"[_,]", fields[-1]) if asn}
+        except ValueError:
+            raise ValueError(f"{path}:{lineNo}: expected <prefix> <asn> or <address> <length> <asn>")
+        yield network, asns
+
+
+def parseSource(text: str) -> Tuple[str, str]:
+    name, sep, path = text.partition("=")
+    if not sep or not name or not path:
+        raise argparse.ArgumentTypeError(f"expected NAME=PATH, got {text}")
+    return name, path
+
+
+def build(args: argparse.Namespace) -> None:
+    sources: List[str] = []
+    networks: List[Tuple[IPNetwork, bool, int]] = []
+
+    def addSource(name: str) -> int:
+        sources.append(name)
+        return len(sources) - 1
+
+    # clean lists come last, so they win over proxy lists for identical networks
+    asnSources: Dict[int, Tuple[bool, int]] = {}
+    for proxy, lists, asnLists in ((True, args.proxy, args.proxy_asns), (False, args.clean, args.clean_asns)):
+        for name, path in lists:
+            source = addSource(name)
+            networks.extend((network, proxy, source) for network in readNetworks(path))
+        for name, path in asnLists:
+            source = addSource(name)
+            asnSources.update((asn, (proxy, source)) for asn in readAsns(path))
+    if asnSources:
+        if not args.asn_prefixes:
+            raise SystemExit("--proxy-asns and --clean-asns need --asn-prefixes")
+        asnNetworks: List[Tuple[IPNetwork, bool, int]] = []
+        for network, asns in readAsnPrefixes(args.asn_prefixes):
+            matching = [asnSources[asn] for asn in asns if asn in asnSources]
+            if matching:
+                # prefixes announced by several listed ASes count as clean if any of them is clean
+                proxy, source = min(matching)
+                asnNetworks.append((network, proxy, source))
+        # explicitly listed networks take precedence over the ASN-derived ones
+        networks = asnNetworks + networks
+    if len(sources) > 0xFFFF:
+        raise SystemExit("Too many sources")
+    intervals = flatten(networks)
+    writeDatabase(args.database, sources, intervals)
+    print(
+        f"Wrote {args.database}: {len(networks)} networks from {len(sources)} sources, "
+        f"{len(intervals[4])} IPv4 and {len(intervals[6])} IPv6 intervals"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compile and query the offline IP reputation database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    buildParser = subparsers.add_parser("build", help="compile CIDR and ASN lists into a database")
+    buildParser.add_argument("database")
+    buildParser.add_argument(
+        "--proxy", type=parseSource, action="append", default=[], metavar="NAME=PATH", help="list of proxy networks"
+    )
+    buildParser.add_argument(
+        "--clean", type=parseSource, action="append", default=[], metavar="NAME=PATH", help="list of clean networks"
+    )
+    buildParser.add_argument("--asn-prefixes", metavar="PATH", help="ASN-to-prefix dump for the ASN lists")
+    buildParser.add_argument(
+        "--proxy-asns", type=parseSource, action="append", default=[], metavar="NAME=PATH", help="list of proxy ASes"
+    )
+    buildParser.add_argument(
+        "--clean-asns", type=parseSource, action="append", default=[], metavar="NAME=PATH", help="list of clean ASes"
+    )
+    lookupParser = subparsers.add_parser("lookup", help="look up addresses in a database")
+    lookupParser.add_argument("database")
+    lookupParser.add_argument("ips", nargs="+")
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args)
+        return
+    file = IntervalFile(args.database)
+    for ip in args.ips:
+        reputation = file.lookup(ip)
+        if reputation is None:
+            print(f"{ip}: unknown")
+        else:
+            print(f"{ip}: {'proxy' if reputation.proxy else 'clean'} ({reputation.source})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import random
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class RetryableError(Exception):
+    """A failure which may go away when the call is repeated, optionally not before retryAfter seconds."""
+
+    def __init__(self, message: str, retryAfter: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CallRefusedError(Exception):
+    """The call was refused locally (e.g. by a quota) without contacting the service."""
+
+
+def parseRetryAfter(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header (delay in seconds or HTTP date)."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retryTime = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retryTime.tzinfo is None:
+        retryTime = retryTime.replace(tzinfo=timezone.utc)
+    return max(0.0, (retryTime - datetime.now(timezone.utc)).total_seconds())
+
+
+@dataclass
+class RetryPolicy:
+    attempts: int = 4
+    baseDelay: float = 0.5
+    maxDelay: float = 8.0
+    # a Retry-After longer than this is not waited for, the call fails instead
+    maxRetryAfter: float = 2.0
+
+    def delay(self, attempt: int, retryAfter: Optional[float]) -> float:
+        """Exponential backoff with full jitter, at least retryAfter."""
+        backoff = random.uniform(0, min(self.maxDelay, self.baseDelay * 2**attempt))
+        return max(backoff, retryAfter or 0.0)
+
+
+@dataclass
+class BreakerState:
+    state: str
+    consecutiveFailures: int
+    # seconds until an open breaker lets a probe call through
+    retryIn: float
+    lastError: Optional[str]
+    # whether the breaker was opened by trip() rather than by failures
+    tripped: bool
+    # number of calls rejected without trying the provider
+    rejectedCalls: int
+
+
+class CircuitBreaker:
+    """Fails calls fast while a service is down.
+
+    The breaker opens after failureThreshold consecutive failed calls or when it is tripped explicitly
+    (e.g. on an exhausted quota). After the cool-down a single probe call is let through (half-open),
+    its outcome closes the breaker or opens it again."""
+
+    def __init__(self, name: str, failureThreshold: int = 5, coolDown: float = 60.0) -> None:
+        self.name = name
+        self.failureThreshold = failureThreshold
+        self.coolDown = coolDown
+        self.state = CLOSED
+        self.consecutiveFailures = 0
+        self.openUntil = 0.0
+        self.lastError: Optional[str] = None
+        self.tripped = False
+        self.rejectedCalls = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> None:
+        """Raise CircuitOpenError unless a call may be made now."""
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() >= self.openUntil:
+                self.state = HALF_OPEN
+                return
+            self.rejectedCalls += 1
+            raise CircuitOpenError(f"{self.name} unavailable: {self.lastError}")
+
+    def allowRetry(self) -> None:
+        """Raise CircuitOpenError if another call has opened the breaker while this one was waiting to retry."""
+        with self.lock:
+            if self.state == OPEN:
+                self.rejectedCalls += 1
+                raise CircuitOpenError(f"{self.name} unavailable: {self.lastError}")
+
+    def release(self) -> None:
+        """Record that an allowed call was not made, a half-open breaker lets the next probe through."""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def recordSuccess(self) -> None:
+        with self.lock:
+            self.state = CLOSED
+            self.consecutiveFailures = 0
+            self.tripped = False
+
+    def recordFailure(self, error: str) -> None:
+        with self.lock:
+            self.consecutiveFailures += 1
+            self.lastError = error
+            if self.state == HALF_OPEN or self.consecutiveFailures >= self.failureThreshold:
+                self.state = OPEN
+                self.tripped = False
+                self.openUntil = time.monotonic() + self.coolDown
+
+    def trip(self, error: str, duration: Optional[float] = None) -> None:
+        """Open the breaker for duration seconds (default: the cool-down)."""
+        with self.lock:
+            self.lastError = error
+            self.state = OPEN
+            self.tripped = True
+            self.openUntil = time.monotonic() + (duration if duration is not None else self.coolDown)
+
+    def status(self) -> BreakerState:
+        with self.lock:
+            return BreakerState(
+                state=self.state,
+                consecutiveFailures=self.consecutiveFailures,
+                retryIn=max(0.0, self.openUntil - time.monotonic()) if self.state == OPEN else 0.0,
+                lastError=self.lastError,
+                tripped=self.tripped,
+                rejectedCalls=self.rejectedCalls,
+            )
+
+
+def callWithRetry(func: Callable[[], T], policy: RetryPolicy, breaker: CircuitBreaker) -> T:
+    """Call func, retrying on RetryableError as long as policy allows.
+
+    Other exceptions are fatal for this call and raised immediately, as the service did answer they do not
+    count as a failure. A call which is still failing after all attempts counts as one breaker failure, a
+    call whose breaker has been opened by another call meanwhile fails fast with CircuitOpenError.
+    CallRefusedError is raised without recording anything, the service has not been contacted."""
+    breaker.allow()
+    attempt = 0
+    while True:
+        try:
+            res = func()
+        except RetryableError as ex:
+            attempt += 1
+            tooLong = ex.retryAfter is not None and ex.retryAfter > policy.maxRetryAfter
+            if attempt >= policy.attempts or tooLong:
+                breaker.recordFailure(str(ex))
+                raise
+            time.sleep(policy.delay(attempt - 1, ex.retryAfter))
+            breaker.allowRetry()
+        except CallRefusedError:
+            breaker.release()
+            raise
+        except Exception:
+            breaker.recordSuccess()
+            raise
+        else:
+            breaker.recordSuccess()
+            return res
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import html
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Optional, Set, Tuple, TypeVar
+
+import metrics
+import pywikibot
+from pywikibot.data import api
+from pywikibot.exceptions import APIError
+
+T = TypeVar("T")
+
+userTemplateRegex = re.compile(r"{{Benutzer\|([^}]+)}}")
+diffLineRegex = re.compile(r'<td class="diff-(added|deleted)line[^"]*">(.*?)</td>', re.DOTALL)
+tagRegex = re.compile(r"<[^>]*>")
+
+
+class RevisionNotReadyException(Exception):
+    pass
+
+
+def parseUserTemplates(text: str) -> "Counter[str]":
+    return Counter(username.strip() for username in userTemplateRegex.findall(text))
+
+
+def parseDiff(body: str) -> Tuple["Counter[str]", "Counter[str]"]:
+    """Return the template arguments on the added and on the deleted lines of an HTML table diff."""
+    added: "Counter[str]" = Counter()
+    deleted: "Counter[str]" = Counter()
+    for side, line in diffLineRegex.findall(body):
+        templates = parseUserTemplates(html.unescape(tagRegex.sub("", line)))
+        (added if side == "added" else deleted).update(templates)
+    return added, deleted
+
+
+class UserTemplateCache:
+    """{{Benutzer|...}} arguments of the latest revisions of a page, keyed by revision id.
+
+    A revision which is not cached is derived from its cached parent revision through the diff between
+    both, the full text is only fetched if there is no cached parent. Revisions which are not yet visible
+    (replication lag) are retried with exponential backoff."""
+
+    def __init__(
+        self, page: pywikibot.Page, maxEntries: int = 10, attempts: int = 6, initialDelay: float = 0.5
+    ) -> None:
+        self.page = page
+        self.maxEntries = maxEntries
+        self.attempts = attempts
+        self.initialDelay = initialDelay
+        self.cache: "OrderedDict[int, Counter[str]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.diffFetches = 0
+        self.textFetches = 0
+
+    def get(self, revision: int) -> "Optional[Counter[str]]":
+        with self.lock:
+            templates = self.cache.get(revision)
+            if templates is not None:
+                self.cache.move_to_end(revision)
+                self.hits += 1
+            return templates
+
+    def put(self, revision: int, templates: "Counter[str]") -> None:
+        with self.lock:
+            self.cache[revision] = templates
+            self.cache.move_to_end(revision)
+            if len(self.cache) > self.maxEntries:
+                self.cache.popitem(last=False)
+
+    def templates(self, revision: int, parentRevision: Optional[int] = None) -> "Counter[str]":
+        templates = self.get(revision)
+        if templates is not None:
+            return templates
+        parentTemplates = self.get(parentRevision) if parentRevision else None
+        if parentRevision and parentTemplates is not None:
+            parent = parentRevision
+            added, deleted = self.waitFor(lambda: self.fetchDiff(parent, revision), f"Diff {parent}/{revision}")
+            templates = parentTemplates + added - deleted
+            with self.lock:
+                self.diffFetches += 1
+        else:
+            templates = parseUserTemplates(self.waitFor(lambda: self.fetchText(revision), f"Revision {revision}"))
+            with self.lock:
+                self.textFetches += 1
+        self.put(revision, templates)
+        return templates
+
+    def newUsers(self, oldRevision: int, newRevision: int) -> Set[str]:
+        """Template arguments present in newRevision but not in oldRevision."""
+        oldTemplates = self.templates(oldRevision)
+        newTemplates = self.templates(newRevision, oldRevision)
+        return {username for username in newTemplates if username not in oldTemplates}
+
+    def waitFor(self, fetch: Callable[[], Optional[T]], what: str) -> T:
+        delay = self.initialDelay
+        for attempt in range(self.attempts):
+            res = fetch()
+            if res is not None:
+                return res
+            if attempt < self.attempts - 1:
+                time.sleep(delay)
+                delay *= 2
+        raise RevisionNotReadyException(f"{what} of {self.page.title()} not available")
+
+    def fetchText(self, revision: int) -> Optional[str]:
+        with metrics.mediawikiRequestSeconds.time("revision"):
+            return self.page.getOldVersion(revision) or None
+
+    def fetchDiff(self, fromRevision: int, toRevision: int) -> Optional[Tuple["Counter[str]", "Counter[str]"]]:
+        request = api.Request(
+            site=self.page.site,
+            parameters={"action": "compare", "fromrev": fromRevision, "torev": toRevision, "prop": "diff"},
+        )
+        try:
+            with metrics.mediawikiRequestSeconds.time("compare"):
+                res = request.submit()
+        except APIError as ex:
+            if ex.code in ("nosuchrevid", "missingcontent"):
+                return None
+            raise
+        compare = res["compare"]
+        return parseDiff(compare.get("body", compare.get("*", "")))
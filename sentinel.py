@@ -4,24 +4,61 @@
 #
 # Distributed under the terms of the MIT license.
 
-import errno
 import locale
 import os
 import re
 import signal
+import threading
 import time
 import traceback
 import ipaddress
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from socket import gaierror, gethostbyname
-from typing import Any, Iterator, cast, List, Tuple, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, cast, List, Tuple, Optional
 
+import metrics
 import pywikibot
+from blockindex import BlockIndex, parseBlockExpiry
+from checkpoint import StreamCheckpoint, StreamPosition
+from cascade import LocalListProvider, createCascades, loadLocalList
+from dnsbl import DnsblChecker, DnsblException
+from eventfilter import DROP, KEEP, EventFilter, FilterRule
+from logwriter import LogWriter
+from pipeline import Pipeline
+from prefetch import Prefetcher
 from pywikibot.bot import SingleSiteBot
-from pywikibot.comms.eventstreams import site_rc_listener
-from vpncheck import CheckException, VpnCheck
+from pywikibot.comms.eventstreams import EventStreams
+from quota import RequestBudget
+from reputation import ReputationDb
+from revisioncache import RevisionNotReadyException, UserTemplateCache
+from sseclient import SSEClient
+from vpncheck import CheckException, CheckResult, VpnCheck
 
 TIMEOUT = 600  # We expect at least one rc entry every 10 minutes
+STATS_INTERVAL = timedelta(minutes=5)
+SHORT_BLOCK_DURATION = timedelta(weeks=1)
+# older events are not processed, after a restart the stream is resumed from at most this far back
+MAX_EVENT_AGE = timedelta(hours=6)
+# lag from which on a restarted sentinel catches up with additional workers and larger log batches
+CATCH_UP_LAG = timedelta(minutes=2)
+CATCH_UP_WORKERS = 8
+CATCH_UP_BATCH = 50
+
+# rules which let through the events that can contain a rollback or undo
+REVERT_RULES = {"revert-comment"}
+# the revert rules come first, reverts on the VM page are checked as well
+EVENT_RULES = [
+    # EventStreams events carry no tags, so rollbacks and undos are recognized by the parts of their
+    # generated summaries which rollbackRegex and undoRegex need instead of the mw-rollback/mw-undo tags
+    FilterRule("revert-comment", KEEP, type="edit", commentContains=("Änderungen von [[", " von [[Special:Contribs/")),
+    FilterRule("vm-edit", KEEP, type="edit", namespace=4, title="Wikipedia:Vandalismusmeldung", bot=False),
+    FilterRule("block-log", KEEP, type="log", logType="block"),
+    FilterRule("anonymous-edit", DROP, type="edit", anonymous=True),
+    FilterRule("edit", DROP, type="edit"),
+    FilterRule("new", DROP, type="new"),
+    FilterRule("categorize", DROP, type="categorize"),
+    FilterRule("log", DROP, type="log"),
+]
 
 
 class ReadingRecentChangesTimeoutError(Exception):
@@ -33,18 +70,67 @@ def on_timeout(signum: Any, frame: Any) -> None:
 
 
 class Controller(SingleSiteBot):
-    def __init__(self) -> None:
+    def __init__(self, workers: int = 4) -> None:
         site = cast(pywikibot.site.APISite, pywikibot.Site())
         site.login()
         super(Controller, self).__init__(site=site)
-        self.generator = FaultTolerantLiveRCPageGenerator(self.site)
         self.rollbackRegex = re.compile(r"Änderungen von \[\[(?:Special:Contributions|Spezial:Beiträge)/([^|]+)\|.+")
         self.undoRegex = re.compile(r"Änderung [0-9]+ von \[\[Special:Contribs/([^|]+)\|.+")
-        self.vmUserTemplateRegex = re.compile(r"{{Benutzer\|([^}]+)}}")
         self.vpnCheck = VpnCheck()
+        self.dnsbl = DnsblChecker()
+        self.cascades = createCascades(
+            self.vpnCheck,
+            [LocalListProvider("local", loadLocalList("local-verdicts.txt"), ReputationDb("reputation.db"))],
+        )
+        # provider requests per day for checking anonymous editors before they are reverted, reported or blocked
+        prefetchBudget = int(os.getenv("PREFETCH_BUDGET", "0"))
+        self.prefetcher: Optional[Prefetcher] = None
+        if prefetchBudget > 0:
+            # prefetchCheck runs every cascade
+            prefetchCost = sum(cascade.maxRequests() for cascade in self.cascades.values())
+            self.prefetcher = Prefetcher(
+                self.vpnCheck, self.prefetchCheck, RequestBudget(prefetchBudget), cost=prefetchCost
+            )
+            self.prefetcher.start()
         self.vmPage = pywikibot.Page(self.site, "Wikipedia:Vandalismusmeldung", 4)
-        self.lastBlockEventsCheckTime = datetime.utcnow()
+        self.vmUserTemplates = UserTemplateCache(self.vmPage)
+        # UTC time of the newest stream event, block log entries are polled from there after a reconnect
+        self.lastEventTime: Optional[datetime] = None
+        self.lastConnectionCount = SSEClient.connection_count
+        metrics.sseConnections.setFunction(lambda: SSEClient.connection_count)
+        self.treatedBlockLogIds: "OrderedDict[int, None]" = OrderedDict()
+        self.treatedBlockLogIdsLock = threading.Lock()
         self.ignoredRangeBlocks = set(["2003::/19"])
+        self.blockIndex = BlockIndex("cache/blockindex.json")
+        if not self.blockIndex.load():
+            pywikibot.output("Seeding block index from block log in the background...")
+        # block log lookups go to the API until the index is current
+        self.blockIndex.startUpdate(self.site)
+        self.logWriter = LogWriter(self.site, "Benutzer:Count Count/iplog", "cache/iplog-journal.jsonl")
+        self.pipeline = Pipeline(workers, self.writeLogEntry)
+        self.lastStatsTime = datetime.utcnow()
+        self.checkpoint = StreamCheckpoint("cache/stream-checkpoint.json", self.pipeline.oldestPendingEventTime)
+        resumeFrom = self.checkpoint.load()
+        self.catchingUp = False
+        self.liveBatching = (self.logWriter.maxEntries, self.logWriter.flushInterval)
+        metrics.catchingUp.setFunction(lambda: float(self.catchingUp))
+        if resumeFrom and time.time() - resumeFrom.timestamp > CATCH_UP_LAG.total_seconds():
+            self.startCatchUp(resumeFrom)
+        self.eventFilter = EventFilter(EVENT_RULES)
+        self.generator = FaultTolerantLiveRCPageGenerator(self.site, self.eventFilter, self.prefetcher, self.checkpoint)
+
+    def startCatchUp(self, resumeFrom: StreamPosition) -> None:
+        """Process the backlog since resumeFrom with more workers, log entries are saved in larger batches."""
+        pywikibot.output(f"Resuming stream from {datetime.utcfromtimestamp(resumeFrom.timestamp)} UTC, catching up...")
+        self.catchingUp = True
+        self.pipeline.addWorkers(CATCH_UP_WORKERS)
+        self.logWriter.setBatching(CATCH_UP_BATCH, STATS_INTERVAL.total_seconds())
+
+    def endCatchUp(self) -> None:
+        pywikibot.output("Caught up with the stream.")
+        self.catchingUp = False
+        self.pipeline.removeWorkers(CATCH_UP_WORKERS)
+        self.logWriter.setBatching(*self.liveBatching)
 
     def setup(self) -> None:
         """Setup the bot."""
@@ -56,44 +142,52 @@ class Controller(SingleSiteBot):
         """Skip special/media pages"""
         if page.namespace() < 0:
             return True
+        elif page._rcinfo["type"] == "log":
+            # blocked users usually do not have a user page
+            return super().skip_page(page)
         elif not page.exists():
             return True
         elif page.isRedirectPage():
             return True
         return super().skip_page(page)
 
+    def prefetchCheck(self, ip: str) -> CheckResult:
+        """Warm the caches for all cascades."""
+        for cascade in self.cascades.values():
+            checkRes = cascade.check(ip)
+        return checkRes
+
+    def liveCheck(self, cascade: str, ip: str) -> CheckResult:
+        if self.prefetcher:
+            self.prefetcher.recordLiveCheck(ip)
+        return self.cascades[cascade].check(ip)
+
     def treatVmPageChange(self, oldRevision: int, newRevision: int) -> None:
-        for _ in range(10):
-            oldText = self.vmPage.getOldVersion(oldRevision)
-            if oldText:
-                break
-            time.sleep(1)
-        else:
-            pywikibot.log(f"Could not find old VM version {oldRevision}")
-            return
-        for _ in range(10):
-            newText = self.vmPage.getOldVersion(newRevision)
-            if newText:
-                break
-            time.sleep(1)
-        else:
-            pywikibot.log(f"Could not find new VM version {newRevision}")
+        try:
+            newReportedUsers = self.vmUserTemplates.newUsers(oldRevision, newRevision)
+        except RevisionNotReadyException as ex:
+            pywikibot.log(str(ex))
             return
-        oldVersionTemplateInstances = set(re.findall(self.vmUserTemplateRegex, oldText))
-        newVersionTemplateInstances = set(re.findall(self.vmUserTemplateRegex, newText))
-        newReportedUsers = newVersionTemplateInstances.difference(oldVersionTemplateInstances)
         for username in newReportedUsers:
-            username = username.strip()
             pwUser = pywikibot.User(self.site, username)
             warnings = ""
             if pwUser.isAnonymous():
-                checkRes = self.vpnCheck.checkWithIpCheck(username)
-                vpnOrProxy = checkRes.score >= 2
-                staticIp = not self.isDynamicIp(username)
+                dynamicIpLookup = self.dnsbl.lookup(username, "dul")
+                checkRes = self.liveCheck("report", username)
+                vpnOrProxy = checkRes.isProxy
+                try:
+                    staticIp = not dynamicIpLookup.result()
+                except DnsblException as ex:
+                    pywikibot.warning(f"Could not determine whether {username} is dynamic: {ex}")
+                    staticIp = False
                 currentlyBlocked = pwUser.isBlocked(force=True)
                 lastBlockTimestamp = self.getLastBlockTImestamp(username, currentlyBlocked)
                 warnings = []
-                if vpnOrProxy:
+                if vpnOrProxy and checkRes.inferredFrom:
+                    warnings.append(
+                        f"Diese IP-Adresse gehört vermutlich zu einem VPN oder Proxy, da schon mehrere Adressen aus {checkRes.inferredFrom} als VPN oder Proxy erkannt wurden."
+                    )
+                elif vpnOrProxy:
                     warnings.append("Diese statische IP-Adresse gehört zu einem VPN oder Proxy.")
                 if staticIp and lastBlockTimestamp:
                     if self.isIpV6(username):
@@ -128,112 +222,224 @@ class Controller(SingleSiteBot):
             return ts.strftime("%-d. %B %Y")
 
     def getLastBlockTImestamp(self, username: str, currentlyBlocked: bool) -> Optional[datetime]:
-        events = self.site.logevents(page=f"User:{username}", logtype="block")
-        evs = [ev for ev in events if ev.action() == "block"]
+        if self.blockIndex.ready.is_set():
+            blockTimestamps = self.blockIndex.lastBlockTimestamps(username)
+        else:
+            events = self.site.logevents(page=f"User:{username}", logtype="block")
+            blockTimestamps = [ev.timestamp() for ev in events if ev.action() == "block"]
         if currentlyBlocked:
-            evs.pop(0)
-        if evs:
-            return evs[0].timestamp()
+            blockTimestamps = blockTimestamps[1:]
+        if blockTimestamps:
+            return blockTimestamps[0]
         return None
 
     def getRangeBlockLogEntries(self, username: str) -> List[Tuple[str, int]]:
-        addr = ipaddress.ip_address(username)
-        res = []
-        if isinstance(addr, ipaddress.IPv4Address):
-            network = ipaddress.ip_network(username).supernet(new_prefix=31)
-            networksToCheck = 16
+        if isinstance(ipaddress.ip_address(username), ipaddress.IPv4Address):
+            minPrefixLen, maxPrefixLen = 16, 31
         else:
-            network = ipaddress.ip_network(username).supernet(new_prefix=64)
-            networksToCheck = 46
-        for _ in range(0, networksToCheck):
+            minPrefixLen, maxPrefixLen = 19, 64
+        if not self.blockIndex.ready.is_set():
+            return self.getRangeBlockLogEntriesFromLog(username, minPrefixLen, maxPrefixLen)
+        return [
+            rangeBlock
+            for rangeBlock in self.blockIndex.enclosingBlockedRanges(username, minPrefixLen, maxPrefixLen)
+            if rangeBlock[0] not in self.ignoredRangeBlocks
+        ]
+
+    def getRangeBlockLogEntriesFromLog(
+        self, username: str, minPrefixLen: int, maxPrefixLen: int
+    ) -> List[Tuple[str, int]]:
+        """Query the block log of every enclosing range, used until the block index is ready."""
+        res = []
+        network = ipaddress.ip_network(username).supernet(new_prefix=maxPrefixLen)
+        while network.prefixlen >= minPrefixLen:
             events = list(self.site.logevents(page=f"User:{str(network)}", logtype="block"))
             if events and not str(network) in self.ignoredRangeBlocks:
                 res.append((str(network), events[0].timestamp().year))
             network = network.supernet()
         return res
 
+    def getInferredSuffix(self, checkRes: CheckResult) -> str:
+        if checkRes.inferredFrom:
+            return f" (inferred from {checkRes.inferredFrom})"
+        return ""
+
     def isIpV6(self, ip: str) -> bool:
         return ip.find(":") != -1
 
-    def isDynamicIp(self, ip: str) -> bool:
-        if self.isIpV6(ip):
-            # IPv6 are almost never dynamic
-            return False
-        elements = ip.split(".")
-        elements.reverse()
-        checkIp = f"{'.'.join(elements)}.dul.dnsbl.sorbs.net"
-        try:
-            _ = gethostbyname(checkIp)
-            return True
-        except gaierror as ex:
-            if ex.errno == -errno.ENOENT or ex.errno == 11001:  # 11001 == WSAHOST_NOT_FOUND
-                return False
-            else:
-                print(ex)
-                raise
-
     def addLogEntry(self, e: str) -> None:
+        self.pipeline.output(e)
+
+    def writeLogEntry(self, e: str) -> None:
         print(e)
-        logPage = pywikibot.Page(self.site, "Benutzer:Count Count/iplog")
-        logPage.text += f"\n* {e}"
-        logPage.save(summary="Bot: Update", botflag=False)
+        self.logWriter.add(e)
 
     def treat(self, page: pywikibot.Page) -> None:
         """Process a single Page object from stream."""
         ch = page._rcinfo
+        treatStart = time.perf_counter()
 
-        ts = datetime.fromtimestamp(ch["timestamp"])
-
-        if datetime.now() - ts > timedelta(minutes=30):
-            pywikibot.warning("Change too old: %s" % (str(datetime.now() - ts)))
+        lag = timedelta(seconds=time.time() - ch["timestamp"])
+        if lag > MAX_EVENT_AGE:
+            pywikibot.warning(f"Change too old: {lag}")
             return
-
-        if os.name != "nt":
-            signal.alarm(TIMEOUT)  # pylint: disable=E1101
+        if self.catchingUp and lag < CATCH_UP_LAG:
+            # the jobs of the backlog must have been worked off as well
+            oldestPending = self.pipeline.oldestPendingEventTime()
+            if oldestPending is None or time.time() - oldestPending < CATCH_UP_LAG.total_seconds():
+                self.endCatchUp()
 
         if ch["type"] == "edit":
             # print(f"Edit on {ch['title']}: {ch['revision']['new']} by {ch['user']}")
             if ch["namespace"] == 4 and ch["title"] == "Wikipedia:Vandalismusmeldung" and not ch["bot"]:
-                self.treatVmPageChange(ch["revision"]["old"], ch["revision"]["new"])
-
-            comment = ch["comment"]
-            rollbackedUser = None
-            searchRes1 = self.rollbackRegex.search(comment)
-            if searchRes1:
-                rollbackedUser = searchRes1.group(1)
-            searchRes2 = self.undoRegex.search(comment)
-            if searchRes2:
-                rollbackedUser = searchRes2.group(1)
-            if rollbackedUser:
-                pyUser = pywikibot.User(self.site, rollbackedUser)
-                if pyUser.isAnonymous():
-                    ip = rollbackedUser
-                    try:
-                        checkRes = self.vpnCheck.checkWithIphub(ip)
-                        if checkRes.score >= 2:
-                            checkRes = self.vpnCheck.checkWithIpCheck(ip)
-                    except CheckException as ex:
-                        self.addLogEntry(f"{ip} could not be checked: {ex}")
-                    else:
-                        if checkRes.score >= 2:
-                            self.addLogEntry(f"IP found after rollback: [[Spezial:Beiträge/{ip}|{ip}]] is a PROXY")
+                self.submitJob(ch["timestamp"], self.treatVmPageChange, ch["revision"]["old"], ch["revision"]["new"])
+
+            if page._rcrule in REVERT_RULES:
+                comment = ch["comment"]
+                rollbackedUser = None
+                searchRes1 = self.rollbackRegex.search(comment)
+                if searchRes1:
+                    rollbackedUser = searchRes1.group(1)
+                searchRes2 = self.undoRegex.search(comment)
+                if searchRes2:
+                    rollbackedUser = searchRes2.group(1)
+                if rollbackedUser:
+                    self.submitJob(ch["timestamp"], self.treatRollback, rollbackedUser)
+        elif ch["type"] == "log" and ch["log_type"] == "block":
+            self.submitJob(
+                ch["timestamp"],
+                self.treatBlockEvent,
+                ch["log_id"],
+                page.title(with_ns=False),
+                ch["log_action"],
+                ch["log_params"] if isinstance(ch["log_params"], dict) else {},
+                datetime.utcfromtimestamp(ch["timestamp"]),
+            )
+
+        if SSEClient.connection_count != self.lastConnectionCount:
+            # events may have been missed while the stream was reconnecting
+            if self.lastEventTime:
+                self.submitJob(ch["timestamp"], self.treatBlockEvents, self.lastEventTime, datetime.utcnow())
+            self.lastConnectionCount = SSEClient.connection_count
+        self.lastEventTime = datetime.utcfromtimestamp(ch["timestamp"])
 
         currentTime = datetime.utcnow()
-        if currentTime - self.lastBlockEventsCheckTime >= timedelta(seconds=30):
-            events = self.site.logevents(reverse=True, start=self.lastBlockEventsCheckTime, logtype="block")
-            for event in events:
-                if event.action() == "block":
-                    pwUser = pywikibot.User(self.site, event.page().title())
-                    if pwUser.isAnonymous() and event.expiry() < currentTime + timedelta(weeks=1):
-                        checkRes = self.vpnCheck.checkWithIpCheck(pwUser.username)
-                        if checkRes.score >= 2:
-                            self.addLogEntry(
-                                f"Blocked IP [[Spezial:Beiträge/{pwUser.username}|{pwUser.username}]] is a PROXY."
-                            )
-            self.lastBlockEventsCheckTime = currentTime
+        if currentTime - self.lastStatsTime >= STATS_INTERVAL:
+            stats = self.pipeline.stats()
+            pywikibot.log(
+                f"Pipeline: queue depth {stats.queueDepth}, output queue depth {stats.outputQueueDepth}, "
+                f"busy workers {stats.busyWorkers}/{len(self.pipeline.workerThreads)}, "
+                f"latency p50 {stats.latencyP50:.1f}s p99 {stats.latencyP99:.1f}s max {stats.latencyMax:.1f}s"
+            )
+            pywikibot.log(
+                f"VM revisions: {self.vmUserTemplates.hits} cached, {self.vmUserTemplates.diffFetches} diffs, "
+                f"{self.vmUserTemplates.textFetches} full texts"
+            )
+            pywikibot.log(
+                "Events dropped by the filter: "
+                + ", ".join(f"{rule} {count}" for rule, count in self.eventFilter.dropCounts().items())
+            )
+            pywikibot.log(f"Provider requests saved by coalescing lookups: {self.vpnCheck.savedRequests}")
+            if self.prefetcher:
+                prefetchStats = self.prefetcher.stats()
+                pywikibot.log(
+                    f"Prefetch: {prefetchStats.prefetched} addresses checked, {prefetchStats.queued} queued, "
+                    f"hit rate {prefetchStats.hitRate:.1%} of {prefetchStats.liveChecks} live checks, "
+                    f"{prefetchStats.requestsUsed} provider requests used, {prefetchStats.requestsRemaining} left today"
+                )
+            for quotaStatus in self.vpnCheck.quotaStates().values():
+                if quotaStatus.dailyQuota:
+                    pywikibot.log(
+                        f"Quota {quotaStatus.provider}: {quotaStatus.used}/{quotaStatus.dailyQuota} used today"
+                    )
+            for provider, breakerState in self.vpnCheck.breakerStates().items():
+                if breakerState.state != "closed" or breakerState.rejectedCalls:
+                    pywikibot.log(
+                        f"Provider {provider}: {breakerState.state}, retry in {breakerState.retryIn:.0f}s, "
+                        f"{breakerState.rejectedCalls} rejected calls, last error: {breakerState.lastError}"
+                    )
+            for cascade in self.cascades.values():
+                pywikibot.log(
+                    f"Cascade {cascade.name}: "
+                    + ", ".join(
+                        f"{provider} ({stats.calls} calls, {stats.decisions} decisions, {stats.latency:.2f}s)"
+                        for provider, stats in cascade.providerStats().items()
+                    )
+                )
+            self.lastStatsTime = currentTime
+        metrics.treatStageSeconds.observe(time.perf_counter() - treatStart, "total")
+
+    def submitJob(self, eventTime: float, func: Callable[..., None], *args: Any) -> None:
+        """Hand a job to the pipeline, waits while the pipeline is saturated."""
+        with metrics.treatStageSeconds.time("submit"):
+            self.pipeline.submit(eventTime, func, *args)
+
+    def treatRollback(self, rollbackedUser: str) -> None:
+        pyUser = pywikibot.User(self.site, rollbackedUser)
+        if pyUser.isAnonymous():
+            ip = rollbackedUser
+            try:
+                checkRes = self.liveCheck("rollback", ip)
+            except CheckException as ex:
+                self.addLogEntry(f"{ip} could not be checked: {ex}")
+            else:
+                if checkRes.isProxy:
+                    self.addLogEntry(
+                        f"IP found after rollback: [[Spezial:Beiträge/{ip}|{ip}]] is a PROXY{self.getInferredSuffix(checkRes)}"
+                    )
+
+    def treatBlockEvents(self, startTime: datetime, endTime: datetime) -> None:
+        """Poll block log entries, used to fill gaps in the stream."""
+        with metrics.mediawikiRequestSeconds.time("logevents"):
+            events = list(self.site.logevents(reverse=True, start=startTime, end=endTime, logtype="block"))
+        for event in events:
+            if "actionhidden" in event.data:
+                continue
+            self.treatBlockEvent(
+                event.logid(),
+                event.page().title(with_ns=False),
+                event.action(),
+                event.data.get("params", {}),
+                event.timestamp(),
+            )
+
+    def treatBlockEvent(
+        self, logId: int, target: str, action: str, logParams: Dict[str, Any], timestamp: datetime
+    ) -> None:
+        with self.treatedBlockLogIdsLock:
+            if logId in self.treatedBlockLogIds:
+                return
+            self.treatedBlockLogIds[logId] = None
+            if len(self.treatedBlockLogIds) > 1000:
+                self.treatedBlockLogIds.popitem(last=False)
+        self.blockIndex.addEvent(target, action, timestamp)
+        self.blockIndex.saveIfDue()
+        if action != "block":
+            return
+        pwUser = pywikibot.User(self.site, target)
+        if not pwUser.isAnonymous():
+            return
+        try:
+            expiry = parseBlockExpiry(logParams, timestamp)
+        except ValueError as ex:
+            pywikibot.warning(f"Block of {target}: {ex}")
+            return
+        if expiry and expiry < datetime.utcnow() + SHORT_BLOCK_DURATION:
+            checkRes = self.liveCheck("report", pwUser.username)
+            if checkRes.isProxy:
+                self.addLogEntry(
+                    f"Blocked IP [[Spezial:Beiträge/{pwUser.username}|{pwUser.username}]] is a PROXY{self.getInferredSuffix(checkRes)}."
+                )
 
     def teardown(self) -> None:
         """Bot has finished due to unknown reason."""
+        if self.prefetcher:
+            self.prefetcher.stop()
+        self.pipeline.stop()
+        self.vpnCheck.close()
+        self.checkpoint.save()
+        self.logWriter.stop()
+        self.blockIndex.save()
         if self._generator_completed:
             pywikibot.log("Main thread exit - THIS SHOULD NOT HAPPEN")
             time.sleep(10)
@@ -244,23 +450,74 @@ class Controller(SingleSiteBot):
         # self.getRangeBlockLogEntries("2a02:8108:7c0:780c:e03a:fc22:3449:e1bf")
 
 
-def FaultTolerantLiveRCPageGenerator(site: pywikibot.site.BaseSite) -> Iterator[pywikibot.Page]:
-    for entry in site_rc_listener(site):
-        # The title in a log entry may have been suppressed
-        if "title" not in entry and entry["type"] == "log":
-            continue
-        try:
-            page = pywikibot.Page(site, entry["title"], entry["namespace"])
-        except Exception:
-            pywikibot.warning("Exception instantiating page %s: %s" % (entry["title"], traceback.format_exc()))
-            continue
-        page._rcinfo = entry
-        yield page
+def rcListener(site: pywikibot.site.BaseSite, resumeFrom: Optional[StreamPosition]) -> Iterable[Dict[str, Any]]:
+    """Recent changes of site from EventStreams, starting after resumeFrom if given.
+
+    The stream is resumed by event id if known, otherwise by timestamp, but not from further back than
+    MAX_EVENT_AGE."""
+    kwargs: Dict[str, Any] = {}
+    if resumeFrom:
+        oldest = time.time() - MAX_EVENT_AGE.total_seconds()
+        if resumeFrom.eventId and resumeFrom.timestamp >= oldest:
+            kwargs["last_id"] = resumeFrom.eventId
+        else:
+            since = datetime.utcfromtimestamp(max(resumeFrom.timestamp, oldest))
+            kwargs["since"] = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+    stream = EventStreams(streams="recentchange", site=site, **kwargs)
+    stream.register_filter(server_name=site.hostname())
+    return stream
+
+
+def lastEventId(stream: Iterable[Dict[str, Any]]) -> Optional[str]:
+    """Id of the event last read from stream, None if unknown."""
+    return getattr(getattr(stream, "source", None), "last_id", None)
+
+
+def pageForEvent(site: pywikibot.site.BaseSite, entry: Dict[str, Any]) -> Optional[pywikibot.Page]:
+    # The title in a log entry may have been suppressed
+    if "title" not in entry and entry["type"] == "log":
+        return None
+    try:
+        page = pywikibot.Page(site, entry["title"], entry["namespace"])
+    except Exception:
+        pywikibot.warning("Exception instantiating page %s: %s" % (entry["title"], traceback.format_exc()))
+        return None
+    page._rcinfo = entry
+    return page
+
+
+def FaultTolerantLiveRCPageGenerator(
+    site: pywikibot.site.BaseSite,
+    eventFilter: EventFilter,
+    prefetcher: Optional[Prefetcher] = None,
+    checkpoint: Optional[StreamCheckpoint] = None,
+) -> Iterator[pywikibot.Page]:
+    """Pages of the recent changes events which pass eventFilter, no Page is created for the others.
+
+    All events are shown to prefetcher. The stream is resumed from checkpoint, which is advanced once
+    the consumer is done with an event."""
+    stream = rcListener(site, checkpoint.saved if checkpoint else None)
+    for entry in stream:
+        eventId = lastEventId(stream)
+        if os.name != "nt":
+            signal.alarm(TIMEOUT)  # pylint: disable=E1101
+        metrics.streamLag.set(time.time() - entry["timestamp"])
+        if prefetcher:
+            prefetcher.observe(entry)
+        rule = eventFilter.match(entry)
+        page = pageForEvent(site, entry) if rule.action == KEEP else None
+        if page is not None:
+            page._rcrule = rule.name
+            yield page
+        if checkpoint:
+            checkpoint.advance(eventId, entry["timestamp"])
+            checkpoint.saveIfDue()
 
 
 def main() -> None:
     locale.setlocale(locale.LC_ALL, "de_DE.utf8")
     # pywikibot.handle_args()
+    metrics.startServer(int(os.getenv("METRICS_PORT", "9090")))
     Controller().run()
     # Controller().test()
 
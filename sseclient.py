@@ -20,14 +20,27 @@ __version__ = '0.0.24'
 # Technically, we should support streams that mix line endings.  This regex,
 # however, assumes that a system will provide consistent line endings.
 end_of_field = re.compile(r'\r\n\r\n|\r\r|\n\n')
+end_of_field_bytes = re.compile(br'\r\n\r\n|\r\r|\n\n')
+# longest separator minus one: a separator may straddle two chunks
+max_partial_separator = 3
 
 
 class SSEClient(object):
-    def __init__(self, url, last_id=None, retry=3000, session=None, chunk_size=1024, **kwargs):
+    # number of connection attempts of all clients, lets users notice reconnects
+    connection_count = 0
+
+    def __init__(self, url, last_id=None, retry=3000, session=None, chunk_size=1024,
+                 max_chunk_size=65536, legacy_parser=False, **kwargs):
         self.url = url
         self.last_id = last_id
         self.retry = retry
         self.chunk_size = chunk_size
+        # chunk_size grows up to max_chunk_size while reads keep returning full chunks.
+        # Set it to chunk_size to disable adaptive sizing.
+        self.max_chunk_size = max(chunk_size, max_chunk_size)
+        # The legacy parser works on a decoded string buffer and rescans the
+        # whole buffer for every chunk, see _next_legacy().
+        self.legacy_parser = legacy_parser
 
         # Optional support for passing in a requests.Session()
         self.session = session
@@ -46,9 +59,17 @@ class SSEClient(object):
         # Keep data here as it streams in
         self.buf = ''
 
+        # Raw data for the incremental parser. Events are consumed from
+        # buf_start on, data before it is dropped only when it makes up most
+        # of the buffer. scan_pos is where the search for end_of_field resumes.
+        self.raw_buf = bytearray()
+        self.buf_start = 0
+        self.scan_pos = 0
+
         self._connect()
 
     def _connect(self):
+        SSEClient.connection_count += 1
         if self.last_id:
             self.requests_kwargs['headers']['Last-Event-ID'] = self.last_id
 
@@ -74,6 +95,9 @@ class SSEClient(object):
                     chunk = self.resp.raw._fp.fp.read1(self.chunk_size)
                     if not chunk:
                         break
+                    if len(chunk) == self.chunk_size and self.chunk_size < self.max_chunk_size:
+                        # more data was available than we asked for
+                        self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
                     yield chunk
             return generate()
         else:
@@ -88,6 +112,57 @@ class SSEClient(object):
         return self
 
     def __next__(self):
+        if self.legacy_parser:
+            event_string = self._next_legacy()
+        else:
+            event_string = self._next_incremental()
+        msg = Event.parse(event_string)
+
+        # If the server requests a specific retry delay, we need to honor it.
+        if msg.retry:
+            self.retry = msg.retry
+
+        # last_id should only be set if included in the message.  It's not
+        # forgotten if a message omits it.
+        if msg.id:
+            self.last_id = msg.id
+
+        return msg
+
+    def _next_incremental(self):
+        while True:
+            match = end_of_field_bytes.search(self.raw_buf, self.scan_pos)
+            if match:
+                break
+            self.scan_pos = max(self.buf_start, len(self.raw_buf) - max_partial_separator)
+            try:
+                next_chunk = next(self.resp_iterator)
+                if not next_chunk:
+                    raise EOFError()
+                self.raw_buf += next_chunk
+
+            except (StopIteration, requests.RequestException, EOFError, six.moves.http_client.IncompleteRead) as e:
+                print(e)
+                time.sleep(self.retry / 1000.0)
+                self._connect()
+
+                # The SSE spec only supports resuming from a whole message, so
+                # if we have half a message we should throw it out.
+                last_line_end = self.raw_buf.rfind(b'\n', self.buf_start)
+                del self.raw_buf[max(last_line_end + 1, self.buf_start):]
+                self.scan_pos = self.buf_start
+                continue
+
+        # Decode only the complete event, the rest stays in raw_buf.
+        with memoryview(self.raw_buf) as view:
+            event_string = str(view[self.buf_start:match.start()], 'utf-8', 'replace')
+        self.buf_start = self.scan_pos = match.end()
+        if self.buf_start * 2 > len(self.raw_buf):
+            del self.raw_buf[:self.buf_start]
+            self.buf_start = self.scan_pos = 0
+        return event_string
+
+    def _next_legacy(self):
         while not self._event_complete():
             try:
                 next_chunk = next(self.resp_iterator)
@@ -110,18 +185,7 @@ class SSEClient(object):
         # and retain anything after the current complete event in self.buf
         # for next time.
         (event_string, self.buf) = re.split(end_of_field, self.buf, maxsplit=1)
-        msg = Event.parse(event_string)
-
-        # If the server requests a specific retry delay, we need to honor it.
-        if msg.retry:
-            self.retry = msg.retry
-
-        # last_id should only be set if included in the message.  It's not
-        # forgotten if a message omits it.
-        if msg.id:
-            self.last_id = msg.id
-
-        return msg
+        return event_string
 
     if six.PY2:
         next = __next__
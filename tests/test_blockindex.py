@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+import pytest
+from blockindex import BlockIndex
+
+START = datetime(2020, 1, 1)
+
+
+class StubLogEvent:
+    def __init__(self, target: str, action: str, timestamp: datetime) -> None:
+        self.target = target
+        self.actionName = action
+        self.time = timestamp
+        self.data: Dict[str, Any] = {}
+
+    def page(self) -> Any:
+        event = self
+
+        class Page:
+            def title(self, with_ns: bool = True) -> str:  # pylint: disable=invalid-name,unused-argument
+                return event.target
+
+        return Page()
+
+    def action(self) -> str:
+        return self.actionName
+
+    def timestamp(self) -> datetime:
+        return self.time
+
+
+class StubSite:
+    """Block log of one block per minute, optionally failing after failAfter entries."""
+
+    def __init__(self, count: int, failAfter: Optional[int] = None) -> None:
+        self.events = [StubLogEvent(f"192.0.2.{i}", "block", START + timedelta(minutes=i)) for i in range(count)]
+        self.failAfter = failAfter
+        self.starts: List[Optional[datetime]] = []
+
+    def logevents(self, logtype: str, reverse: bool, start: Optional[datetime]) -> Iterator[StubLogEvent]:
+        self.starts.append(start)
+        for i, event in enumerate(e for e in self.events if start is None or e.time >= start):
+            if self.failAfter is not None and i >= self.failAfter:
+                raise ConnectionError("pod restarted")
+            yield event
+
+
+def testInterruptedSeedResumes(tmp_path: Any) -> None:
+    path = str(tmp_path / "blockindex.json")
+    site = StubSite(100, failAfter=60)
+    index = BlockIndex(path, saveInterval=0)
+    with pytest.raises(ConnectionError):
+        index.update(site)  # type: ignore
+
+    resumed = BlockIndex(path)
+    assert resumed.load()
+    assert resumed.lastTimestamp == START + timedelta(minutes=59)
+    site.failAfter = None
+    resumed.update(site)  # type: ignore
+    assert site.starts[-1] == START + timedelta(minutes=59)
+    assert resumed.lastBlockTimestamps("192.0.2.99") == [START + timedelta(minutes=99)]
+    # the entry at the resume point is read again, but not recorded twice
+    assert resumed.lastBlockTimestamps("192.0.2.59") == [START + timedelta(minutes=59)]
+
+
+def testEnclosingBlockedRanges(tmp_path: Any) -> None:
+    index = BlockIndex(str(tmp_path / "blockindex.json"))
+    index.addEvent("192.0.2.0/24", "block", datetime(2018, 5, 1))
+    index.addEvent("192.0.0.0/16", "block", datetime(2019, 5, 1))
+    index.addEvent("192.0.2.0/24", "unblock", datetime(2020, 5, 1))
+    assert index.enclosingBlockedRanges("192.0.2.1", 16, 24) == [("192.0.2.0/24", 2020), ("192.0.0.0/16", 2019)]
+    assert index.enclosingBlockedRanges("192.0.2.1", 20, 24) == [("192.0.2.0/24", 2020)]
+
+
+def testBackgroundSeed(tmp_path: Any) -> None:
+    index = BlockIndex(str(tmp_path / "blockindex.json"))
+    index.startUpdate(StubSite(100)).join()  # type: ignore
+    assert index.ready.is_set()
+    assert index.lastBlockTimestamps("192.0.2.99") == [START + timedelta(minutes=99)]
+
+
+def testFailedSeedIsNotReady(tmp_path: Any) -> None:
+    index = BlockIndex(str(tmp_path / "blockindex.json"))
+    index.startUpdate(StubSite(100, failAfter=10)).join()  # type: ignore
+    assert not index.ready.is_set()
+
+
+def testStreamEventsDoNotMoveTheResumePointWhileSeeding(tmp_path: Any) -> None:
+    index = BlockIndex(str(tmp_path / "blockindex.json"))
+    index.addEvent("198.51.100.1", "block", START + timedelta(days=1))
+    assert index.lastTimestamp is None
+    assert index.lastBlockTimestamps("198.51.100.1") == [START + timedelta(days=1)]
+    index.update(StubSite(10))  # type: ignore
+    assert index.lastTimestamp == START + timedelta(minutes=9)
+    index.addEvent("198.51.100.2", "block", START + timedelta(days=2))
+    assert index.lastTimestamp == START + timedelta(days=2)
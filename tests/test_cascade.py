@@ -0,0 +1,85 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+from typing import List, Optional
+
+import pytest
+from cascade import ALL, ANY, Cascade, LocalListProvider, Provider
+from vpncheck import PROXY_SCORE, CheckException, CheckResult, QuotaExceededException
+
+
+class FakeProvider(Provider):
+    def __init__(self, name: str, score: Optional[int] = None, error: Optional[CheckException] = None) -> None:
+        super().__init__(name, initialLatency=0.1)
+        self.score = score
+        self.error = error
+        self.checked: List[str] = []
+
+    def check(self, ip: str) -> Optional[CheckResult]:
+        self.checked.append(ip)
+        if self.error:
+            raise self.error
+        return None if self.score is None else CheckResult(score=self.score, cached=False)
+
+
+def testProviderIsAbstract() -> None:
+    with pytest.raises(TypeError):
+        Provider("abstract")  # type: ignore  # pylint: disable=abstract-class-instantiated
+
+
+def testAllStopsAtFirstNegativeVerdict() -> None:
+    first, second = FakeProvider("first", 0), FakeProvider("second", PROXY_SCORE)
+    result = Cascade("test", [first, second], ALL).check("192.0.2.1")
+    assert not result.isProxy
+    assert not second.checked
+
+
+def testAllNeedsEveryVerdict() -> None:
+    first, second = FakeProvider("first", PROXY_SCORE), FakeProvider("second", PROXY_SCORE + 1)
+    result = Cascade("test", [first, second], ALL).check("192.0.2.1")
+    assert result.score == PROXY_SCORE
+    assert second.checked
+
+
+def testAnyStopsAtFirstPositiveVerdict() -> None:
+    first, second = FakeProvider("first", PROXY_SCORE), FakeProvider("second", 0)
+    assert Cascade("test", [first, second], ANY).check("192.0.2.1").isProxy
+    assert not second.checked
+
+
+def testErrorsAreSkipped() -> None:
+    first, second = FakeProvider("first", error=CheckException("timeout")), FakeProvider("second", 0)
+    cascade = Cascade("test", [first, second], ALL)
+    assert not cascade.check("192.0.2.1").isProxy
+    assert cascade.providerStats()["first"].errors == 1
+
+
+def testUndecidedErrorIsRaised() -> None:
+    first, second = FakeProvider("first", PROXY_SCORE), FakeProvider("second", error=CheckException("timeout"))
+    with pytest.raises(CheckException):
+        Cascade("test", [first, second], ALL).check("192.0.2.1")
+
+
+def testExhaustedQuotaStopsTheCascade() -> None:
+    first = FakeProvider("first", error=QuotaExceededException("quota exceeded"))
+    second = FakeProvider("second", PROXY_SCORE)
+    cascade = Cascade("test", [first, second], ALL)
+    with pytest.raises(QuotaExceededException):
+        cascade.check("192.0.2.1")
+    assert not second.checked
+    assert cascade.providerStats()["first"].errors == 1
+
+
+def testLocalListIsFinal() -> None:
+    local = LocalListProvider("local", {"192.0.2.0/24": False, "192.0.2.128/25": True})
+    remote = FakeProvider("remote", 0)
+    cascade = Cascade("test", [local, remote], ALL)
+    assert cascade.check("192.0.2.200").isProxy
+    assert not cascade.check("192.0.2.1").isProxy
+    assert not remote.checked
+    assert cascade.check("198.51.100.1").tier == "remote"
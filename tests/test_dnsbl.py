@@ -0,0 +1,153 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterator
+
+import pytest
+from dnsbl import DnsblChecker, DnsblException, DnsblZone, reverseName
+
+ZONE = DnsblZone(name="test", zone="dnsbl.test")
+ZONE6 = DnsblZone(name="test6", zone="dnsbl6.test", ipv6=True)
+
+
+class StubResolver:
+    """Answers DNS queries on 127.0.0.1 according to the behavior configured for the queried name.
+
+    Behaviors: "listed" (A record), "nxdomain" (with SOA), "timeout" (no answer), "malformed" (truncated
+    answer section) and "servfail". Unconfigured names are answered with NXDOMAIN."""
+
+    def __init__(self) -> None:
+        self.behaviors: Dict[str, str] = {}
+        self.queries: "Counter[str]" = Counter()
+        self.ttl = 300
+        self.soaTtl = 3600
+        self.soaMinimum = 120
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                packet, address = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            questionEnd = packet.index(b"\0", 12) + 5
+            question = packet[12:questionEnd]
+            labels = []
+            offset = 0
+            while question[offset]:
+                labels.append(question[offset + 1 : offset + 1 + question[offset]].decode("ascii"))
+                offset += 1 + question[offset]
+            name = ".".join(labels)
+            self.queries[name] += 1
+            behavior = self.behaviors.get(name, "nxdomain")
+            queryId = packet[:2]
+            if behavior == "timeout":
+                continue
+            if behavior == "listed":
+                answer = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, self.ttl, 4) + bytes([127, 0, 0, 10])
+                reply = queryId + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0) + question + answer
+            elif behavior == "malformed":
+                reply = queryId + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0) + question + b"\xc0\x0c\x00"
+            elif behavior == "servfail":
+                reply = queryId + struct.pack("!HHHHH", 0x8182, 1, 0, 0, 0) + question
+            else:
+                soaData = b"\0\0" + struct.pack("!IIIII", 1, 3600, 600, 86400, self.soaMinimum)
+                authority = b"\xc0\x0c" + struct.pack("!HHIH", 6, 1, self.soaTtl, len(soaData)) + soaData
+                reply = queryId + struct.pack("!HHHHH", 0x8183, 1, 0, 1, 0) + question + authority
+            self.sock.sendto(reply, address)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+@pytest.fixture
+def resolver() -> Iterator[StubResolver]:
+    stub = StubResolver()
+    yield stub
+    stub.close()
+
+
+def createChecker(resolver: StubResolver) -> DnsblChecker:
+    return DnsblChecker(
+        zones=[ZONE, ZONE6], nameserver="127.0.0.1", port=resolver.port, timeout=0.2, attempts=2, minTtl=1
+    )
+
+
+def testReverseName() -> None:
+    assert reverseName("192.0.2.1", "dnsbl.test") == "1.2.0.192.dnsbl.test"
+    assert reverseName("2001:db8::1", "z.test") == "1.0.0.0." + "0." * 20 + "8.b.d.0.1.0.0.2.z.test"
+
+
+def testListed(resolver: StubResolver) -> None:
+    name = reverseName("192.0.2.1", ZONE.zone)
+    resolver.behaviors[name] = "listed"
+    checker = createChecker(resolver)
+    assert checker.isListed("192.0.2.1", "test")
+    # served from the cache for the TTL of the answer
+    assert checker.isListed("192.0.2.1", "test")
+    assert resolver.queries[name] == 1
+    expiry, listed = checker.cache[("test", "192.0.2.1")]
+    assert listed
+    assert expiry - time.monotonic() == pytest.approx(resolver.ttl, abs=5)
+
+
+def testNxdomain(resolver: StubResolver) -> None:
+    checker = createChecker(resolver)
+    assert not checker.isListed("192.0.2.2", "test")
+    # negative answers are cached for min(SOA TTL, SOA minimum)
+    expiry, listed = checker.cache[("test", "192.0.2.2")]
+    assert not listed
+    assert expiry - time.monotonic() == pytest.approx(resolver.soaMinimum, abs=5)
+
+
+def testTimeout(resolver: StubResolver) -> None:
+    name = reverseName("192.0.2.3", ZONE.zone)
+    resolver.behaviors[name] = "timeout"
+    checker = createChecker(resolver)
+    start = time.monotonic()
+    with pytest.raises(DnsblException):
+        checker.isListed("192.0.2.3", "test")
+    assert time.monotonic() - start < 2
+    assert resolver.queries[name] == 2
+    assert ("test", "192.0.2.3") not in checker.cache
+
+
+@pytest.mark.parametrize("behavior", ["malformed", "servfail"])
+def testBadReply(resolver: StubResolver, behavior: str) -> None:
+    resolver.behaviors[reverseName("192.0.2.4", ZONE.zone)] = behavior
+    with pytest.raises(DnsblException):
+        createChecker(resolver).isListed("192.0.2.4", "test")
+
+
+def testIpv6(resolver: StubResolver) -> None:
+    resolver.behaviors[reverseName("2001:db8::1", ZONE6.zone)] = "listed"
+    checker = createChecker(resolver)
+    assert checker.isListed("2001:db8::1", "test6")
+    # the zone does not list IPv6 addresses, it is not asked
+    assert not checker.isListed("2001:db8::1", "test")
+    assert sum(resolver.queries.values()) == 1
+
+
+def testLookupMany(resolver: StubResolver) -> None:
+    ips = [f"192.0.2.{i}" for i in range(10, 20)]
+    for ip in ips[:3]:
+        resolver.behaviors[reverseName(ip, ZONE.zone)] = "listed"
+    resolver.behaviors[reverseName(ips[3], ZONE.zone)] = "timeout"
+    res = createChecker(resolver).lookupMany(ips, "test")
+    # addresses which could not be looked up are left out
+    assert set(res) == set(ips) - {ips[3]}
+    assert {ip for ip, listed in res.items() if listed} == set(ips[:3])
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+from typing import Any, Dict
+
+import pytest
+from eventfilter import DROP, KEEP, EventFilter, FilterRule, isIpAddress
+from sentinel import EVENT_RULES, REVERT_RULES
+
+ROLLBACK_COMMENT = "Änderungen von [[Spezial:Beiträge/192.0.2.1|192.0.2.1]] rückgängig gemacht"
+UNDO_COMMENT = "Änderung 1 von [[Special:Contribs/192.0.2.1|192.0.2.1]] rückgängig gemacht"
+
+
+def edit(**fields: Any) -> Dict[str, Any]:
+    event = {
+        "type": "edit",
+        "namespace": 0,
+        "title": "Beispiel",
+        "user": "Beispielnutzer",
+        "bot": False,
+        "comment": "",
+    }
+    event.update(fields)
+    return event
+
+
+def testIsIpAddress() -> None:
+    assert isIpAddress("192.0.2.1")
+    assert isIpAddress("2001:db8::1")
+    assert not isIpAddress("Beispielnutzer")
+    assert not isIpAddress("192.0.2.0/24")
+
+
+def testFirstMatchingRuleWins() -> None:
+    eventFilter = EventFilter([FilterRule("first", KEEP, type="edit"), FilterRule("second", DROP, type="edit")])
+    assert eventFilter.match(edit()).name == "first"
+
+
+def testDefaultRuleAndDropCounts() -> None:
+    eventFilter = EventFilter([FilterRule("edits", DROP, type="edit")], defaultAction=KEEP)
+    eventFilter.match(edit())
+    eventFilter.match(edit())
+    assert eventFilter.match({"type": "log"}).name == "default"
+    assert eventFilter.dropCounts() == {"edits": 2}
+
+
+def testConditions() -> None:
+    rule = FilterRule(
+        "rule", KEEP, type="edit", namespace=4, anonymous=True, tags=("mw-undo",), commentContains=("Änderung",)
+    )
+    event = edit(namespace=4, user="192.0.2.1", tags=["mw-undo"], comment="Änderung 1 rückgängig")
+    assert rule.matches(event)
+    assert not rule.matches({**event, "namespace": 0})
+    assert not rule.matches({**event, "user": "Beispielnutzer"})
+    assert not rule.matches({**event, "tags": []})
+    assert not rule.matches({**event, "comment": "Tippfehler"})
+
+
+def testUnknownActionIsRejected() -> None:
+    with pytest.raises(ValueError):
+        EventFilter([FilterRule("rule", "maybe")])
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        edit(comment=ROLLBACK_COMMENT),
+        edit(comment=UNDO_COMMENT),
+        edit(namespace=4, title="Wikipedia:Vandalismusmeldung", comment=ROLLBACK_COMMENT),
+        edit(namespace=4, title="Wikipedia:Vandalismusmeldung", comment=UNDO_COMMENT),
+    ],
+)
+def testRevertsAreCheckedForRollbacks(event: Dict[str, Any]) -> None:
+    rule = EventFilter(EVENT_RULES).match(event)
+    assert rule.action == KEEP
+    assert rule.name in REVERT_RULES
+
+
+def testOtherSummariesAreNotCheckedForRollbacks() -> None:
+    eventFilter = EventFilter(EVENT_RULES)
+    assert eventFilter.match(edit(comment="Änderungen übernommen")).action == DROP
+    assert eventFilter.match(edit(comment="Änderung 1 rückgängig gemacht")).action == DROP
+
+
+def testSentinelRules() -> None:
+    eventFilter = EventFilter(EVENT_RULES)
+    assert eventFilter.match(edit(namespace=4, title="Wikipedia:Vandalismusmeldung")).name == "vm-edit"
+    assert eventFilter.match(edit(namespace=4, title="Wikipedia:Vandalismusmeldung", bot=True)).action == DROP
+    assert eventFilter.match({"type": "log", "log_type": "block", "user": "Admin"}).action == KEEP
+    assert eventFilter.match(edit(user="192.0.2.1")).name == "anonymous-edit"
+    assert eventFilter.match(edit()).action == DROP
+    assert eventFilter.match({"type": "categorize"}).action == DROP
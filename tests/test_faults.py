@@ -0,0 +1,202 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+"""Provider retry logic and circuit breakers against a local fault-injecting stub server.
+
+Each test queues faults which the stub answers the next requests with, later requests succeed."""
+
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Iterator, List
+
+import pytest
+from quota import QuotaLimiter
+from retry import CLOSED, OPEN, RetryPolicy
+from vpncheck import CheckException, QuotaExceededException, VpnCheck
+
+IPCHECK_RESPONSE = {
+    "teohio": {"result": {"vpnOrProxy": False}},
+    "proxycheck": {"result": {"proxy": False}},
+    "getIPIntel": {"result": {"chance": 0}},
+    "ipQualityScore": {"result": {"proxy": False, "vpn": False}},
+    "cache": {"result": {"cached": "no"}},
+}
+TEOH_RESPONSE = {"vpn_or_proxy": "no"}
+READ_TIMEOUT = 0.5
+
+# fault -> (status, extra headers, body); "hang" does not answer within the read timeout
+FAULTS = {
+    "ok": (200, {}, None),
+    "500": (500, {}, b"Internal Server Error"),
+    "503": (503, {}, b"Service Unavailable"),
+    "404": (404, {}, b"Not Found"),
+    "429-short": (429, {"Retry-After": "1"}, b"Too Many Requests"),
+    "429-long": (429, {"Retry-After": "3600"}, b"Too Many Requests"),
+    "garbage": (200, {}, b"<html>Bad Gateway</html>"),
+    "teoh-quota": (200, {}, json.dumps({"message": "Exceeded limit of 1000 requests per day"}).encode("utf-8")),
+    "teoh-error": (200, {}, json.dumps({"message": "Invalid IP address"}).encode("utf-8")),
+}
+
+
+class FaultServer(ThreadingHTTPServer):
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), FaultHandler)
+        self.plan: Deque[str] = deque()
+        self.requestCount = 0
+        self.planLock = threading.Lock()
+
+    def queue(self, faults: List[str]) -> None:
+        with self.planLock:
+            self.plan.clear()
+            self.plan.extend(faults)
+            self.requestCount = 0
+
+
+class FaultHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: FaultServer
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        with self.server.planLock:
+            fault = self.server.plan.popleft() if self.server.plan else "ok"
+            self.server.requestCount += 1
+        if fault == "hang":
+            time.sleep(READ_TIMEOUT * 2)
+            fault = "ok"
+        status, headers, body = FAULTS[fault]
+        if body is None:
+            body = json.dumps(TEOH_RESPONSE if self.path.startswith("/teoh/") else IPCHECK_RESPONSE).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting
+            pass
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture(scope="module")
+def server() -> Iterator[FaultServer]:
+    faultServer = FaultServer()
+    threading.Thread(target=faultServer.serve_forever, daemon=True).start()
+    yield faultServer
+    faultServer.shutdown()
+
+
+@pytest.fixture
+def vpnCheck(server: FaultServer, tmp_path: Any, monkeypatch: Any) -> Iterator[VpnCheck]:
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("cache")
+    check = VpnCheck(readTimeout=READ_TIMEOUT)
+    baseUrl = f"http://127.0.0.1:{server.server_address[1]}"
+    check.teohUrl = f"{baseUrl}/teoh/"
+    check.ipcheckUrl = f"{baseUrl}/index.php"
+    # the stub has no rate limit
+    for provider in check.limiters:
+        check.limiters[provider] = QuotaLimiter(f"cache/quota-{provider}.json", provider, None, 1e6, 10**6)
+    check.retryPolicy = RetryPolicy(attempts=4, baseDelay=0.01, maxDelay=0.05, maxRetryAfter=2.0)
+    yield check
+    check.close()
+
+
+def lookups(vpnCheck: VpnCheck, provider: str, count: int = 1) -> List[str]:
+    """Outcomes of count lookups of different addresses: "ok" or the name of the exception."""
+    fetch: Callable[[str], Any] = vpnCheck.fetchFromTeoh if provider == "teoh" else vpnCheck.fetchFromIpCheck
+    outcomes = []
+    for i in range(count):
+        try:
+            fetch(f"10.0.0.{i + 1}")
+            outcomes.append("ok")
+        except CheckException as ex:
+            outcomes.append(type(ex).__name__)
+    return outcomes
+
+
+@pytest.mark.parametrize(
+    "faults",
+    [["500", "503"], ["garbage"], ["hang"], ["429-short"]],
+    ids=["server errors", "garbled response", "read timeout", "short Retry-After"],
+)
+def testTransientFaultsAreRetried(server: FaultServer, vpnCheck: VpnCheck, faults: List[str]) -> None:
+    server.queue(faults)
+    assert lookups(vpnCheck, "ipcheck") == ["ok"]
+    assert server.requestCount == len(faults) + 1
+    status = vpnCheck.breakers["ipcheck"].status()
+    assert status.state == CLOSED
+    assert status.consecutiveFailures == 0
+
+
+def testShortRetryAfterIsRespected(server: FaultServer, vpnCheck: VpnCheck) -> None:
+    server.queue(["429-short"])
+    start = time.monotonic()
+    assert lookups(vpnCheck, "ipcheck") == ["ok"]
+    assert time.monotonic() - start >= 1.0
+
+
+def testNotFoundIsFatal(server: FaultServer, vpnCheck: VpnCheck) -> None:
+    server.queue(["404"])
+    assert lookups(vpnCheck, "ipcheck") == ["CheckException"]
+    assert server.requestCount == 1
+    assert vpnCheck.breakers["ipcheck"].status().consecutiveFailures == 0
+
+
+def testProviderDownOpensTheBreaker(server: FaultServer, vpnCheck: VpnCheck) -> None:
+    server.queue(["503"] * 100)
+    assert lookups(vpnCheck, "ipcheck", 8) == ["CheckException"] * 8
+    status = vpnCheck.breakers["ipcheck"].status()
+    assert status.state == OPEN
+    assert not status.tripped
+    # the calls after the fifth failed one are rejected without requests
+    assert server.requestCount == 5 * 4
+    assert status.rejectedCalls == 3
+
+    server.queue([])
+    vpnCheck.breakers["ipcheck"].openUntil = time.monotonic()
+    assert lookups(vpnCheck, "ipcheck") == ["ok"]
+    assert vpnCheck.breakers["ipcheck"].status().state == CLOSED
+
+
+def testLongRetryAfterTripsTheBreaker(server: FaultServer, vpnCheck: VpnCheck) -> None:
+    server.queue(["429-long"])
+    start = time.monotonic()
+    assert lookups(vpnCheck, "ipcheck", 3) == ["QuotaExceededException"] * 3
+    # not waited for
+    assert time.monotonic() - start < 1.0
+    assert server.requestCount == 1
+    status = vpnCheck.breakers["ipcheck"].status()
+    assert status.tripped
+    assert status.retryIn > 3000
+
+
+def testTeohErrorMessage(server: FaultServer, vpnCheck: VpnCheck) -> None:
+    server.queue(["teoh-error"])
+    assert lookups(vpnCheck, "teoh") == ["CheckException"]
+    assert server.requestCount == 1
+    assert vpnCheck.breakers["teoh"].status().state == CLOSED
+
+
+def testTeohQuotaExceeded(server: FaultServer, vpnCheck: VpnCheck) -> None:
+    server.queue(["teoh-quota"])
+    assert lookups(vpnCheck, "teoh", 3) == ["QuotaExceededException"] * 3
+    assert server.requestCount == 1
+    assert vpnCheck.breakers["teoh"].status().tripped
+
+
+def testQuotaExceededIsACheckException() -> None:
+    assert issubclass(QuotaExceededException, CheckException)
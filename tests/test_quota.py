@@ -0,0 +1,47 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import pytest
+from quota import QuotaRefusedError, RequestBudget
+
+
+def testReservationIsSetAside() -> None:
+    budget = RequestBudget(5)
+    reservation = budget.reserve(3)
+    assert budget.remaining() == 2
+    with pytest.raises(QuotaRefusedError):
+        budget.reserve(3)
+    reservation.take()
+    assert budget.used == 1
+    assert budget.remaining() == 2
+
+
+def testReleaseReturnsUntakenRequests() -> None:
+    budget = RequestBudget(5)
+    reservation = budget.reserve(3)
+    reservation.take()
+    reservation.release()
+    assert budget.remaining() == 4
+    reservation.release()
+    assert budget.remaining() == 4
+
+
+def testReservationCannotBeExceeded() -> None:
+    budget = RequestBudget(5)
+    reservation = budget.reserve(1)
+    reservation.take()
+    with pytest.raises(QuotaRefusedError):
+        reservation.take()
+    assert budget.used == 1
+
+
+def testBudgetRefusesWhenReserved() -> None:
+    budget = RequestBudget(2)
+    budget.reserve(2)
+    with pytest.raises(QuotaRefusedError):
+        budget.take()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+from typing import Any
+
+import pytest
+from quota import LIVE, QuotaLimiter, QuotaRefusedError
+from retry import OPEN, CircuitBreaker, CircuitOpenError, RetryableError, RetryPolicy, callWithRetry
+
+
+def openBreaker(failures: int = 2) -> CircuitBreaker:
+    breaker = CircuitBreaker("test", failureThreshold=failures, coolDown=0.0)
+    for _ in range(failures):
+        breaker.recordFailure("HTTP 503")
+    assert breaker.status().state == OPEN
+    return breaker
+
+
+def testQuotaRefusalDoesNotCloseBreaker(tmp_path: Any) -> None:
+    breaker = openBreaker()
+    limiter = QuotaLimiter(str(tmp_path / "quota.json"), "test", 10, 1000.0, 10)
+    limiter.exhaust()
+    calls = 0
+
+    def request() -> str:
+        nonlocal calls
+        limiter.acquire(LIVE)
+        calls += 1
+        return "ok"
+
+    # the probe call let through by the cooled-down breaker is refused locally, twice
+    for _ in range(2):
+        with pytest.raises(QuotaRefusedError):
+            callWithRetry(request, RetryPolicy(), breaker)
+    status = breaker.status()
+    assert calls == 0
+    assert status.state == OPEN
+    assert status.consecutiveFailures == 2
+    assert status.lastError == "HTTP 503"
+
+
+def testRefusedRetryIsNotRecorded() -> None:
+    breaker = CircuitBreaker("test", failureThreshold=1)
+    attempts = 0
+
+    def request() -> str:
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise RetryableError("HTTP 503")
+        raise QuotaRefusedError("budget used up")
+
+    with pytest.raises(QuotaRefusedError):
+        callWithRetry(request, RetryPolicy(baseDelay=0.0), breaker)
+    assert breaker.status().consecutiveFailures == 0
+    assert breaker.status().state != OPEN
+
+
+def testSuccessfulProbeClosesBreaker() -> None:
+    breaker = openBreaker()
+    assert callWithRetry(lambda: "ok", RetryPolicy(), breaker) == "ok"
+    assert breaker.status().consecutiveFailures == 0
+
+
+def testOpenBreakerRejectsCalls() -> None:
+    breaker = openBreaker()
+    breaker.coolDown = 60.0
+    breaker.recordFailure("HTTP 503")
+    with pytest.raises(CircuitOpenError):
+        callWithRetry(lambda: "ok", RetryPolicy(), breaker)
+
+
+def testRetryFailsFastWhenBreakerOpensMeanwhile() -> None:
+    breaker = CircuitBreaker("test")
+    attempts = 0
+
+    def request() -> str:
+        nonlocal attempts
+        attempts += 1
+        # another call finds the quota exhausted while this one waits to retry
+        breaker.trip("quota exceeded")
+        raise RetryableError("HTTP 503")
+
+    with pytest.raises(CircuitOpenError):
+        callWithRetry(request, RetryPolicy(baseDelay=0.0), breaker)
+    assert attempts == 1
+
+
+def testLongRetryAfterIsNotWaitedFor() -> None:
+    breaker = CircuitBreaker("test")
+
+    def request() -> str:
+        raise RetryableError("HTTP 429", retryAfter=RetryPolicy().maxRetryAfter + 1)
+
+    with pytest.raises(RetryableError):
+        callWithRetry(request, RetryPolicy(), breaker)
+    assert breaker.status().consecutiveFailures == 1
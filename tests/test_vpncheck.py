@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# (C) 2020 Count Count
+#
+# Distributed under the terms of the MIT license.
+
+from __future__ import unicode_literals
+
+import os
+import threading
+from typing import Any, Iterator, List
+
+import pytest
+from quota import RequestBudget
+from vpncheck import CheckResult, QuotaExceededException, VpnCheck
+
+
+@pytest.fixture
+def vpnCheck(tmp_path: Any, monkeypatch: Any) -> Iterator[VpnCheck]:
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("cache")
+    check = VpnCheck()
+    yield check
+    check.close()
+
+
+def testLiveLookupDoesNotShareBackgroundFailure(vpnCheck: VpnCheck) -> None:
+    started = threading.Event()
+    release = threading.Event()
+    errors: List[Exception] = []
+
+    def refusedFetch(ip: str) -> CheckResult:
+        started.set()
+        release.wait(5)
+        raise QuotaExceededException("budget used up")
+
+    def background() -> None:
+        with vpnCheck.background(RequestBudget(0).reserve(0)):
+            try:
+                vpnCheck.lookup("iphub", "192.0.2.1", refusedFetch)
+            except QuotaExceededException as ex:
+                errors.append(ex)
+
+    thread = threading.Thread(target=background)
+    thread.start()
+    assert started.wait(5)
+    try:
+        result = vpnCheck.lookup("iphub", "192.0.2.1", lambda ip: CheckResult(score=2, cached=False))
+    finally:
+        release.set()
+        thread.join()
+    assert result.isProxy
+    assert result.tier == "remote"
+    assert len(errors) == 1
+
+
+def testCloseStopsSyncingAndFlushes(tmp_path: Any, monkeypatch: Any) -> None:
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("cache")
+    check = VpnCheck(syncInterval=0.05)
+    assert check.syncThread and check.syncThread.is_alive()
+    check.caches["iphub"].put("192.0.2.3", 2)
+    check.close()
+    assert not check.syncThread.is_alive()
+    assert not check.caches["iphub"].dirty
+
+    reopened = VpnCheck(syncInterval=None)
+    assert reopened.syncThread is None
+    assert reopened.caches["iphub"].get("192.0.2.3") == 2
+    reopened.close()
@@ -5,7 +5,7 @@ BASTION=login.toolforge.org
 
 (cd ../; pipenv lock --requirements > /tmp/requirements.txt)
 
-scp /tmp/requirements.txt ../{sentinel.py,vpncheck.py,sseclient.py} deploy.sh vpncheck-deployment.yaml exec-bot.sh countcount@$BASTION:/data/project/dewikivpncheck/
+scp /tmp/requirements.txt ../{sentinel.py,vpncheck.py,sseclient.py,prefixtrie.py,blockindex.py,dnsbl.py,pipeline.py,logwriter.py,revisioncache.py,retry.py,quota.py,metrics.py,cascade.py,eventfilter.py,prefetch.py,checkpoint.py,reputation.py} deploy.sh vpncheck-deployment.yaml exec-bot.sh countcount@$BASTION:/data/project/dewikivpncheck/
 scp ../user-config.py countcount@$BASTION:/data/project/dewikivpncheck/user-config.py.orig
 ssh countcount@$BASTION "chmod 755 /data/project/dewikivpncheck/exec-bot.sh"
 ssh countcount@$BASTION "chmod 755 /data/project/dewikivpncheck/deploy.sh"
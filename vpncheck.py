@@ -6,19 +6,58 @@
 
 from __future__ import unicode_literals
 
+import argparse
 import json
 import os
+import shutil
+import struct
+import threading
 import time
-from dataclasses import dataclass
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+from datetime import timedelta
+from typing import Any, Callable, Dict, Generic, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
 
 import lmdb
+import metrics
+import pywikibot
 import requests
+from prefixtrie import IPNetwork, PrefixTrie, toNetwork
+from quota import BATCH, LIVE, QuotaLimiter, QuotaRefusedError, QuotaStatus, Reservation
+from requests.adapters import HTTPAdapter
+from retry import (
+    BreakerState,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryableError,
+    RetryPolicy,
+    callWithRetry,
+    parseRetryAfter,
+)
+
+T = TypeVar("T")
+
+# scores from this on mean VPN or proxy
+PROXY_SCORE = 2
 
 
 @dataclass
 class CheckResult:
     score: int
     cached: bool
+    # where the result came from: "local" (rules and lists), "dnsbl", "memory", "disk", "prefix", "remote" or
+    # "coalesced" (shared with a concurrent lookup)
+    tier: str = "remote"
+    # network the verdict was inferred from if the IP itself has not been checked
+    inferredFrom: Optional[str] = None
+    # the verdict settles the question regardless of what other providers would say (local lists)
+    final: bool = False
+
+    @property
+    def isProxy(self) -> bool:
+        return self.score >= PROXY_SCORE
 
 
 class CheckException(Exception):
@@ -29,131 +68,689 @@ class QuotaExceededException(CheckException):
     pass
 
 
-class VpnCheck:
+@dataclass
+class BatchCheckResult:
+    ip: str
+    result: Optional[CheckResult]
+    error: Optional[CheckException]
+
+
+CACHE_RECORD_VERSION = 1
+# version, provider id, score, fetch timestamp, last access timestamp
+cacheRecord = struct.Struct("<BBbII")
+PROVIDER_IDS = {"teoh": 1, "iphub": 2, "ipcheck": 3}
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# requests per day (None: unlimited), per second and burst, batch lookups leave batchReserve requests per day
+PROVIDER_LIMITS: Dict[str, Dict[str, Any]] = {
+    "teoh": {"dailyQuota": 1000, "rate": 1.0, "burst": 5, "batchReserve": 200},
+    "iphub": {"dailyQuota": 1000, "rate": 1.0, "burst": 5, "batchReserve": 200},
+    "ipcheck": {"dailyQuota": None, "rate": 2.0, "burst": 10},
+}
+# how long a provider is not asked again after reporting an exhausted quota
+QUOTA_COOL_DOWN = 3600
+
+
+def teohScore(jsonResponse: Any) -> int:
+    return PROXY_SCORE if jsonResponse["vpn_or_proxy"] != "no" else 0
+
+
+def iphubScore(jsonResponse: Any) -> int:
+    return PROXY_SCORE if jsonResponse["block"] == 1 else 0
+
+
+class VerdictCache:
+    """Persistent cache of provider scores with TTL expiry and least-recently-used eviction.
+
+    Records are stored as cacheRecord structs. Records from before the versioned format (raw JSON
+    responses) are converted with legacyScore when they are read or when the cache is compacted.
+
+    In shared mode the environment is opened with LMDB's lock file, so that several processes on the same
+    host can use the cache at the same time: readers do not block each other and writers are serialized.
+    LMDB's locking does not work across hosts, the cache must not be shared over a network file system
+    (e.g. between pods on different nodes). Writes are not synced to disk on commit but by sync, which
+    should be called periodically. Without shared mode only a single process may open the cache."""
+
+    def __init__(
+        self,
+        path: str,
+        provider: str,
+        ttl: timedelta,
+        legacyScore: Optional[Callable[[Any], int]] = None,
+        maxEntries: int = 300000,
+        mapSize: int = int(1e8),
+        shared: bool = False,
+    ) -> None:
+        self.path = path
+        self.provider = provider
+        self.providerId = PROVIDER_IDS[provider]
+        self.ttl = int(ttl.total_seconds())
+        self.legacyScore = legacyScore
+        self.maxEntries = maxEntries
+        self.mapSize = mapSize
+        self.shared = shared
+        # whether there are writes which have not been synced to disk yet
+        self.dirty = False
+        # the last access time is only rewritten if it is older than this to keep reads cheap
+        self.accessGranularity = 3600
+        # fraction of maxEntries which is evicted at once when the cache is full
+        self.evictFraction = 0.1
+        # without shared mode the environment is opened without locking, so concurrent lookups must not access
+        # it at the same time, the map size may only be changed while no transaction of the process is active
+        self.lock = threading.Lock()
+        self.env = self.openEnv()
+
+    def openEnv(self) -> lmdb.Environment:
+        return lmdb.open(
+            self.path,
+            map_size=self.mapSize,
+            metasync=False,
+            sync=False,
+            lock=self.shared,
+            writemap=False,
+            meminit=False,
+        )
+
+    def close(self) -> None:
+        with self.lock:
+            if self.dirty:
+                self.dirty = False
+                self.env.sync(True)
+            self.env.close()
+
+    def sync(self) -> None:
+        """Flush committed writes to disk."""
+        with self.lock:
+            if self.dirty:
+                self.dirty = False
+                self.env.sync(True)
+
+    def begin(self, write: bool = False) -> Any:
+        if write:
+            self.dirty = True
+        try:
+            return self.env.begin(write=write)
+        except lmdb.MapResizedError:
+            # another process has grown the map, adopt its size
+            self.env.set_mapsize(0)
+            self.mapSize = self.env.info()["map_size"]
+            return self.env.begin(write=write)
+
+    def decode(self, value: bytes, now: int) -> Tuple[int, int, int]:
+        """Return score, fetch and last access timestamp of a record."""
+        if value[0] == CACHE_RECORD_VERSION:
+            _, _, score, fetched, accessed = cacheRecord.unpack(value)
+            return score, fetched, accessed
+        if self.legacyScore is None:
+            # unknown record, treat it as expired
+            return 0, 0, 0
+        # legacy JSON record without timestamp, treat it as freshly fetched
+        return self.legacyScore(json.loads(str(value, "utf-8"))), now, now
+
+    def encode(self, score: int, fetched: int, accessed: int) -> bytes:
+        return cacheRecord.pack(CACHE_RECORD_VERSION, self.providerId, score, fetched, accessed)
+
+    def get(self, ip: str) -> Optional[int]:
+        key = ip.encode("utf-8")
+        now = int(time.time())
+        with self.lock:
+            with self.begin() as txn:
+                value = txn.get(key, None)
+                if value is None:
+                    return None
+                isCurrentVersion = value[0] == CACHE_RECORD_VERSION
+                score, fetched, accessed = self.decode(value, now)
+            if now - fetched > self.ttl:
+                with self.begin(write=True) as txn:
+                    txn.delete(key)
+                return None
+            if not isCurrentVersion or now - accessed > self.accessGranularity:
+                self.write(key, self.encode(score, fetched, now))
+            return score
+
+    def put(self, ip: str, score: int) -> None:
+        now = int(time.time())
+        with self.lock:
+            self.write(ip.encode("utf-8"), self.encode(score, now, now))
+
+    def write(self, key: bytes, value: bytes) -> None:
+        try:
+            with self.begin(write=True) as txn:
+                txn.put(key, value)
+                full = txn.stat(self.env.open_db())["entries"] > self.maxEntries
+        except lmdb.MapFullError:
+            # maxEntries does not fit into the map, e.g. because of unusually long keys
+            self.growMap()
+            self.evict(int(self.env.stat()["entries"] * (1 - self.evictFraction)))
+            with self.begin(write=True) as txn:
+                txn.put(key, value)
+            full = False
+        if full:
+            self.evict()
+
+    def evict(self, target: Optional[int] = None) -> int:
+        """Remove expired records and the least recently used ones until at most target records are left."""
+        if target is None:
+            target = int(self.maxEntries * (1 - self.evictFraction))
+        now = int(time.time())
+        expired: List[bytes] = []
+        byAccess: List[Tuple[int, bytes]] = []
+        with self.begin() as txn:
+            for key, value in txn.cursor():
+                score, fetched, accessed = self.decode(value, now)
+                if now - fetched > self.ttl:
+                    expired.append(key)
+                else:
+                    byAccess.append((accessed, key))
+        byAccess.sort()
+        toDelete = expired + [key for _, key in byAccess[: max(0, len(byAccess) - target)]]
+        try:
+            self.delete(toDelete)
+        except lmdb.MapFullError:
+            # deleting needs free pages as well
+            self.growMap()
+            self.delete(toDelete)
+        return len(toDelete)
+
+    def delete(self, keys: List[bytes]) -> None:
+        with self.begin(write=True) as txn:
+            for key in keys:
+                txn.delete(key)
+
+    def growMap(self) -> None:
+        # another process may have grown the map already
+        self.mapSize = int(max(self.mapSize, self.env.info()["map_size"]) * 1.5)
+        pywikibot.warning(f"{self.provider} cache map full, increasing map size to {self.mapSize}")
+        self.env.set_mapsize(self.mapSize)
+
+    def compact(self) -> Tuple[int, int]:
+        """Convert legacy records, drop expired ones and rewrite the database without free pages.
+
+        Must not run while another process uses the cache. Returns converted and removed record counts."""
+        now = int(time.time())
+        with self.lock:
+            converted = 0
+            with self.begin(write=True) as txn:
+                for key, value in txn.cursor():
+                    if value[0] != CACHE_RECORD_VERSION:
+                        score, fetched, accessed = self.decode(value, now)
+                        txn.put(key, self.encode(score, fetched, accessed))
+                        converted += 1
+            removed = self.evict()
+            compactPath = f"{self.path}.compact"
+            oldPath = f"{self.path}.old"
+            shutil.rmtree(compactPath, ignore_errors=True)
+            os.makedirs(compactPath)
+            self.env.copy(compactPath, compact=True)
+            self.env.close()
+            os.rename(self.path, oldPath)
+            os.rename(compactPath, self.path)
+            shutil.rmtree(oldPath)
+            self.env = self.openEnv()
+        return converted, removed
+
+
+class MemoryCache:
+    """In-process LRU cache of check results."""
+
+    def __init__(self, ttl: timedelta, maxEntries: int = 10000) -> None:
+        self.ttl = ttl.total_seconds()
+        self.maxEntries = maxEntries
+        self.entries: "OrderedDict[str, Tuple[float, CheckResult]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, ip: str) -> Optional[CheckResult]:
+        with self.lock:
+            entry = self.entries.get(ip)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self.entries[ip]
+                return None
+            self.entries.move_to_end(ip)
+            return entry[1]
+
+    def put(self, ip: str, result: CheckResult) -> None:
+        with self.lock:
+            self.entries[ip] = (time.monotonic(), result)
+            self.entries.move_to_end(ip)
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+
+@dataclass
+class PrefixStats:
+    checked: int = 0
+    proxies: int = 0
+
+    @property
+    def confidence(self) -> float:
+        return self.proxies / self.checked if self.checked else 0.0
+
+
+class PrefixVerdicts:
+    """Per-network counters of checked addresses which allow inferring proxy verdicts for whole ranges.
+
+    Once threshold addresses of a network have been found to be proxies and at least confidence of all
+    checked addresses in it were proxies, further addresses of the network are assumed to be proxies."""
+
+    # networks which are typically assigned as a whole
+    prefixLengths = {4: [24], 6: [48, 64]}
+
+    def __init__(self, threshold: int, confidence: float) -> None:
+        self.threshold = threshold
+        self.confidence = confidence
+        self.trie: PrefixTrie[PrefixStats] = PrefixTrie()
+        self.lock = threading.Lock()
+
+    def networks(self, ip: str) -> List[IPNetwork]:
+        network = toNetwork(ip)
+        return [network.supernet(new_prefix=prefixLen) for prefixLen in self.prefixLengths[network.version]]
+
+    def record(self, ip: str, proxy: bool) -> None:
+        with self.lock:
+            for network in self.networks(ip):
+                stats = self.trie.get(network)
+                if stats is None:
+                    stats = PrefixStats()
+                    self.trie.set(network, stats)
+                stats.checked += 1
+                if proxy:
+                    stats.proxies += 1
+
+    def proxiesNear(self, ip: str) -> int:
+        """Number of proxies found in the networks of ip."""
+        with self.lock:
+            return max((stats.proxies for _, stats in self.trie.enclosing(toNetwork(ip))), default=0)
+
+    def infer(self, ip: str) -> Optional[str]:
+        """Return the most specific network ip is assumed to be a proxy because of, if any."""
+        with self.lock:
+            for network, stats in reversed(list(self.trie.enclosing(toNetwork(ip)))):
+                if stats.proxies >= self.threshold and stats.confidence >= self.confidence:
+                    return str(network)
+        return None
+
+
+class SingleFlight(Generic[T]):
+    """Runs a call only once for concurrent callers with the same key, the others wait for its outcome."""
+
     def __init__(self) -> None:
+        self.calls: "Dict[Hashable, Future[T]]" = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> Tuple[T, bool]:
+        """Return the result of func and whether it was shared with a call which was already in flight."""
+        with self.lock:
+            future = self.calls.get(key)
+            shared = future is not None
+            if future is None:
+                future = Future()
+                self.calls[key] = future
+        if shared:
+            return future.result(), True
+        try:
+            future.set_result(func())
+        except BaseException as ex:
+            future.set_exception(ex)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result(), False
+
+
+def createSession(poolSize: int) -> requests.Session:
+    """Create a keep-alive session which pools up to poolSize connections per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class VpnCheck:
+    def __init__(
+        self,
+        poolSize: int = 8,
+        connectTimeout: float = 5.0,
+        readTimeout: float = 30.0,
+        prefixThreshold: int = 3,
+        prefixConfidence: float = 0.9,
+        priority: int = LIVE,
+        sharedCache: bool = True,
+        syncInterval: Optional[float] = 5.0,
+    ) -> None:
         self.ipcheckApikey = os.getenv("IPCHECK_API_KEY")
         self.iphubApikey = os.getenv("IPHUB_API_KEY")
-        self.teohCacheEnv = lmdb.open(
-            "cache/teoh", map_size=int(1e8), metasync=False, sync=False, lock=False, writemap=False, meminit=False
-        )
-        self.iphubCacheEnv = lmdb.open(
-            "cache/iphub", map_size=int(1e8), metasync=False, sync=False, lock=False, writemap=False, meminit=False
-        )
+        self.teohUrl = "https://ip.teoh.io/api/vpn/"
+        self.iphubUrl = "http://v2.api.iphub.info/ip/"
+        self.ipcheckUrl = "https://ipcheck.toolforge.org/index.php"
+        self.timeout = (connectTimeout, readTimeout)
+        # one long-lived session per provider so that connections (and TLS sessions) are reused
+        self.teohSession = createSession(poolSize)
+        self.iphubSession = createSession(poolSize)
+        self.ipcheckSession = createSession(poolSize)
+        # other processes on this host (check-ips.py) may use the caches at the same time
+        self.caches = {
+            "teoh": VerdictCache("cache/teoh", "teoh", timedelta(days=14), teohScore, shared=sharedCache),
+            "iphub": VerdictCache("cache/iphub", "iphub", timedelta(days=30), iphubScore, shared=sharedCache),
+            # ipcheck aggregates several upstream services and is checked repeatedly for the same IP
+            "ipcheck": VerdictCache("cache/ipcheck", "ipcheck", timedelta(days=1), shared=sharedCache),
+        }
+        # cache writes are flushed to disk every syncInterval seconds, without it only by close
+        self.syncInterval = syncInterval
+        self.stopping = threading.Event()
+        self.syncThread: Optional[threading.Thread] = None
+        if syncInterval:
+            self.syncThread = threading.Thread(target=self.syncCaches, name="cache-sync", daemon=True)
+            self.syncThread.start()
+        self.memoryCaches = {"ipcheck": MemoryCache(timedelta(hours=1))}
+        self.prefixVerdicts = {provider: PrefixVerdicts(prefixThreshold, prefixConfidence) for provider in self.caches}
+        self.inFlight: SingleFlight[CheckResult] = SingleFlight()
+        # lookups answered by a remote lookup of another caller which was in flight
+        self.savedRequests = 0
+        self.retryPolicy = RetryPolicy()
+        self.breakers = {provider: CircuitBreaker(provider) for provider in self.caches}
+        # priority class (LIVE or BATCH) of the lookups of this instance
+        self.priority = priority
+        self.limiters = {
+            provider: QuotaLimiter(f"cache/quota-{provider}.json", provider, **limits)
+            for provider, limits in PROVIDER_LIMITS.items()
+        }
+        # per-thread budget reservation of background lookups
+        self.context = threading.local()
 
-    def checkWithTeoh(self, ip: str) -> CheckResult:
-        if ip.startswith("2001:16B8:"):
-            return CheckResult(score=0, cached=True)
-        jsonResponse = None
-        cached = False
-        with self.teohCacheEnv.begin(buffers=True) as txn:
-            getRes = txn.get(ip.encode("utf-8"), None)
-            if getRes:
-                cached = True
-                jsonResponse = json.loads(str(getRes, "utf-8"))
-        lastError = None
-        if not jsonResponse:
-            for _ in range(5):
+    @contextmanager
+    def background(self, budget: Reservation) -> Iterator[None]:
+        """Make the lookups of the current thread batch lookups whose requests are charged to budget."""
+        self.context.budget = budget
+        try:
+            yield
+        finally:
+            self.context.budget = None
+
+    def syncCaches(self) -> None:
+        while not self.stopping.wait(self.syncInterval):
+            for cache in self.caches.values():
                 try:
-                    response = requests.get(f"https://ip.teoh.io/api/vpn/{ip}")
-                    if response.status_code == 200:
-                        jsonResponse = json.loads(response.text)
-                        if not "vpn_or_proxy" in jsonResponse:
-                            if "message" in jsonResponse:
-                                if jsonResponse["message"].find("Exceeded limit"):
-                                    raise QuotaExceededException("Teoh check failed: Quota exceeded")
-                                else:
-                                    raise CheckException(f"Teoh check failed: {jsonResponse['message']}")
-                            else:
-                                raise CheckException("Teoh check failed: Unknown error")
-                        with self.teohCacheEnv.begin(buffers=True, write=True) as txn:
-                            txn.put(ip.encode("utf-8"), response.text.encode("utf-8"))
-                        break
+                    cache.sync()
+                except lmdb.Error as ex:
+                    pywikibot.warning(f"Syncing the {cache.provider} cache failed: {ex}")
+
+    def close(self) -> None:
+        """Stop syncing, flush and close the caches and close the sessions."""
+        self.stopping.set()
+        if self.syncThread:
+            self.syncThread.join()
+        for cache in self.caches.values():
+            cache.close()
+        for session in (self.teohSession, self.iphubSession, self.ipcheckSession):
+            session.close()
+
+    def checkMany(
+        self, ips: Iterable[str], check: Callable[[str], CheckResult], concurrency: int = 8
+    ) -> Iterator[BatchCheckResult]:
+        """Check ips with at most concurrency parallel lookups, yielding results as they complete.
+
+        Per-IP failures are reported in BatchCheckResult.error. A QuotaExceededException cancels
+        all lookups which have not been started yet and is raised once the running ones are done."""
+        ipIterator = iter(ips)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending: Set["Future[CheckResult]"] = set()
+            futureToIp: Dict["Future[CheckResult]", str] = {}
+
+            def submitNext() -> bool:
+                ip = next(ipIterator, None)
+                if ip is None:
+                    return False
+                future = executor.submit(check, ip)
+                futureToIp[future] = ip
+                pending.add(future)
+                return True
+
+            for _ in range(concurrency):
+                if not submitNext():
+                    break
+            quotaException: Optional[QuotaExceededException] = None
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    ip = futureToIp.pop(future)
+                    try:
+                        result = future.result()
+                    except QuotaExceededException as ex:
+                        quotaException = ex
+                    except CheckException as ex:
+                        yield BatchCheckResult(ip=ip, result=None, error=ex)
                     else:
-                        response.raise_for_status()
-                except CheckException:
-                    raise
-                except Exception as ex:
-                    lastError = str(ex)
-                # delay in case of error
-                time.sleep(1)
+                        yield BatchCheckResult(ip=ip, result=result, error=None)
+                    if not quotaException:
+                        submitNext()
+            if quotaException:
+                raise quotaException
+
+    def lookup(self, provider: str, ip: str, fetch: Callable[[str], CheckResult]) -> CheckResult:
+        """Serve ip from the caches of provider, infer it from its network or fetch it remotely.
+
+        Concurrent lookups of the same ip share a single lookup. Background lookups are only shared with
+        each other, live lookups must neither run at batch priority nor fail because a budget is used up."""
+        background = getattr(self.context, "budget", None) is not None
+        result, shared = self.inFlight.do((provider, ip, background), lambda: self.lookupOnce(provider, ip, fetch))
+        if not shared:
+            return result
+        metrics.cacheLookups.inc(provider, "coalesced", "hit")
+        if result.tier == "remote":
+            with self.inFlight.lock:
+                self.savedRequests += 1
+        return replace(result, cached=True, tier="coalesced")
+
+    def lookupOnce(self, provider: str, ip: str, fetch: Callable[[str], CheckResult]) -> CheckResult:
+        memoryCache = self.memoryCaches.get(provider)
+        if memoryCache:
+            memoryResult = memoryCache.get(ip)
+            if memoryResult:
+                metrics.cacheLookups.inc(provider, "memory", "hit")
+                return replace(memoryResult, cached=True, tier="memory")
+            metrics.cacheLookups.inc(provider, "memory", "miss")
+        cachedScore = self.caches[provider].get(ip)
+        if cachedScore is not None:
+            metrics.cacheLookups.inc(provider, "disk", "hit")
+            result = CheckResult(score=cachedScore, cached=True, tier="disk")
+            if memoryCache:
+                memoryCache.put(ip, result)
+            return result
+        metrics.cacheLookups.inc(provider, "disk", "miss")
+        inferredFrom = self.prefixVerdicts[provider].infer(ip)
+        if inferredFrom:
+            metrics.cacheLookups.inc(provider, "prefix", "hit")
+            return CheckResult(score=PROXY_SCORE, cached=True, tier="prefix", inferredFrom=inferredFrom)
+        metrics.cacheLookups.inc(provider, "prefix", "miss")
+        result = fetch(ip)
+        self.caches[provider].put(ip, result.score)
+        if memoryCache:
+            memoryCache.put(ip, result)
+        self.prefixVerdicts[provider].record(ip, result.isProxy)
+        return result
+
+    def checkWithTeoh(self, ip: str) -> CheckResult:
+        if ip.startswith("2001:16B8:"):
+            return CheckResult(score=0, cached=True, tier="local")
+        return self.lookup("teoh", ip, self.fetchFromTeoh)
+
+    def fetchJson(
+        self, provider: str, session: requests.Session, url: str, headers: Optional[Dict[str, str]] = None
+    ) -> Any:
+        """GET url and decode the JSON response, transient failures raise RetryableError."""
+        try:
+            response = session.get(url, headers=headers, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            raise RetryableError(f"{provider} check failed: {ex}")
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise RetryableError(
+                f"{provider} check failed: HTTP {response.status_code}",
+                parseRetryAfter(response.headers.get("Retry-After")),
+            )
+        if response.status_code != 200:
+            raise CheckException(f"{provider} check failed: HTTP {response.status_code}")
+        try:
+            return json.loads(response.text)
+        except ValueError as ex:
+            raise RetryableError(f"{provider} check failed: invalid response: {ex}")
+
+    def fetch(self, provider: str, request: Callable[[], CheckResult]) -> CheckResult:
+        """Run request with retries behind the circuit breaker and rate limiter of provider."""
+        try:
+            return self.fetchWithRetry(provider, request)
+        except QuotaExceededException:
+            metrics.providerQuotaErrors.inc(provider)
+            raise
+
+    def fetchWithRetry(self, provider: str, request: Callable[[], CheckResult]) -> CheckResult:
+        breaker = self.breakers[provider]
+        limiter = self.limiters[provider]
+        attempts = 0
+
+        def limitedRequest() -> CheckResult:
+            nonlocal attempts
+            if attempts:
+                metrics.providerRetries.inc(provider)
+            attempts += 1
+            # every attempt counts against the quota
+            budget = getattr(self.context, "budget", None)
+            if budget:
+                budget.take()
+            limiter.acquire(BATCH if budget else self.priority)
+            outcome = "error"
+            start = time.perf_counter()
+            try:
+                res = request()
+                outcome = "ok"
+                return res
+            except QuotaExceededException:
+                outcome = "quota"
+                raise
+            except RetryableError:
+                outcome = "retryable"
+                raise
+            finally:
+                metrics.providerRequestSeconds.observe(time.perf_counter() - start, provider)
+                metrics.providerRequests.inc(provider, outcome)
+
+        try:
+            return callWithRetry(limitedRequest, self.retryPolicy, breaker)
+        except QuotaRefusedError as ex:
+            raise QuotaExceededException(str(ex))
+        except CircuitOpenError as ex:
+            if breaker.status().tripped:
+                raise QuotaExceededException(str(ex))
+            raise CheckException(str(ex))
+        except RetryableError as ex:
+            if ex.retryAfter is not None and ex.retryAfter > self.retryPolicy.maxRetryAfter:
+                breaker.trip(str(ex), ex.retryAfter)
+                raise QuotaExceededException(f"{ex}, retry after {ex.retryAfter:.0f}s")
+            raise CheckException(str(ex))
+        except QuotaExceededException as ex:
+            breaker.trip(str(ex), QUOTA_COOL_DOWN)
+            limiter.exhaust()
+            raise
+
+    def breakerStates(self) -> Dict[str, BreakerState]:
+        return {provider: breaker.status() for provider, breaker in self.breakers.items()}
+
+    def quotaStates(self) -> Dict[str, QuotaStatus]:
+        return {provider: limiter.status() for provider, limiter in self.limiters.items()}
+
+    def fetchFromTeoh(self, ip: str) -> CheckResult:
+        return self.fetch("teoh", lambda: self.requestTeoh(ip))
+
+    def requestTeoh(self, ip: str) -> CheckResult:
+        jsonResponse = self.fetchJson("Teoh", self.teohSession, f"{self.teohUrl}{ip}")
+        if not "vpn_or_proxy" in jsonResponse:
+            if "message" in jsonResponse:
+                if "Exceeded limit" in jsonResponse["message"]:
+                    raise QuotaExceededException("Teoh check failed: Quota exceeded")
+                else:
+                    raise CheckException(f"Teoh check failed: {jsonResponse['message']}")
             else:
-                raise CheckException(lastError)
-        score = 2 if jsonResponse["vpn_or_proxy"] != "no" else 0
-        return CheckResult(score=score, cached=cached)
+                raise CheckException("Teoh check failed: Unknown error")
+        return CheckResult(score=teohScore(jsonResponse), cached=False)
 
     def checkWithIphub(self, ip: str) -> CheckResult:
-        jsonResponse = None
-        cached = False
-        with self.iphubCacheEnv.begin(buffers=True) as txn:
-            getRes = txn.get(ip.encode("utf-8"), None)
-            if getRes:
-                cached = True
-                jsonResponse = json.loads(str(getRes, "utf-8"))
-        lastError = None
-        if not jsonResponse:
-            for _ in range(5):
-                try:
-                    response = requests.get(f"http://v2.api.iphub.info/ip/{ip}", headers={"X-Key": self.iphubApikey},)
-                    if response.status_code == 200:
-                        jsonResponse = json.loads(response.text)
-                        if not "block" in jsonResponse:
-                            raise CheckException("Iphub check failed: Unknown error")
-                        with self.iphubCacheEnv.begin(buffers=True, write=True) as txn:
-                            txn.put(ip.encode("utf-8"), response.text.encode("utf-8"))
-                        break
-                    else:
-                        response.raise_for_status()
-                except CheckException:
-                    raise
-                except Exception as ex:
-                    lastError = str(ex)
-                # delay in case of error
-                time.sleep(1)
-            else:
-                raise CheckException(lastError)
-        score = 2 if jsonResponse["block"] == 1 else 0
-        return CheckResult(score=score, cached=cached)
+        return self.lookup("iphub", ip, self.fetchFromIphub)
+
+    def fetchFromIphub(self, ip: str) -> CheckResult:
+        return self.fetch("iphub", lambda: self.requestIphub(ip))
+
+    def requestIphub(self, ip: str) -> CheckResult:
+        jsonResponse = self.fetchJson(
+            "Iphub", self.iphubSession, f"{self.iphubUrl}{ip}", headers={"X-Key": self.iphubApikey or ""}
+        )
+        if not "block" in jsonResponse:
+            raise CheckException("Iphub check failed: Unknown error")
+        return CheckResult(score=iphubScore(jsonResponse), cached=False)
 
     def checkWithIpCheck(self, ip: str) -> CheckResult:
-        lastError = None
-        for _ in range(5):
-            try:
-                response = requests.get(
-                    f"https://ipcheck.toolforge.org/index.php?ip={ip}&api=true&key={self.ipcheckApikey}"
+        return self.lookup("ipcheck", ip, self.fetchFromIpCheck)
+
+    def fetchFromIpCheck(self, ip: str) -> CheckResult:
+        return self.fetch("ipcheck", lambda: self.requestIpCheck(ip))
+
+    def requestIpCheck(self, ip: str) -> CheckResult:
+        jsonResponse = self.fetchJson(
+            "Ipcheck", self.ipcheckSession, f"{self.ipcheckUrl}?ip={ip}&api=true&key={self.ipcheckApikey}"
+        )
+        try:
+            blockScore = 0
+            errors = 0
+            if not "error" in jsonResponse["teohio"]:
+                if jsonResponse["teohio"]["result"]["vpnOrProxy"]:
+                    blockScore += 1
+            else:
+                errors += 1
+            if not "error" in jsonResponse["proxycheck"]:
+                if jsonResponse["proxycheck"]["result"]["proxy"]:
+                    blockScore += 1
+            else:
+                errors += 1
+            if not "error" in jsonResponse["getIPIntel"]:
+                if jsonResponse["getIPIntel"]["result"]["chance"] == 100:
+                    blockScore += 1
+            if not "error" in jsonResponse["ipQualityScore"]:
+                if jsonResponse["ipQualityScore"]["result"]["proxy"] or jsonResponse["ipQualityScore"]["result"]["vpn"]:
+                    blockScore += 1
+            else:
+                errors += 1
+
+            cached = jsonResponse["cache"]["result"]["cached"] == "yes"
+        except (KeyError, TypeError) as ex:
+            raise CheckException(f"Ipcheck check failed: unexpected response: {ex!r}")
+        return CheckResult(cached=cached, score=blockScore)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Maintain the local verdict caches.")
+    parser.add_argument(
+        "command",
+        choices=["compact", "quota"],
+        help="compact: convert old records and reclaim space, quota: show the quota used today",
+    )
+    args = parser.parse_args()
+    vpnCheck = VpnCheck(syncInterval=None)
+    try:
+        if args.command == "quota":
+            for status in vpnCheck.quotaStates().values():
+                limit = (
+                    f"{status.dailyQuota} (batch reserve {status.batchReserve})" if status.dailyQuota else "unlimited"
                 )
-                if response.status_code == 200:
-                    blockScore = 0
-                    errors = 0
-                    jsonResponse = json.loads(response.text)
-                    if not "error" in jsonResponse["teohio"]:
-                        if jsonResponse["teohio"]["result"]["vpnOrProxy"]:
-                            blockScore += 1
-                    else:
-                        errors += 1
-                    if not "error" in jsonResponse["proxycheck"]:
-                        if jsonResponse["proxycheck"]["result"]["proxy"]:
-                            blockScore += 1
-                    else:
-                        errors += 1
-                    if not "error" in jsonResponse["getIPIntel"]:
-                        if jsonResponse["getIPIntel"]["result"]["chance"] == 100:
-                            blockScore += 1
-                    if not "error" in jsonResponse["ipQualityScore"]:
-                        if (
-                            jsonResponse["ipQualityScore"]["result"]["proxy"]
-                            or jsonResponse["ipQualityScore"]["result"]["vpn"]
-                        ):
-                            blockScore += 1
-                    else:
-                        errors += 1
+                print(f"{status.provider}: used {status.used} of {limit}, {status.tokens:.1f} tokens")
+            return
+        for cache in vpnCheck.caches.values():
+            converted, removed = cache.compact()
+            print(f"{cache.provider}: converted {converted}, removed {removed} records")
+    finally:
+        vpnCheck.close()
 
-                    cached = jsonResponse["cache"]["result"]["cached"] == "yes"
-                    return CheckResult(cached=cached, score=blockScore)
-                else:
-                    response.raise_for_status()
-            except Exception as ex:
-                lastError = str(ex)
-            # delay in case of error
-            time.sleep(1)
 
-        raise CheckException(lastError)
+if __name__ == "__main__":
+    main()